@@ -0,0 +1,91 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, NamedTuple
+
+TOKEN_CACHE_SIZE = 4096
+TOKEN_CACHE_TTL = 30  # seconds
+ROUTE_CACHE_SIZE = 4096
+ROUTE_CACHE_TTL = 300  # seconds, routes only change during an offline rebalance
+LEGACY_MISS_CACHE_SIZE = 4096
+LEGACY_MISS_CACHE_TTL = 3600  # seconds
+
+
+class UserSnapshot(NamedTuple):
+    id: int
+    username: str
+    disabled: bool
+    shard: int | None = None
+
+
+class TTLCache:
+    def __init__(self, maxsize: int = 1024, ttl: float = 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # Bumped by every removal, a value loaded before one is stale
+        self.generation = 0
+        self._data: OrderedDict[Any, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl: float | None = None, generation: int | None = None):
+        # `generation` is read before loading `value`, a removal since then
+        # may have been for it and the value is not cached
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self.generation += 1
+            entry = self._data.pop(key, None)
+        return entry[1] if entry else None
+
+    def invalidate(self, predicate: Callable[[Any], bool]):
+        with self._lock:
+            self.generation += 1
+            for key in [k for k, (_, v) in self._data.items() if predicate(v)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._data.clear()
+
+    def stats(self) -> dict:
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+# Maps token_digest(token) -> UserSnapshot for tokens that passed verification.
+# Per process: revoking clears it here only, other workers keep accepting
+# the token until their entry expires, at most TOKEN_CACHE_TTL seconds.
+token_cache = TTLCache(maxsize=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL)
+# Maps username -> shard holding the account
+route_cache = TTLCache(maxsize=ROUTE_CACHE_SIZE, ttl=ROUTE_CACHE_TTL)
+# Digests of tokens without a session that matched none of their account's
+# legacy hashes. Those are only ever removed, a token that missed once always
+# misses, so a revoked or unknown token costs the Argon2 checks once.
+legacy_miss_cache = TTLCache(maxsize=LEGACY_MISS_CACHE_SIZE, ttl=LEGACY_MISS_CACHE_TTL)
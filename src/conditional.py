@@ -0,0 +1,59 @@
+from fastapi import HTTPException, Request, Response, status
+from starlette.datastructures import Headers, MutableHeaders
+
+
+def parse_etags(header: str | None) -> set[str]:
+    if not header:
+        return set()
+    # Weak comparison, W/"x" matches "x"
+    return {tag.strip().removeprefix("W/") for tag in header.split(",") if tag.strip()}
+
+
+def not_modified(request: Request, response: Response, etag: str) -> Response | None:
+    # Answers If-None-Match before the payload is loaded, otherwise tags the response
+    tags = parse_etags(request.headers.get("if-none-match"))
+    if etag in tags or "*" in tags:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    return None
+
+
+def check_if_match(request: Request, etag: str):
+    header = request.headers.get("if-match")
+    if header is None:
+        return
+    tags = parse_etags(header)
+    if etag not in tags and "*" not in tags:
+        raise HTTPException(
+            status_code=status.HTTP_412_PRECONDITION_FAILED,
+            detail="Resource was modified",
+            headers={"ETag": etag}
+        )
+
+
+class EncodingETagMiddleware:
+    # The tags name the resource state, not its bytes. Clients that accept
+    # gzip may get a compressed body, so they get weak tags, and every tagged
+    # response varies on Accept-Encoding. Plain ASGI, sits outside GZipMiddleware.
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        gzip = "gzip" in Headers(scope=scope).get("accept-encoding", "")
+
+        async def send_tagged(message):
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                etag = headers.get("etag")
+                if etag is not None:
+                    if gzip and not etag.startswith("W/"):
+                        headers["etag"] = f"W/{etag}"
+                    vary = [value.strip() for value in headers.get("vary", "").split(",") if value.strip()]
+                    if "accept-encoding" not in {value.lower() for value in vary}:
+                        headers["vary"] = ", ".join([*vary, "Accept-Encoding"])
+            await send(message)
+
+        await self.app(scope, receive, send_tagged)
@@ -1,32 +1,456 @@
+import contextlib
+import contextvars
+import fcntl
+import functools
+import hashlib
 import os
+import queue
+import random
+import sqlite3
 import threading
+import time
+from pathlib import Path
+from typing import Callable
+
+import yaml
+from peewee import OperationalError
 from playhouse.sqlite_ext import SqliteExtDatabase
 
+from src.metrics import metrics
+from src.writequeue import WriteQueue
+
+# Worker threads that may hold a connection at once. WAL allows any number of
+# readers next to the single writer, writers queue on the IMMEDIATE lock.
+DB_THREADS = int(os.getenv("DB_THREADS", 16))
+CONFIG_PATH = os.getenv("CONFIG_PATH", "config.yml")
+
+WRITE_QUEUE_SIZE = int(os.getenv("WRITE_QUEUE_SIZE", 1000))  # mutations waiting for the writer
+WRITE_QUEUE_TIMEOUT = float(os.getenv("WRITE_QUEUE_TIMEOUT", 1))  # seconds to wait for a slot
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", 64))  # mutations per group commit
+WRITE_RETRIES = int(os.getenv("WRITE_RETRIES", 8))  # BEGIN IMMEDIATE attempts past busy_timeout
+WRITE_RETRY_BASE = 0.01  # seconds
+WRITE_RETRY_CAP = 1  # seconds
+
+DEFAULT_SETTINGS = {
+    "database_name": "database.db",
+    "database_location": ".",
+    "synchronous": "normal",  # Durable at checkpoints, enough with WAL.
+    "mmap_size": 256 * 1024 * 1024,
+    "busy_timeout": 5000,  # milliseconds
+    "cache_size": -1024 * 64,  # 64MB page-cache.
+    "temp_store": "memory",
+    "wal_autocheckpoint": 1000,  # pages
+    "statement_cache": 256,  # prepared statements kept per connection
+    "read_pool_size": DB_THREADS,
+    "shards": 0,  # account data split across this many files, 0 keeps one file
+}
+
+# Shard of the account the current request acts for, None is the main file
+# holding the account routes and the shared caches
+current_shard: contextvars.ContextVar[int | None] = contextvars.ContextVar("current_shard", default=None)
+
 # base_dir = os.path.dirname(os.path.abspath(__file__))
 # db_name = os.path.join(base_dir, 'database.db')
 # os.makedirs(os.path.dirname(db_name), exist_ok=True)
 
 
+def read_settings(path: str = CONFIG_PATH) -> dict:
+    try:
+        with open(path) as file:
+            config = yaml.safe_load(file) or {}
+    except FileNotFoundError:
+        config = {}
+    return {**DEFAULT_SETTINGS, **config.get("sqlite", {}), **{
+        key: config[key] for key in ("database_name", "database_location") if key in config
+    }}
+
+
+def shard_for(user_id: int, shards: int) -> int:
+    # Stable across processes and restarts, unlike the builtin hash()
+    digest = hashlib.blake2b(str(user_id).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % shards
+
+
+@contextlib.contextmanager
+def use_shard(shard: int | None):
+    token = current_shard.set(shard)
+    try:
+        yield
+    finally:
+        current_shard.reset(token)
+
+
+def main_shard(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with use_shard(None):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+class ReadOnlyConnection(sqlite3.Connection):
+    pass
+
+
+class SplitDatabase(SqliteExtDatabase):
+    # One writer connection shared by every thread under a lock and a pool
+    # of read-only connections. A thread borrows one for the length of a
+    # transaction, outside of reader()/writer() it keeps its own connection.
+    # With shards the borrowed connection comes from the current shard's
+    # pools, the models stay bound to this database either way.
+    def __init__(self, database, read_pool_size: int = DB_THREADS, shards: list["SplitDatabase"] = (), **kwargs):
+        super().__init__(database, **kwargs)
+        self.read_pool_size = read_pool_size
+        self.shards = list(shards)
+        self._readers: queue.LifoQueue = queue.LifoQueue()
+        self._reader_count = 0
+        self._writer_conn: sqlite3.Connection | None = None
+        self._write_lock = threading.RLock()
+        self._pool_lock = threading.Lock()
+        self._after_commit: dict[int, list[Callable[[], None]]] = {}
+
+    @property
+    def split(self) -> bool:
+        return self.read_pool_size > 0 and self.database != ":memory:" and not self.database.startswith("file:")
+
+    def shard_ids(self) -> list[int]:
+        return list(range(len(self.shards)))
+
+    def _target(self) -> "SplitDatabase":
+        shard = current_shard.get()
+        return self if shard is None or not self.shards else self.shards[shard]
+
+    def execute_sql(self, sql, params=None, commit=None):
+        # Execution only, rows fetched afterwards by the cursor are not timed
+        started = time.perf_counter()
+        try:
+            return super().execute_sql(sql, params, commit)
+        finally:
+            metrics.observe_query(sql, time.perf_counter() - started)
+
+    def after_commit(self, callback: Callable[[], None]):
+        # Runs once the enclosing transaction commits, right away outside of
+        # one and never if it rolls back
+        if not self.in_transaction():
+            callback()
+            return
+        self._after_commit.setdefault(id(self._state.conn), []).append(callback)
+
+    def commit(self):
+        super().commit()
+        for callback in self._after_commit.pop(id(self._state.conn), ()):
+            callback()
+
+    def rollback(self):
+        self._after_commit.pop(id(self._state.conn), None)
+        super().rollback()
+
+    def _set_pragmas(self, conn):
+        # journal_mode needs a write lock, readers inherit it from the file
+        pragmas = self._pragmas
+        if isinstance(conn, ReadOnlyConnection):
+            pragmas = [(pragma, value) for pragma, value in pragmas if pragma != "journal_mode"]
+        cursor = conn.cursor()
+        for pragma, value in pragmas:
+            cursor.execute('PRAGMA %s = %s;' % (pragma, value))
+        cursor.close()
+
+    def _open(self, readonly=False) -> sqlite3.Connection:
+        params = {**self.connect_params, "check_same_thread": False}
+        if readonly:
+            # as_uri() escapes what would end the path early, like ? and #
+            uri = f"{Path(self.database).absolute().as_uri()}?mode=ro"
+            conn = sqlite3.connect(uri, uri=True, timeout=self._timeout,
+                                   isolation_level=None, factory=ReadOnlyConnection, **params)
+        else:
+            conn = sqlite3.connect(self.database, timeout=self._timeout, isolation_level=None, **params)
+        try:
+            self._add_conn_hooks(conn)
+        except Exception:
+            conn.close()
+            raise
+        if self.server_version is None:
+            self._set_server_version(conn)
+        return conn
+
+    def _checkout(self) -> sqlite3.Connection:
+        with self._pool_lock:
+            if self._writer_conn is None:
+                # The writer switches the file to WAL, read-only connections cannot
+                self._writer_conn = self._open()
+            if self._readers.empty() and self._reader_count < self.read_pool_size:
+                self._reader_count += 1
+                try:
+                    return self._open(readonly=True)
+                except Exception:
+                    self._reader_count -= 1
+                    raise
+        try:
+            return self._readers.get(timeout=self._timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError("Timed out waiting for a read connection")
+
+    @contextlib.contextmanager
+    def _bound(self, conn: sqlite3.Connection, target: "SplitDatabase"):
+        state = self._state
+        saved = (state.closed, state.conn, state.ctx, state.transactions, getattr(state, "target", None))
+        state.set_connection(conn)
+        state.target = target
+        try:
+            yield
+        finally:
+            state.closed, state.conn, state.ctx, state.transactions, state.target = saved
+
+    @contextlib.contextmanager
+    def reader(self):
+        target = self._target()
+        if not target.split or (self._state.conn is not None and self.in_transaction()
+                                and getattr(self._state, "target", self) is target):
+            yield
+            return
+        conn = target._checkout()
+        try:
+            with self._bound(conn, target):
+                yield
+        finally:
+            target._readers.put(conn)
+
+    @contextlib.contextmanager
+    def writer(self):
+        target = self._target()
+        if not target.split or self._state.conn is not None and self._state.conn is target._writer_conn:
+            yield
+            return
+        started = time.perf_counter()
+        with target._write_lock:
+            metrics.observe_lock_wait("writer", time.perf_counter() - started)
+            with target._pool_lock:
+                if target._writer_conn is None:
+                    target._writer_conn = target._open()
+            with self._bound(target._writer_conn, target):
+                yield
+
+    def wal_size(self) -> int:
+        try:
+            return os.path.getsize(self._target().database + "-wal")
+        except OSError:
+            return 0
+
+    def checkpoint(self, truncate_timeout: float) -> tuple[int, int, int]:
+        # PASSIVE copies what it can without waiting on anyone. Only once every
+        # frame is copied is TRUNCATE tried, it waits up to `truncate_timeout`
+        # for readers to leave the WAL and then resets the file to zero bytes.
+        with self.writer():
+            busy, log, checkpointed = self.execute_sql("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+            if busy or log != checkpointed:
+                return busy, log, checkpointed
+            self.execute_sql(f"PRAGMA busy_timeout = {int(truncate_timeout * 1000)}")
+            try:
+                return self.execute_sql("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+            finally:
+                self.execute_sql(f"PRAGMA busy_timeout = {int(self._timeout * 1000)}")
+
+    def optimize(self, analysis_limit: int):
+        # 0x10002 checks every table, not only the ones this connection used,
+        # analysis_limit caps the rows ANALYZE samples per index
+        with self.writer():
+            self.execute_sql(f"PRAGMA analysis_limit = {analysis_limit}")
+            self.execute_sql("PRAGMA optimize = 0x10002")
+
+    def close_pool(self):
+        for shard in self.shards:
+            shard.close_pool()
+        with self._write_lock, self._pool_lock:
+            while not self._readers.empty():
+                self._readers.get_nowait().close()
+                self._reader_count -= 1
+            if self._writer_conn is not None:
+                self._writer_conn.close()
+                self._writer_conn = None
+
+
+def shard_path(db_name: str, shard: int) -> str:
+    root, ext = os.path.splitext(db_name)
+    return f"{root}-shard{shard}{ext}"
+
+
+def create_database(db_name: str | None = None, settings: dict | None = None) -> SplitDatabase:
+    settings = settings or read_settings()
+    if db_name is None:
+        db_name = os.path.join(settings["database_location"], settings["database_name"])
+    shards = []
+    if settings["shards"] and db_name != ":memory:":
+        # Shards are reached through the pools only, they need at least one reader
+        settings = {**settings, "read_pool_size": max(settings["read_pool_size"], 1)}
+        shards = [create_database(shard_path(db_name, shard), {**settings, "shards": 0})
+                  for shard in range(settings["shards"])]
+    return SplitDatabase(
+        db_name,
+        read_pool_size=settings["read_pool_size"],
+        shards=shards,
+        timeout=settings["busy_timeout"] / 1000,
+        cached_statements=settings["statement_cache"],
+        pragmas=(
+            ('cache_size', settings["cache_size"]),
+            ('journal_mode', 'wal'),  # Use WAL-mode (you should always use this!).
+            ('foreign_keys', 1),  # Enforce foreign-key constraints.
+            ('synchronous', settings["synchronous"]),
+            ('mmap_size', settings["mmap_size"]),
+            ('temp_store', settings["temp_store"]),
+            ('wal_autocheckpoint', settings["wal_autocheckpoint"])))
+
+
 class DatabaseSingleton:
-    _instance: SqliteExtDatabase = None
+    _instance: SplitDatabase = None
     _lock = threading.Lock()
 
-    def __new__(cls, db_name='database.db'):
+    def __new__(cls, db_name=None):
         if not cls._instance:
             with cls._lock:
                 if not cls._instance:
-                    cls._instance = SqliteExtDatabase(db_name, pragmas=(
-                        ('cache_size', -1024 * 64),  # 64MB page-cache.
-                        ('journal_mode', 'wal'),  # Use WAL-mode (you should always use this!).
-                        ('foreign_keys', 1)))  # Enforce foreign-key constraints.
+                    cls._instance = create_database(db_name)
         return cls._instance
 
     @classmethod
-    def initialize(cls, db_name):
+    def initialize(cls, db_name, shards: int | None = None):
         if cls._instance:
             cls._instance.close()
-        cls._instance = SqliteExtDatabase(db_name, pragmas=(
-            ('cache_size', -1024 * 64),  # 64MB page-cache.
-            ('journal_mode', 'wal'),  # Use WAL-mode (you should always use this!).
-            ('foreign_keys', 1)))  # Enforce foreign-key constraints.
+            cls._instance.close_pool()
+        settings = read_settings()
+        if shards is not None:
+            settings["shards"] = shards
+        cls._instance = create_database(db_name, settings)
         return cls._instance
+
+
+@contextlib.contextmanager
+def serving():
+    # The watch progress buffer, and the ETags it feeds, live in the serving
+    # process. Another worker serving the same file would miss its buffered
+    # positions, so it fails to start while this lock is held.
+    database = DatabaseSingleton()
+    if database.database == ":memory:" or database.database.startswith("file:"):
+        yield
+        return
+    with open(f"{database.database}.lock", "a") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise RuntimeError(f"{database.database} is already served by another process, run a single worker")
+        yield
+
+
+def is_busy(error: Exception) -> bool:
+    return "database is locked" in str(error) or "database is busy" in str(error)
+
+
+@contextlib.contextmanager
+def writing():
+    # Takes the write lock up front, a deferred transaction that upgrades to a
+    # writer can fail with "database is locked" without waiting on busy_timeout.
+    # Other worker processes can hold the lock past busy_timeout under load,
+    # BEGIN is retried with full jitter so the stragglers do not retry in step.
+    database = DatabaseSingleton()
+    with database.writer(), contextlib.ExitStack() as stack:
+        started = time.perf_counter()
+        for attempt in range(WRITE_RETRIES + 1):
+            try:
+                stack.enter_context(database.atomic(lock_type="IMMEDIATE"))
+                break
+            except OperationalError as e:
+                if attempt == WRITE_RETRIES or not is_busy(e):
+                    raise
+                time.sleep(random.uniform(0, min(WRITE_RETRY_CAP, WRITE_RETRY_BASE * 2 ** attempt)))
+        # busy_timeout waits inside BEGIN when another process holds the lock
+        metrics.observe_lock_wait("begin", time.perf_counter() - started)
+        yield
+
+
+@contextlib.contextmanager
+def shard_writing(shard: int | None):
+    with use_shard(shard), writing():
+        yield
+
+
+def each_file() -> list[int | None]:
+    # The main file, then every shard
+    return [None, *DatabaseSingleton().shard_ids()]
+
+
+class ShardWriters:
+    # One WriteQueue per shard, a batch commits on a single file
+    def __init__(self):
+        self._queues: dict[int | None, WriteQueue] = {}
+        self._lock = threading.Lock()
+        self.running = False
+
+    def queue(self, shard: int | None) -> WriteQueue:
+        with self._lock:
+            if shard not in self._queues:
+                self._queues[shard] = WriteQueue(
+                    lambda: shard_writing(shard),
+                    lambda: DatabaseSingleton().atomic(),
+                    WRITE_QUEUE_SIZE,
+                    WRITE_BATCH_SIZE,
+                    WRITE_QUEUE_TIMEOUT
+                )
+                if self.running:
+                    self._queues[shard].start()
+            return self._queues[shard]
+
+    def on_writer_thread(self) -> bool:
+        return any(queue.on_writer_thread() for queue in list(self._queues.values()))
+
+    @property
+    def batches(self) -> int:
+        return sum(queue.batches for queue in list(self._queues.values()))
+
+    @property
+    def committed(self) -> int:
+        return sum(queue.committed for queue in list(self._queues.values()))
+
+    def pending(self) -> int:
+        return sum(queue.pending() for queue in list(self._queues.values()))
+
+    def submit(self, fn):
+        return self.queue(current_shard.get()).submit(fn)
+
+    def start(self):
+        with self._lock:
+            self.running = True
+            for queue in self._queues.values():
+                queue.start()
+
+    def stop(self):
+        with self._lock:
+            self.running = False
+            queues = list(self._queues.values())
+        for queue in queues:
+            queue.stop()
+
+
+write_queue = ShardWriters()
+
+
+def read_transaction(func):
+    # Runs the whole handler in one deferred transaction on a pooled read-only
+    # connection so every read sees the same snapshot.
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        database = DatabaseSingleton()
+        with database.reader(), database.atomic():
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def write_transaction(func):
+    # Group committed by the writer thread once it runs, nested calls and
+    # scripts without it write inline
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if write_queue.running and not write_queue.on_writer_thread():
+            # The writer thread runs it in the caller's context, shard included
+            return write_queue.submit(functools.partial(contextvars.copy_context().run, func, *args, **kwargs))
+        with writing():
+            return func(*args, **kwargs)
+    return wrapper
@@ -1,5 +1,13 @@
-from typing import Optional
-from pydantic import BaseModel
+from datetime import datetime
+from typing import Annotated, Any, Literal, Optional, Union
+from pydantic import BaseModel, Field
+
+MAX_BULK_OPERATIONS = 1000
+MAX_POSITION = 2 ** 31 - 1  # seconds, keeps positions far inside SQLite's integers
+MAX_TMDB_ID = 2 ** 31 - 1
+
+Position = Annotated[int, Field(ge=0, le=MAX_POSITION)]
+TmdbId = Annotated[int, Field(ge=0, le=MAX_TMDB_ID)]
 
 
 class CreateProfileForm(BaseModel):
@@ -19,9 +27,100 @@ class UpdateProfileForm(BaseModel):
 
 class UpdateWatchlistForm(BaseModel):
     profile_id: int
-    tmdb_id: int
+    tmdb_id: TmdbId
 
 
 class UpdateWatchHistoryForm(BaseModel):
-    tmdb_id: int
-    current_time: int
+    tmdb_id: TmdbId
+    current_time: Position
+    duration: Optional[Position] = None
+
+
+class UpdatePreferencesForm(BaseModel):
+    preferences: dict[str, Any]
+
+
+class PreferencePathForm(BaseModel):
+    op: Literal["set", "insert", "append", "remove"] = "set"
+    value: Any = None
+
+
+class WatchlistOperation(BaseModel):
+    op: Literal["add", "remove"]
+    tmdb_id: TmdbId
+
+
+class BulkWatchlistForm(BaseModel):
+    profile_id: int
+    operations: list[WatchlistOperation] = Field(max_length=MAX_BULK_OPERATIONS)
+
+
+class WatchHistoryOperation(BaseModel):
+    op: Literal["progress", "remove"]
+    tmdb_id: TmdbId
+    current_time: Optional[Position] = 0
+    duration: Optional[Position] = None
+
+
+class BulkWatchHistoryForm(BaseModel):
+    profile_id: int
+    operations: list[WatchHistoryOperation] = Field(max_length=MAX_BULK_OPERATIONS)
+
+
+class CreateNotificationForm(BaseModel):
+    payload: dict[str, Any]
+
+
+class ReadNotificationsForm(BaseModel):
+    ids: list[int] = Field(max_length=MAX_BULK_OPERATIONS)
+
+
+# Lines of an account export, `profile` is the profile id in the exporting account
+
+
+class AccountRecord(BaseModel):
+    type: Literal["account"]
+    version: int
+
+
+class ProfileRecord(BaseModel):
+    type: Literal["profile"]
+    id: int
+    name: str
+    avatar_url: Optional[str] = ""
+
+
+class PreferencesRecord(BaseModel):
+    type: Literal["preferences"]
+    profile: int
+    data: dict[str, Any]
+
+
+class WatchlistRecord(BaseModel):
+    type: Literal["watchlist"]
+    profile: int
+    id: TmdbId
+    added_at: Optional[datetime] = None
+
+
+class WatchhistoryRecord(BaseModel):
+    type: Literal["watchhistory"]
+    profile: int
+    id: TmdbId
+    current_time: Position = 0
+    duration: Optional[Position] = None
+    updated_at: Optional[datetime] = None
+
+
+class NotificationRecord(BaseModel):
+    type: Literal["notification"]
+    profile: int
+    payload: dict[str, Any]
+    created_at: Optional[datetime] = None
+    read: bool = False
+
+
+ImportRecord = Annotated[
+    Union[AccountRecord, ProfileRecord, PreferencesRecord, WatchlistRecord, WatchhistoryRecord, NotificationRecord],
+    Field(discriminator="type")
+]
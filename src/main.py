@@ -1,15 +1,97 @@
-from fastapi import FastAPI
-from src.models import create_tables
-from src.routes import access_router, manageprofiles_router, watchlist_router, watchhistory_router
+import os
+from contextlib import asynccontextmanager
+
+from anyio import to_thread
+from fastapi import FastAPI, Request, status
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse, ORJSONResponse
+from src.cache import route_cache, token_cache
+from src.conditional import EncodingETagMiddleware
+from src.database import DB_THREADS, serving, write_queue
+from src.maintenance import scheduler
+from src.migration import apply_migrations
+from src.metrics import MetricsMiddleware, metrics
+from src.writequeue import WriterSaturatedError
+from src.models import compact_changelog, create_tables, progress_buffer
+from src.routes import (
+    access_router,
+    manageprofiles_router,
+    watchlist_router,
+    watchhistory_router,
+    notification_router,
+    preferences_router,
+    tmdb_router,
+    sync_router,
+    metrics_router,
+    account_router
+)
+from src.tmdb import tmdb_client
+
+GZIP_MINIMUM_SIZE = int(os.getenv("GZIP_MINIMUM_SIZE", 1024))  # bytes, smaller bodies go out as is
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", 5))  # most of level 9's ratio at a fraction of the CPU
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Sync routes run in this threadpool, each thread keeps its own connection
+    to_thread.current_default_thread_limiter().total_tokens = DB_THREADS
+    with serving():
+        create_tables()
+        apply_migrations()
+        compact_changelog()
+        write_queue.start()
+        progress_buffer.start()
+        scheduler.start()
+        yield
+        scheduler.stop()
+        progress_buffer.stop()
+        write_queue.stop()
+        await tmdb_client.aclose()
+
+
+# Dict responses still pass through jsonable_encoder, the list endpoints
+# return pre-encoded bodies (src.responses)
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+# Only when the client sends Accept-Encoding: gzip
+app.add_middleware(GZipMiddleware, minimum_size=GZIP_MINIMUM_SIZE, compresslevel=GZIP_LEVEL)
+app.add_middleware(EncodingETagMiddleware)
+app.add_middleware(MetricsMiddleware)
+
+metrics.collect("token_cache_hits_total", "Bearer tokens resolved from the cache", "counter",
+                lambda: token_cache.hits)
+metrics.collect("token_cache_misses_total", "Bearer tokens verified against the database", "counter",
+                lambda: token_cache.misses)
+metrics.collect("route_cache_misses_total", "Account routes read from the main file", "counter",
+                lambda: route_cache.misses)
+metrics.collect("write_batches_total", "Group commits by the writer threads", "counter",
+                lambda: write_queue.batches)
+metrics.collect("write_mutations_total", "Mutations committed by the writer threads", "counter",
+                lambda: write_queue.committed)
+metrics.collect("write_queue_pending", "Mutations waiting for a writer thread", "gauge", write_queue.pending)
+metrics.collect("progress_buffer_pending", "Buffered watch progress entries", "gauge",
+                lambda: len(progress_buffer))
+
+
+@app.exception_handler(WriterSaturatedError)
+async def writer_saturated(request: Request, exc: WriterSaturatedError):
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "Too many pending writes, try again shortly"},
+        headers={"Retry-After": "1"},
+    )
 
-app = FastAPI()
 
 app.include_router(access_router)
 app.include_router(manageprofiles_router)
 app.include_router(watchlist_router)
 app.include_router(watchhistory_router)
+app.include_router(notification_router)
+app.include_router(preferences_router)
+app.include_router(tmdb_router)
+app.include_router(sync_router)
+app.include_router(metrics_router)
+app.include_router(account_router)
 
-create_tables()
 # config = read_config()
 # if not config:
 #     return
@@ -0,0 +1,142 @@
+import datetime
+import logging
+import os
+import threading
+import time
+from typing import Callable
+
+from src.database import DatabaseSingleton, each_file, use_shard, writing
+from src.metrics import metrics
+from src.migration import MIGRATION_INTERVAL, backfill
+from src.models import CHANGELOG_RETENTION, ChangeLogEntry, NotificationItem, TmdbCache, TokenSession
+
+logger = logging.getLogger(__name__)
+
+MAINTENANCE_BUDGET = float(os.getenv("MAINTENANCE_BUDGET", 0.25))  # seconds per task run
+MAINTENANCE_BATCH = int(os.getenv("MAINTENANCE_BATCH", 500))  # rows per delete statement
+MAINTENANCE_PAUSE = 0.01  # seconds between batches, lets queued writers take the lock
+MAINTENANCE_BACKOFF = 1  # seconds before a task that ran out of budget continues
+PRUNE_INTERVAL = int(os.getenv("PRUNE_INTERVAL", 600))  # seconds
+CHECKPOINT_INTERVAL = int(os.getenv("CHECKPOINT_INTERVAL", 60))  # seconds
+WAL_CHECKPOINT_SIZE = int(os.getenv("WAL_CHECKPOINT_SIZE", 64 * 1024 * 1024))  # bytes
+OPTIMIZE_INTERVAL = int(os.getenv("OPTIMIZE_INTERVAL", 6 * 3600))  # seconds
+COMPACT_ACCOUNTS = 50  # accounts per change log compaction step
+ANALYSIS_LIMIT = 1000  # rows sampled per index by ANALYZE
+
+
+class MaintenanceTask:
+    # `step` does one bounded unit of work and returns (rows, more). The
+    # scheduler repeats it while there is more and the budget lasts.
+    def __init__(self, name: str, step: Callable[[], tuple[int, bool]], interval: float,
+                 budget: float = MAINTENANCE_BUDGET):
+        self.name = name
+        self.step = step
+        self.interval = interval
+        self.budget = budget
+        self.next_run = time.monotonic() + interval
+
+
+class MaintenanceScheduler:
+    # One background thread per worker. Tasks only ever hold the write lock
+    # for a single batch, traffic queued behind it goes first between batches.
+    def __init__(self, tasks: list[MaintenanceTask], pause: float = MAINTENANCE_PAUSE,
+                 backoff: float = MAINTENANCE_BACKOFF):
+        self.tasks = tasks
+        self.pause = pause
+        self.backoff = backoff
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def run_task(self, task: MaintenanceTask) -> int:
+        started = time.perf_counter()
+        rows, more = 0, True
+        while more and not self._stop.is_set():
+            done, more = task.step()
+            rows += done
+            if time.perf_counter() - started >= task.budget:
+                break
+            if more:
+                time.sleep(self.pause)
+        elapsed = time.perf_counter() - started
+        metrics.maintenance.observe(elapsed, task.name)
+        # Work left when the budget ran out continues shortly, not an interval later
+        task.next_run = time.monotonic() + (self.backoff if more else task.interval)
+        logger.info("Maintenance %s: %d rows in %.1fms%s", task.name, rows, elapsed * 1000,
+                    ", more pending" if more else "")
+        return rows
+
+    def run_pending(self):
+        for task in self.tasks:
+            if task.next_run <= time.monotonic() and not self._stop.is_set():
+                try:
+                    self.run_task(task)
+                except Exception:
+                    task.next_run = time.monotonic() + task.interval
+                    logger.exception("Maintenance %s failed", task.name)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.run_pending()
+            self._stop.wait(max(0.0, min(task.next_run for task in self.tasks) - time.monotonic()))
+
+    def start(self):
+        if self._thread is None and self.tasks:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="maintenance", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+
+def prune(model, main_only=False) -> Callable[[], tuple[int, bool]]:
+    def step() -> tuple[int, bool]:
+        rows, more = 0, False
+        for shard in [None] if main_only else each_file():
+            with use_shard(shard), writing():
+                deleted = model.prune(datetime.datetime.now(), MAINTENANCE_BATCH)
+            rows += deleted
+            more = more or deleted == MAINTENANCE_BATCH
+        return rows, more
+    return step
+
+
+def compact_changes() -> tuple[int, bool]:
+    before = datetime.datetime.now() - datetime.timedelta(days=CHANGELOG_RETENTION)
+    rows = 0
+    for shard in each_file():
+        with use_shard(shard), DatabaseSingleton().writer():
+            rows += ChangeLogEntry.compact(before, accounts=COMPACT_ACCOUNTS)
+    return rows, rows > 0
+
+
+def checkpoint() -> tuple[int, bool]:
+    database = DatabaseSingleton()
+    pages = 0
+    for shard in each_file():
+        with use_shard(shard):
+            if database.wal_size() >= WAL_CHECKPOINT_SIZE:
+                pages += database.checkpoint(MAINTENANCE_BUDGET)[2]
+    return pages, False
+
+
+def optimize() -> tuple[int, bool]:
+    database = DatabaseSingleton()
+    for shard in each_file():
+        with use_shard(shard):
+            database.optimize(ANALYSIS_LIMIT)
+    return 0, False
+
+
+scheduler = MaintenanceScheduler([
+    MaintenanceTask("prune_sessions", prune(TokenSession), PRUNE_INTERVAL),
+    MaintenanceTask("prune_notifications", prune(NotificationItem), PRUNE_INTERVAL),
+    MaintenanceTask("prune_tmdb_cache", prune(TmdbCache, main_only=True), PRUNE_INTERVAL),
+    MaintenanceTask("compact_changelog", compact_changes, PRUNE_INTERVAL),
+    MaintenanceTask("wal_checkpoint", checkpoint, CHECKPOINT_INTERVAL),
+    MaintenanceTask("optimize", optimize, OPTIMIZE_INTERVAL),
+    MaintenanceTask("legacy_backfill", backfill, MIGRATION_INTERVAL),
+])
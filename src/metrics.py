@@ -0,0 +1,179 @@
+import bisect
+import logging
+import os
+import threading
+import time
+from contextvars import ContextVar
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", 0))  # 0 turns the slow request log off
+SLOW_REQUEST_QUERIES = 200  # statements kept per request for the slow log
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    labels = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Histogram:
+    # Cumulative only when rendered, observe() is one bisect and one lock
+    def __init__(self, name: str, description: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self._series: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                # One count per bucket plus +Inf, then sum
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def count(self, *labels) -> int:
+        with self._lock:
+            series = self._series.get(labels)
+            return sum(series[:-1]) if series else 0
+
+    def render(self) -> list[str]:
+        with self._lock:
+            snapshot = {labels: list(series) for labels, series in self._series.items()}
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        for labels, series in sorted(snapshot.items()):
+            total = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                total += count
+                bucket = format_labels(self.labels, labels, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{bucket} {total}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, labels)} {series[-1]}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, labels)} {total}")
+        return lines
+
+
+class RequestStats:
+    __slots__ = ("queries", "query_time", "argon2_calls", "argon2_time", "lock_wait", "statements")
+
+    def __init__(self, record: bool = False):
+        self.queries = 0
+        self.query_time = 0.0
+        self.argon2_calls = 0
+        self.argon2_time = 0.0
+        self.lock_wait = 0.0
+        self.statements: list[tuple[float, str]] | None = [] if record else None
+
+
+# Stats of the request being served. Threadpool and writer thread jobs run in
+# a copy of the request's context, so they add to the same object.
+current_request: ContextVar[RequestStats | None] = ContextVar("current_request", default=None)
+
+
+class Metrics:
+    def __init__(self, slow_request_ms: float = 0):
+        self.slow_request_ms = slow_request_ms
+        self.requests = Histogram("http_request_duration_seconds", "Request latency by route",
+                                  ("method", "route", "status"))
+        self.request_queries = Histogram("http_request_queries", "SQL statements per request",
+                                         ("route",), COUNT_BUCKETS)
+        self.request_query_time = Histogram("http_request_query_seconds", "Time in SQL per request", ("route",))
+        self.queries = Histogram("db_query_duration_seconds", "SQL statement execution time")
+        self.lock_wait = Histogram("db_lock_wait_seconds", "Time waiting for the write lock", ("lock",))
+        self.argon2 = Histogram("argon2_duration_seconds", "Argon2 calls, queueing included")
+        self.maintenance = Histogram("maintenance_duration_seconds", "Maintenance task runs", ("task",))
+        self._histograms = [self.requests, self.request_queries, self.request_query_time,
+                            self.queries, self.lock_wait, self.argon2, self.maintenance]
+        self._collectors: list[tuple[str, str, str, Callable[[], float]]] = []
+
+    def collect(self, name: str, description: str, kind: str, value: Callable[[], float]):
+        # Values owned elsewhere (cache hits, queue depth), read on scrape
+        self._collectors.append((name, description, kind, value))
+
+    def observe_query(self, sql: str, elapsed: float):
+        self.queries.observe(elapsed)
+        stats = current_request.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.query_time += elapsed
+            if stats.statements is not None and len(stats.statements) < SLOW_REQUEST_QUERIES:
+                stats.statements.append((elapsed, sql))
+
+    def observe_lock_wait(self, lock: str, elapsed: float):
+        self.lock_wait.observe(elapsed, lock)
+        stats = current_request.get()
+        if stats is not None:
+            stats.lock_wait += elapsed
+
+    def observe_argon2(self, elapsed: float):
+        self.argon2.observe(elapsed)
+        stats = current_request.get()
+        if stats is not None:
+            stats.argon2_calls += 1
+            stats.argon2_time += elapsed
+
+    def observe_request(self, method: str, route: str, status: int, elapsed: float, stats: RequestStats):
+        self.requests.observe(elapsed, method, route, str(status))
+        self.request_queries.observe(stats.queries, route)
+        self.request_query_time.observe(stats.query_time, route)
+        if self.slow_request_ms and elapsed * 1000 >= self.slow_request_ms:
+            logger.warning(
+                "Slow request %s %s %d in %.1fms: %d queries in %.1fms, argon2 %d in %.1fms, lock wait %.1fms%s",
+                method, route, status, elapsed * 1000, stats.queries, stats.query_time * 1000,
+                stats.argon2_calls, stats.argon2_time * 1000, stats.lock_wait * 1000,
+                "".join(f"\n  {duration * 1000:.2f}ms {sql}" for duration, sql in stats.statements or ())
+            )
+
+    def render(self) -> str:
+        lines = []
+        for histogram in self._histograms:
+            lines += histogram.render()
+        for name, description, kind, value in self._collectors:
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} {kind}", f"{name} {value()}"]
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics(SLOW_REQUEST_MS)
+
+
+class MetricsMiddleware:
+    # Plain ASGI so it adds no task or body buffering to the request
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        stats = RequestStats(record=bool(metrics.slow_request_ms))
+        token = current_request.set(stats)
+        status = 500
+
+        async def send_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            current_request.reset(token)
+            # The route template keeps the label set bounded, unmatched paths share one
+            route = scope.get("route")
+            metrics.observe_request(scope["method"], getattr(route, "path", "unmatched"), status, elapsed, stats)
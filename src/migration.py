@@ -0,0 +1,130 @@
+import datetime
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Callable
+
+from peewee import fn
+from peewee_migrate import Router
+
+from src.database import DatabaseSingleton, each_file, use_shard, writing
+from src.models import MigrationCheckpoint, UserAccount, Watchhistory, Watchlist, create_tables
+
+logger = logging.getLogger(__name__)
+
+# Online migration of the legacy JSON columns:
+#   python -m src.migration
+# applies the migrations in src/migrations and drains the backfills they
+# schedule. A running app does the same, the migrations on startup and the
+# backfills as a maintenance task, so neither needs downtime.
+
+MIGRATE_DIR = Path(__file__).parent / "migrations"
+MIGRATION_BATCH = int(os.getenv("MIGRATION_BATCH", 200))  # entries, and rows scanned, per write transaction
+MIGRATION_INTERVAL = int(os.getenv("MIGRATION_INTERVAL", 60))  # seconds between checks for new backfills
+MIGRATION_PAUSE = float(os.getenv("MIGRATION_PAUSE", 0.05))  # seconds between batches when run from the shell
+
+
+class Backfill:
+    # `size` counts the legacy entries of a row, `move(row_id, limit)` handles
+    # up to `limit` of them and reports how many and whether the row is done.
+    # A batch scans at most `batch` rows and handles about `batch` entries, a
+    # row larger than that is split across batches. A batch and its
+    # checkpoint commit together, an interrupted backfill resumes after the
+    # last committed batch. Reads and writes handle rows on either side of
+    # the checkpoint meanwhile.
+    def __init__(self, name: str, model, size, move: Callable[[int, int], tuple[int, bool]]):
+        self.name = name
+        self.model = model
+        self.size = size
+        self.move = move
+
+    def checkpoint(self) -> MigrationCheckpoint | None:
+        return MigrationCheckpoint.get_or_none(MigrationCheckpoint.name == self.name)
+
+    def step(self, batch: int) -> tuple[int, bool]:
+        # Unscheduled and finished backfills cost a read, not the write lock
+        with DatabaseSingleton().reader():
+            checkpoint = self.checkpoint()
+        if checkpoint is None or checkpoint.done:
+            return 0, False
+        with writing():
+            checkpoint = self.checkpoint()
+            rows = list(self.model
+                        .select(self.model.id, self.size)
+                        .where(self.model.id > checkpoint.last_id)
+                        .order_by(self.model.id)
+                        .limit(batch)
+                        .tuples())
+            moved, scanned = 0, 0
+            for row_id, size in rows:
+                if moved >= batch:
+                    break
+                if size:
+                    count, finished = self.move(row_id, batch - moved)
+                    moved += count
+                    if not finished:
+                        # Resumes inside this row
+                        break
+                checkpoint.last_id = row_id
+                scanned += 1
+            # Rows created after the checkpoint passed them never had a legacy value
+            checkpoint.done = scanned == len(rows) < batch
+            checkpoint.updated_at = datetime.datetime.now()
+            checkpoint.save()
+        logger.debug("Backfill %s: %d entries moved, checkpoint %d", self.name, moved, checkpoint.last_id)
+        return moved, not checkpoint.done
+
+
+BACKFILLS = [
+    Backfill("tokens", UserAccount, fn.json_array_length(UserAccount.tokens, "$.tokens"), UserAccount.migrate_row),
+    Backfill("watchlist", Watchlist, fn.json_array_length(Watchlist.legacy_watchlist, "$.watchlist"),
+             Watchlist.migrate_row),
+    Backfill("watchhistory", Watchhistory, fn.json_array_length(Watchhistory.legacy_watchhistory, "$.watchhistory"),
+             Watchhistory.migrate_row),
+]
+
+
+def apply_migrations() -> list[str]:
+    # Each file keeps its own migration history
+    database = DatabaseSingleton()
+    applied = []
+    for shard in each_file():
+        with use_shard(shard), database.writer():
+            # A table rebuild must not cascade to the children. SQLite ignores
+            # this inside a transaction, so it is set around the run and the
+            # migrations check the foreign keys before committing.
+            database.execute_sql("PRAGMA foreign_keys = OFF")
+            try:
+                applied += Router(database, migrate_dir=MIGRATE_DIR, logger=logger).run()
+            finally:
+                database.execute_sql("PRAGMA foreign_keys = ON")
+    return applied
+
+
+def backfill() -> tuple[int, bool]:
+    # One batch of every unfinished backfill in every file
+    entries, more = 0, False
+    for shard in each_file():
+        with use_shard(shard):
+            for backfill in BACKFILLS:
+                moved, pending = backfill.step(MIGRATION_BATCH)
+                entries += moved
+                more = more or pending
+    return entries, more
+
+
+def run(pause: float = MIGRATION_PAUSE) -> int:
+    create_tables()
+    apply_migrations()
+    entries, more = 0, True
+    while more:
+        moved, more = backfill()
+        entries += moved
+        time.sleep(pause if more else 0)
+    return entries
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    print(f"Migrated {run()} entries")
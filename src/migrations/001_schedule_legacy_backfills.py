@@ -0,0 +1,22 @@
+"""Peewee migrations -- 001_schedule_legacy_backfills.py.
+
+Moving the rows out of the legacy JSON columns is left to the backfills in
+src/migration.py, a migration runs in a single transaction. This only
+schedules them, every file starts from the first row.
+"""
+
+import peewee as pw
+from peewee_migrate import Migrator
+
+BACKFILLS = ("tokens", "watchlist", "watchhistory")
+
+
+def migrate(migrator: Migrator, database: pw.Database, *, fake=False):
+    for name in BACKFILLS:
+        migrator.sql("INSERT OR IGNORE INTO migrationcheckpoint (name, last_id, done, updated_at) "
+                     "VALUES (?, 0, 0, CURRENT_TIMESTAMP)", [name])
+
+
+def rollback(migrator: Migrator, database: pw.Database, *, fake=False):
+    for name in BACKFILLS:
+        migrator.sql("DELETE FROM migrationcheckpoint WHERE name = ?", [name])
@@ -0,0 +1,47 @@
+"""Peewee migrations -- 002_add_version_columns.py.
+
+Adds the columns of the conditional requests and the sync feed to tables
+that predate them. Files created since already have them from
+create_tables, existing columns are skipped.
+"""
+
+import peewee as pw
+from peewee_migrate import Migrator
+
+VERSION = [("version", "INTEGER NOT NULL DEFAULT 0"), ("etag_salt", "VARCHAR(255) NOT NULL DEFAULT ''")]
+COLUMNS = {
+    "useraccount": [("profiles_version", "INTEGER NOT NULL DEFAULT 0"),
+                    ("changelog_floor", "INTEGER NOT NULL DEFAULT 0")],
+    "profile": VERSION,
+    "preferences": VERSION,
+    "watchlist": VERSION,
+    "watchhistory": VERSION,
+}
+
+
+def add_columns(database: pw.Database):
+    for table, columns in COLUMNS.items():
+        existing = {column.name for column in database.get_columns(table)}
+        for name, definition in columns:
+            if name in existing:
+                continue
+            database.execute_sql(f'ALTER TABLE "{table}" ADD COLUMN "{name}" {definition}')
+            if name == "etag_salt":
+                # A salt per row, like the rows created since
+                database.execute_sql(f'UPDATE "{table}" SET "etag_salt" = lower(hex(randomblob(4)))')
+
+
+def drop_columns(database: pw.Database):
+    for table, columns in COLUMNS.items():
+        existing = {column.name for column in database.get_columns(table)}
+        for name, _ in columns:
+            if name in existing:
+                database.execute_sql(f'ALTER TABLE "{table}" DROP COLUMN "{name}"')
+
+
+def migrate(migrator: Migrator, database: pw.Database, *, fake=False):
+    migrator.run(add_columns, database)
+
+
+def rollback(migrator: Migrator, database: pw.Database, *, fake=False):
+    migrator.run(drop_columns, database)
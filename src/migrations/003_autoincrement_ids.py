@@ -0,0 +1,77 @@
+"""Peewee migrations -- 003_autoincrement_ids.py.
+
+Rebuilds the profile and changelogentry tables with AUTOINCREMENT ids, a
+deleted profile's id and a compacted sync seq are never handed out again.
+SQLite only takes AUTOINCREMENT in CREATE TABLE, so the rows are copied
+into a new table. Dropping the old one must not cascade to the children,
+foreign keys are off while migrations run (src.migration.apply_migrations)
+and checked before the migration commits.
+"""
+
+import peewee as pw
+from peewee_migrate import Migrator
+
+# Table, indexes and the largest id still referenced elsewhere, the
+# sequence starts past it
+TABLES = {
+    "profile": (
+        'CREATE TABLE "profile" ("id" INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, "version" INTEGER NOT NULL, '
+        '"etag_salt" VARCHAR(255) NOT NULL, "parent_id" INTEGER NOT NULL, "name" VARCHAR(255) NOT NULL, '
+        '"avatar_url" VARCHAR(255), FOREIGN KEY ("parent_id") REFERENCES "useraccount" ("id"))',
+        ['CREATE INDEX "profile_parent_id" ON "profile" ("parent_id")',
+         'CREATE UNIQUE INDEX "profile_parent_id_name" ON "profile" ("parent_id", "name")'],
+        'SELECT MAX("profile_id") FROM "changelogentry"',
+    ),
+    "changelogentry": (
+        'CREATE TABLE "changelogentry" ("id" INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, "user_id" INTEGER NOT NULL, '
+        '"profile_id" INTEGER NOT NULL, "resource" VARCHAR(255) NOT NULL, "op" VARCHAR(255) NOT NULL, '
+        '"tmdb_id" INTEGER, "data" JSON, "created_at" DATETIME NOT NULL, '
+        'FOREIGN KEY ("user_id") REFERENCES "useraccount" ("id") ON DELETE CASCADE)',
+        ['CREATE INDEX "changelogentry_user_id_id" ON "changelogentry" ("user_id", "id")'],
+        'SELECT MAX("changelog_floor") FROM "useraccount"',
+    ),
+}
+
+
+def rebuild(database: pw.Database, table: str):
+    create, indexes, floor = TABLES[table]
+    sql = database.execute_sql("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()[0]
+    if "AUTOINCREMENT" in sql.upper():
+        return
+    floor = database.execute_sql(floor).fetchone()[0] or 0
+    old = f"{table}__old"
+    # Keeps the references of the children pointing at the table name
+    database.execute_sql("PRAGMA legacy_alter_table = ON")
+    try:
+        database.execute_sql(f'ALTER TABLE "{table}" RENAME TO "{old}"')
+        for index in database.get_indexes(old):
+            database.execute_sql(f'DROP INDEX "{index.name}"')
+        database.execute_sql(create)
+        for index in indexes:
+            database.execute_sql(index)
+        existing = {column.name for column in database.get_columns(old)}
+        columns = ", ".join(f'"{column.name}"' for column in database.get_columns(table) if column.name in existing)
+        database.execute_sql(f'INSERT INTO "{table}" ({columns}) SELECT {columns} FROM "{old}"')
+        database.execute_sql(f'DROP TABLE "{old}"')
+        database.execute_sql("DELETE FROM sqlite_sequence WHERE name = ?", (table,))
+        database.execute_sql(
+            f'INSERT INTO sqlite_sequence (name, seq) SELECT ?, MAX(?, IFNULL(MAX("id"), 0)) FROM "{table}"',
+            (table, floor))
+    finally:
+        database.execute_sql("PRAGMA legacy_alter_table = OFF")
+
+
+def check_foreign_keys(database: pw.Database):
+    if database.execute_sql("PRAGMA foreign_key_check").fetchone() is not None:
+        raise pw.IntegrityError("Rebuilding a table broke a foreign key")
+
+
+def migrate(migrator: Migrator, database: pw.Database, *, fake=False):
+    for table in TABLES:
+        migrator.run(rebuild, database, table)
+    migrator.run(check_foreign_keys, database)
+
+
+def rollback(migrator: Migrator, database: pw.Database, *, fake=False):
+    # AUTOINCREMENT only stops ids from being reused, the tables stay as they are
+    pass
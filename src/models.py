@@ -1,41 +1,141 @@
 import datetime
+import os
+import secrets
 
 import pydantic
 
-from peewee import CharField, BooleanField, ForeignKeyField, Model
-from playhouse.sqlite_ext import JSONField
+import json
 
-from argon2.exceptions import VerifyMismatchError
+from peewee import (
+    CharField,
+    BooleanField,
+    DateTimeField,
+    EXCLUDED,
+    ForeignKeyField,
+    IntegerField,
+    JOIN,
+    Model,
+    OperationalError,
+    SQL,
+    Select,
+    chunked,
+    fn
+)
+from playhouse.sqlite_ext import AutoIncrementField, JSONField
 
-from src.security import hash_password, verify_password
-from src.database import DatabaseSingleton
-from src.serializers import serialize_datetime
+from src.security import token_digest
+from src.cache import route_cache, token_cache
+from src.writebehind import PartitionedProgressBuffer, ProgressBuffer, PROGRESS_FLUSH_INTERVAL, PROGRESS_FLUSH_SIZE
+from src.database import DatabaseSingleton, current_shard, shard_for, shard_writing, use_shard, writing
 
 db = DatabaseSingleton()
 
+CHANGELOG_RETENTION = int(os.getenv("CHANGELOG_RETENTION", 30))  # days
+NOTIFICATION_RETENTION = int(os.getenv("NOTIFICATION_RETENTION", 30))  # days after being read
+NOTIFICATION_UNREAD_RETENTION = int(os.getenv("NOTIFICATION_UNREAD_RETENTION", 180))  # days
+# The legacy arrays kept no timestamps, their entries sort before anything written since
+LEGACY_TIMESTAMP = datetime.datetime(1970, 1, 1)
+# Lifetime of the tokens whose hashes are in the legacy tokens column
+LEGACY_TOKEN_LIFETIME = datetime.timedelta(minutes=525960)
+
+
+def legacy_token_expired(entry: list) -> bool:
+    # [argon2 hash, issued at]
+    try:
+        return datetime.datetime.fromisoformat(entry[1]) + LEGACY_TOKEN_LIFETIME < datetime.datetime.now()
+    except (IndexError, TypeError, ValueError):
+        return True
+
 
 class BaseModel(Model):
     class Meta:
         database = db
 
 
+class VersionedModel(BaseModel):
+    # Bumped by every mutation, GETs are tagged with it and compared against
+    # If-None-Match / If-Match without touching the payload. The salt differs
+    # per row, a tag held for a deleted row never matches its successor.
+    version = IntegerField(default=0, null=False)
+    etag_salt = CharField(default=lambda: secrets.token_hex(4), null=False)
+
+    @property
+    def etag(self) -> str:
+        return f'"{type(self).__name__.lower()}-{self.id}-{self.etag_salt}-{self.version}"'
+
+    def bump_version(self):
+        # Writers hold the IMMEDIATE lock, so the in-memory copy stays exact
+        type(self).update(version=type(self).version + 1).where(type(self).id == self.id).execute()
+        self.version += 1
+
+
+class AccountRoute(BaseModel):
+    # Lives in the main file and hands out the account ids, the account and
+    # everything below it live in `shard`. A null shard is the main file.
+    username = CharField(unique=True, null=False)
+    email = CharField(unique=True, null=False)
+    shard = IntegerField(null=True)
+
+    @classmethod
+    def shard_of(cls, username: str) -> int | None:
+        # Raises DoesNotExist for unknown accounts
+        database = cls._meta.database
+        if not database.shards:
+            return None
+        shard = route_cache.get(username, default=False)
+        if shard is False:
+            with use_shard(None), database.reader():
+                shard = cls.select(cls.shard).where(cls.username == username).tuples().get()[0]
+            route_cache.set(username, shard)
+        return shard
+
+
 class UserAccount(BaseModel):
     username = CharField(unique=True, null=False)
     email = CharField(unique=True, null=False)
     disabled = BooleanField(default=False, null=False)
     hashed_password = CharField(null=False)
 
+    # Legacy Argon2 token hashes, sessions now live in TokenSession
     tokens = JSONField(null=False, default={
         "tokens": []
     })
+    # Version of the profile list, bumped on create, update and delete
+    profiles_version = IntegerField(default=0, null=False)
+    # Highest change log seq compacted away, older sync cursors must resync
+    changelog_floor = IntegerField(default=0, null=False)
 
     def create_user(self, username, email, hashed_password, disabled=False):
-        UserAccount.create(
-            username=username,
-            email=email,
-            hashed_password=hashed_password,
-            disabled=disabled
-        )
+        database = UserAccount._meta.database
+        if not database.shards:
+            UserAccount.create(
+                username=username,
+                email=email,
+                hashed_password=hashed_password,
+                disabled=disabled
+            )
+            return
+        # The route claims the username and email and allocates the id first.
+        # Neither transaction is nested in the other, so the main file lock is
+        # never held while waiting on a shard; the route is dropped if the
+        # account cannot be created.
+        with use_shard(None), writing():
+            route = AccountRoute.create(username=username, email=email)
+            route.shard = shard_for(route.id, len(database.shards))
+            route.save(only=[AccountRoute.shard])
+        try:
+            with shard_writing(route.shard):
+                UserAccount.create(
+                    id=route.id,
+                    username=username,
+                    email=email,
+                    hashed_password=hashed_password,
+                    disabled=disabled
+                )
+        except Exception:
+            with use_shard(None), writing():
+                route.delete_instance()
+            raise
 
     def delete_user(self, email):
         self.delete()
@@ -45,144 +145,1072 @@ class UserAccount(BaseModel):
         self.email = email
         self.hashed_password = hashed_password
         self.disabled = disabled
-        self.save()
+        self.save(only=[UserAccount.username, UserAccount.email, UserAccount.hashed_password, UserAccount.disabled])
+        if self._meta.database.shards:
+            with use_shard(None), writing():
+                AccountRoute.update(username=username, email=email).where(AccountRoute.id == self.id).execute()
+            route_cache.clear()
+        self.invalidate_cached_tokens()
 
-    def register_token(self, token: str):
-        self.tokens.get("tokens").append([
-            hash_password(token),
-            serialize_datetime(datetime.datetime.now())
-        ])
-        self.save()
+    @classmethod
+    def bump_profiles_version(cls, user_id: int):
+        cls.update(profiles_version=cls.profiles_version + 1).where(cls.id == user_id).execute()
+
+    @classmethod
+    def profiles_etag(cls, user_id: int) -> str:
+        version = cls.select(cls.profiles_version).where(cls.id == user_id).scalar()
+        return f'"profiles-{user_id}-{version}"'
+
+    def invalidate_cached_tokens(self):
+        # After the commit, a miss in between would cache the old state again
+        self._meta.database.after_commit(lambda: token_cache.invalidate(lambda snapshot: snapshot.id == self.id))
+
+    def register_token(self, token: str, expires_at: datetime.datetime | None = None):
+        TokenSession.create(user=self, digest=token_digest(token), expires_at=expires_at)
+
+    @classmethod
+    def get_by_token(cls, username: str, token: str) -> "UserAccount | None":
+        # User lookup and session check in one indexed join
+        return (cls
+                .select()
+                .join(TokenSession)
+                .where(
+                    cls.username == username,
+                    TokenSession.digest == token_digest(token),
+                    TokenSession.expires_at.is_null() | (TokenSession.expires_at > datetime.datetime.now())
+                )
+                .first())
 
     def check_token(self, token: str) -> bool:
-        for t, d in self.tokens.get("tokens"):
-            try:
-                if verify_password(t, token):
-                    return True
-            except VerifyMismatchError:
-                pass
-        return False
+        return TokenSession.select().where(
+            TokenSession.digest == token_digest(token),
+            TokenSession.user == self,
+            TokenSession.expires_at.is_null() | (TokenSession.expires_at > datetime.datetime.now())
+        ).exists()
 
     def revoke_token(self, token: str):
-        for i, [t, d] in enumerate(self.tokens.get("tokens")):
-            try:
-                if verify_password(t, token):
-                    self.tokens.get("tokens").pop(i)
-                    self.save()
-                    return
-            except VerifyMismatchError:
-                pass
+        digest = token_digest(token)
+        TokenSession.delete().where(
+            TokenSession.digest == digest,
+            TokenSession.user == self
+        ).execute()
+        self._meta.database.after_commit(lambda: token_cache.pop(digest))
 
     def revoke_all_tokens(self):
-        self.tokens = {"tokens": []}
-        self.save()
+        TokenSession.delete().where(TokenSession.user == self).execute()
+        type(self).update(tokens={"tokens": []}).where(type(self).id == self.id).execute()
+        self.invalidate_cached_tokens()
+
+    @classmethod
+    def legacy_token_hashes(cls, username: str) -> list[str]:
+        user = cls.select(cls.tokens).where(cls.username == username).first()
+        return [entry[0] for entry in user.tokens.get("tokens", [])] if user is not None else []
+
+    @classmethod
+    def adopt_legacy_token(cls, username: str, token: str, hashed: str,
+                           expires_at: datetime.datetime | None) -> "UserAccount | None":
+        # Moves a session verified against its legacy hash into TokenSession,
+        # later requests find it by digest
+        user = cls.get_or_none(cls.username == username)
+        if user is None:
+            return None
+        legacy = user.tokens.get("tokens", [])
+        if not any(entry[0] == hashed for entry in legacy):
+            # Adopted by a concurrent request or revoked meanwhile
+            return cls.get_by_token(username, token)
+        user.tokens = {"tokens": [entry for entry in legacy if entry[0] != hashed]}
+        user.save(only=[cls.tokens])
+        user.register_token(token, expires_at)
+        return user
+
+    @classmethod
+    def migrate_row(cls, row_id: int, limit: int) -> tuple[int, bool]:
+        # The legacy hashes cannot become digests, live ones stay for
+        # adopt_legacy_token and only the expired ones are dropped
+        user = cls.select(cls.id, cls.tokens).where(cls.id == row_id).get()
+        legacy = user.tokens.get("tokens", [])
+        live = [entry for entry in legacy if not legacy_token_expired(entry)]
+        if len(live) < len(legacy):
+            cls.update(tokens={"tokens": live}).where(cls.id == row_id).execute()
+        return len(legacy), True
+
+
+class TokenSession(BaseModel):
+    user = ForeignKeyField(UserAccount, backref="sessions", null=False, on_delete="CASCADE")
+    digest = CharField(unique=True, null=False)
+    created_at = DateTimeField(default=datetime.datetime.now, null=False)
+    expires_at = DateTimeField(null=True, index=True)
 
+    @classmethod
+    def prune(cls, now: datetime.datetime, limit: int) -> int:
+        return delete_batch(cls, cls.expires_at < now, limit)
+
+
+# Columns a client sees, version and etag_salt stay server-side
+PROFILE_FIELDS = ("id", "parent", "name", "avatar_url")
 
-class Profile(BaseModel):
+
+class Profile(VersionedModel):
+    # Never reused, buffered heartbeats and ETags of a deleted profile must
+    # not carry over to the next one
+    id = AutoIncrementField()
     parent = ForeignKeyField(UserAccount, backref="profiles", null=False)
     name = CharField()
     avatar_url = CharField(null=True)
 
     @classmethod
     def create(cls, **query):
-        inst = super().create(**query)
+        # One transaction so a profile never exists without its child rows
+        with cls._meta.database.atomic():
+            inst = super().create(**query)
 
-        Preferences.create(profile=inst, preferences={})
-        Watchlist.create(profile=inst, watchlist={})
-        Watchhistory.create(profile=inst, watchhistory={})
-        Notification.create(profile=inst, notifications={})
+            Preferences.insert(profile=inst, preferences={}).execute()
+            Watchlist.insert(profile=inst).execute()
+            Watchhistory.insert(profile=inst).execute()
+            Notification.insert(profile=inst).execute()
+            UserAccount.bump_profiles_version(inst.parent_id)
+            ChangeLogEntry.record(inst.parent_id, inst.id, "profile", "create", [inst.sync_data()])
         return inst
 
+    def delete_instance(self, *args, **kwargs):
+        with self._meta.database.atomic():
+            UserAccount.bump_profiles_version(self.parent_id)
+            ChangeLogEntry.record(self.parent_id, self.id, "profile", "delete")
+            progress_buffer.discard(self.id)
+            return super().delete_instance(*args, **kwargs)
+
+    def sync_data(self) -> dict:
+        return {"data": {"name": self.name, "avatar_url": self.avatar_url}}
+
+    def to_dict(self) -> dict:
+        return {field: self.__data__.get(field) for field in PROFILE_FIELDS}
+
+    @classmethod
+    def hydrate(cls, user, id) -> dict | None:
+        # Loads the profile and all of its state in a single statement, the
+        # item tables are folded into JSON arrays by correlated subqueries
+        items = (WatchlistItem
+                 .select(WatchlistItem.tmdb_id)
+                 .where(WatchlistItem.profile == cls.id)
+                 .order_by(WatchlistItem.id))
+        watchlist = Select([items.alias("w")], [fn.json_group_array(SQL('"w"."tmdb_id"'))])
+        progress = (WatchProgress
+                    .select(WatchProgress.tmdb_id, WatchProgress.current_time,
+                            WatchProgress.duration, WatchProgress.updated_at)
+                    .where(WatchProgress.profile == cls.id)
+                    .order_by(WatchProgress.updated_at, WatchProgress.id))
+        watchhistory = Select([progress.alias("h")], [fn.json_group_array(fn.json_object(
+            "id", SQL('"h"."tmdb_id"'),
+            "current_time", SQL('"h"."current_time"'),
+            "duration", SQL('"h"."duration"'),
+            "updated_at", SQL('"h"."updated_at"')
+        ))])
+        unread = (NotificationItem
+                  .select(NotificationItem.id, NotificationItem.payload, NotificationItem.created_at)
+                  .where(NotificationItem.profile == cls.id, NotificationItem.read_at.is_null())
+                  .order_by(NotificationItem.id))
+        notifications = Select([unread.alias("n")], [fn.json_group_array(fn.json_object(
+            "id", SQL('"n"."id"'),
+            "payload", fn.json(SQL('"n"."payload"')),
+            "created_at", SQL('"n"."created_at"'),
+            "read", SQL("json('false')")
+        ))])
+        # Entries left in the legacy arrays until the backfill moves them
+        legacy_watchlist = (Watchlist
+                            .select(fn.json_array_length(Watchlist.legacy_watchlist, "$.watchlist"))
+                            .where(Watchlist.profile == cls.id))
+        legacy_watchhistory = (Watchhistory
+                               .select(fn.json_array_length(Watchhistory.legacy_watchhistory, "$.watchhistory"))
+                               .where(Watchhistory.profile == cls.id))
+        row = (cls
+               .select(cls, Preferences.preferences, watchlist.alias("watchlist"),
+                       watchhistory.alias("watchhistory"), notifications.alias("notifications"),
+                       legacy_watchlist.alias("legacy_watchlist"), legacy_watchhistory.alias("legacy_watchhistory"))
+               .join(Preferences, JOIN.LEFT_OUTER, on=(Preferences.profile == cls.id))
+               .where(cls.parent == user, cls.id == id)
+               .dicts()
+               .first())
+        if row is None:
+            return None
+
+        # While legacy entries remain, read like the per-resource routes do
+        if row["legacy_watchlist"]:
+            items = Watchlist.get(Watchlist.profile == id).items()
+        else:
+            items = json.loads(row["watchlist"])
+        if row["legacy_watchhistory"]:
+            history = Watchhistory.get(Watchhistory.profile == id).watchhistory["watchhistory"]
+        else:
+            history = merge_pending([
+                (datetime.datetime.fromisoformat(entry.pop("updated_at")), entry)
+                for entry in json.loads(row["watchhistory"])
+            ], progress_buffer.pending(id))
+        return {
+            "profile": {field: row[field] for field in PROFILE_FIELDS},
+            "preferences": row["preferences"],
+            "watchlist": items,
+            "watchhistory": history,
+            "notifications": [
+                {**entry, "created_at": datetime.datetime.fromisoformat(entry["created_at"]).isoformat()}
+                for entry in json.loads(row["notifications"])
+            ],
+        }
+
     class Meta:
         indexes = (
             (('parent', 'name'), True),
         )
 
+    @classmethod
+    def page(cls, user, limit: int | None = None, after: int | None = None,
+             fields: set[str] | None = None) -> tuple[list[dict], int | None]:
+        columns = [cls.id] + [cls._meta.fields[field] for field in fields or () if field != "id"]
+        query = cls.select(*columns if fields else ()).where(cls.parent == user).order_by(cls.id)
+        if after is not None:
+            query = query.where(cls.id > after)
+        if limit is not None:
+            query = query.limit(limit + 1)
+        rows = list(query)
+        next_key = rows[limit - 1].id if limit is not None and len(rows) > limit else None
+        return [row.to_dict() for row in rows[:limit]], next_key
+
     def update_profile(self, name, avatar_url):
         self.name = name or self.name
         self.avatar_url = avatar_url or self.avatar_url
+        self.version += 1
         self.save()
+        UserAccount.bump_profiles_version(self.parent_id)
+        ChangeLogEntry.record(self.parent_id, self.id, "profile", "update", [self.sync_data()])
 
 
-class Preferences(BaseModel):
+class PreferencePathError(ValueError):
+    pass
+
+
+class Preferences(VersionedModel):
     profile = ForeignKeyField(Profile, backref='preferences')
     preferences = JSONField(default={}, null=False)
 
     def update_prefs(self, data):
-        self.preferences = data
-        self.save()
+        self._apply(data)
 
     def clear(self):
-        self.preferences = {}
-        self.save()
+        self._apply({})
+
+    def patch(self, data: dict):
+        # RFC 7396 merge patch, a null value deletes the key
+        self._apply(Preferences.preferences.update(data))
+
+    def resolve(self, segments: list[str]) -> list:
+        # A digit segment indexes an array and names a key of an object,
+        # whichever the stored node it applies to is. Missing nodes become
+        # objects when set, an index can point at most one past an array's end.
+        node, path = self.preferences, []
+        for segment in segments:
+            if isinstance(node, list):
+                if not segment.isdigit() or int(segment) > len(node):
+                    raise PreferencePathError(f"No index {segment} in the array at /{'/'.join(segments)}")
+                path.append(int(segment))
+                node = node[int(segment)] if int(segment) < len(node) else None
+            elif isinstance(node, dict) or node is None:
+                path.append(segment)
+                node = node.get(segment) if node is not None else None
+            else:
+                raise PreferencePathError(f"/{'/'.join(segments)} is below a value that is not an object or array")
+        return path
+
+    # The path operations return False and change nothing when there is
+    # nothing to do: an insert over an existing value, an append to a value
+    # that is not an array or a removal of a missing path
+    def set_path(self, path: list, value, overwrite=True) -> bool:
+        node = self._node(path)
+        if overwrite:
+            return self._apply(node.set(value))
+        return self._apply(node.insert(value), node.json_type().is_null())
+
+    def append(self, path: list, value) -> bool:
+        node = self._node(path)
+        return self._apply(node.append(value), node.json_type() == "array")
 
+    def remove_path(self, path: list) -> bool:
+        node = self._node(path)
+        return self._apply(node.remove(), node.json_type().is_null(False))
 
-class Watchlist(BaseModel):
+    def remove_value(self, path: list, value) -> bool:
+        # Rebuilds the array without `value` inside SQLite, json_each walks the
+        # stored document so it never round-trips through Python
+        node = self._node(path)
+        element = SQL("""CASE WHEN "e"."type" IN ('object', 'array') THEN json("e"."value") ELSE "e"."value" END""")
+        document = (Preferences
+                    .select(fn.json_set(Preferences.preferences, node.path, fn.json_group_array(element)))
+                    .from_(node.children().alias("e"))
+                    .where(SQL('"e"."atom" IS NOT ?', [value])))
+        return self._apply(document, node.json_type() == "array")
+
+    @staticmethod
+    def _node(path: list):
+        node = Preferences.preferences
+        for key in path:
+            node = node[key if isinstance(key, int) else f'"{key}"']
+        return node
+
+    def _apply(self, document, *conditions) -> bool:
+        # Single UPDATE, the new document comes back through RETURNING
+        row = (Preferences
+               .update(preferences=document, version=Preferences.version + 1)
+               .where(Preferences.id == self.id, *conditions)
+               .returning(Preferences.preferences, Preferences.version)
+               .execute())
+        row = next(iter(row), None)
+        if row is None:
+            return False
+        self.preferences, self.version = row.preferences, row.version
+        ChangeLogEntry.record(self.profile.parent_id, self.profile_id, "preferences", "update",
+                              [{"data": self.preferences}])
+        return True
+
+
+class Watchlist(VersionedModel):
     profile = ForeignKeyField(Profile, backref='watchlists')
-    watchlist = JSONField(default={"watchlist": []}, null=False)
+    # Legacy JSON array, entries now live in WatchlistItem
+    legacy_watchlist = JSONField(column_name="watchlist", default={"watchlist": []}, null=False)
+
+    @property
+    def watchlist(self) -> dict:
+        return {"watchlist": self.items()}
+
+    def items(self) -> list[int]:
+        items = list(WatchlistItem
+                     .select(WatchlistItem.tmdb_id)
+                     .where(WatchlistItem.profile == self.profile_id)
+                     .order_by(WatchlistItem.id)
+                     .scalars())
+        present = set(items)
+        return items + [tmdb_id for tmdb_id in self.legacy_items() if tmdb_id not in present]
+
+    def legacy_items(self) -> list[int]:
+        # Read alongside the rows until the backfill or a write moves them,
+        # in the order they get their rows
+        return list(dict.fromkeys((self.legacy_watchlist or {}).get("watchlist") or []))
+
+    def _unmigrated(self) -> list[tuple[int, int]]:
+        # (position, tmdb_id) of the legacy entries without a row yet
+        legacy = self.legacy_items()
+        present = set()
+        for batch in chunked(legacy, 500):
+            present.update(WatchlistItem
+                           .select(WatchlistItem.tmdb_id)
+                           .where(WatchlistItem.profile == self.profile_id, WatchlistItem.tmdb_id.in_(batch))
+                           .scalars())
+        return [(index, tmdb_id) for index, tmdb_id in enumerate(legacy) if tmdb_id not in present]
+
+    def migrate_legacy(self, limit: int | None = None) -> int:
+        # Entries already present keep their row, they were written after the
+        # array. `limit` moves only the first entries, the rest stay in the array.
+        legacy = self.legacy_items()
+        if not legacy:
+            return 0
+        moved, rest = legacy[:limit], legacy[len(legacy) if limit is None else limit:]
+        for batch in chunked(moved, 300):
+            (WatchlistItem
+             .insert_many([{"profile": self.profile_id, "tmdb_id": tmdb_id, "added_at": LEGACY_TIMESTAMP}
+                           for tmdb_id in batch])
+             .on_conflict_ignore()
+             .execute())
+        self.legacy_watchlist = {"watchlist": rest}
+        Watchlist.update(legacy_watchlist=self.legacy_watchlist).where(Watchlist.id == self.id).execute()
+        return len(moved)
+
+    def _reset_legacy(self) -> bool:
+        if not self.legacy_items():
+            return False
+        self.legacy_watchlist = {"watchlist": []}
+        Watchlist.update(legacy_watchlist=self.legacy_watchlist).where(Watchlist.id == self.id).execute()
+        return True
+
+    @classmethod
+    def migrate_row(cls, row_id: int, limit: int) -> tuple[int, bool]:
+        row = cls.get_by_id(row_id)
+        return row.migrate_legacy(limit), not row.legacy_items()
+
+    def items_json(self) -> str:
+        if self.legacy_items():
+            return json.dumps(self.items())
+        # Encoded by SQLite, sent without building a Python list
+        items = (WatchlistItem
+                 .select(WatchlistItem.tmdb_id)
+                 .where(WatchlistItem.profile == self.profile_id)
+                 .order_by(WatchlistItem.id))
+        return Select([items.alias("w")], [fn.json_group_array(SQL('"w"."tmdb_id"'))]).scalar(self._meta.database)
+
+    def page(self, limit: int | None = None, after: int | None = None) -> tuple[list[dict], int | None]:
+        entries = []
+        # Unmigrated legacy entries follow the rows keyed by their negated
+        # position, a cursor in that range skips the rows
+        if after is None or after > 0:
+            query = (WatchlistItem
+                     .select(WatchlistItem.id, WatchlistItem.tmdb_id, WatchlistItem.added_at)
+                     .where(WatchlistItem.profile == self.profile_id)
+                     .order_by(WatchlistItem.id))
+            if after is not None:
+                query = query.where(WatchlistItem.id > after)
+            if limit is not None:
+                query = query.limit(limit + 1)
+            entries = [(row.id, row.to_dict()) for row in query]
+        if (limit is None or len(entries) <= limit) and self.legacy_items():
+            skip = -after if after is not None and after < 0 else 0
+            entries += [(-(index + 1), {"id": tmdb_id, "added_at": LEGACY_TIMESTAMP.isoformat()})
+                        for index, tmdb_id in self._unmigrated() if index >= skip]
+        next_key = entries[limit - 1][0] if limit is not None and len(entries) > limit else None
+        return [entry for _, entry in entries[:limit]], next_key
+
+    def apply(self, operations) -> list[dict]:
+        # Replays the operations against the current membership in memory and
+        # writes only the final state of each title, one INSERT and one DELETE
+        self.migrate_legacy()
+        tmdb_ids = list(dict.fromkeys(operation.tmdb_id for operation in operations))
+        present = set(WatchlistItem
+                      .select(WatchlistItem.tmdb_id)
+                      .where(WatchlistItem.profile == self.profile_id, WatchlistItem.tmdb_id.in_(tmdb_ids))
+                      .scalars())
+        initial = set(present)
+        results = []
+        for operation in operations:
+            if operation.op == "add":
+                status = "unchanged" if operation.tmdb_id in present else "added"
+                present.add(operation.tmdb_id)
+            else:
+                status = "removed" if operation.tmdb_id in present else "missing"
+                present.discard(operation.tmdb_id)
+            results.append({"op": operation.op, "tmdb_id": operation.tmdb_id, "status": status})
+
+        added = [tmdb_id for tmdb_id in tmdb_ids if tmdb_id in present and tmdb_id not in initial]
+        removed = [tmdb_id for tmdb_id in tmdb_ids if tmdb_id in initial and tmdb_id not in present]
+        for batch in chunked(added, 300):
+            (WatchlistItem
+             .insert_many([{"profile": self.profile_id, "tmdb_id": tmdb_id} for tmdb_id in batch])
+             .on_conflict_ignore()
+             .execute())
+        for batch in chunked(removed, 500):
+            WatchlistItem.delete().where(
+                WatchlistItem.profile == self.profile_id,
+                WatchlistItem.tmdb_id.in_(batch)
+            ).execute()
+        if added or removed:
+            self.bump_version()
+            ChangeLogEntry.record(self.profile.parent_id, self.profile_id, "watchlist", "add",
+                                  [{"tmdb_id": tmdb_id} for tmdb_id in added])
+            ChangeLogEntry.record(self.profile.parent_id, self.profile_id, "watchlist", "remove",
+                                  [{"tmdb_id": tmdb_id} for tmdb_id in removed])
+        return results
+
+    def restore(self, entries: list[dict]):
+        # Exported entries keep when they were added, titles already on the
+        # list keep their row
+        self.migrate_legacy()
+        now = datetime.datetime.now()
+        added = []
+        for batch in chunked(entries, 300):
+            added += (WatchlistItem
+                      .insert_many([{"profile": self.profile_id, "tmdb_id": entry["id"],
+                                     "added_at": entry["added_at"] or now} for entry in batch])
+                      .on_conflict_ignore()
+                      .returning(WatchlistItem.tmdb_id)
+                      .tuples()
+                      .execute())
+        if added:
+            self.bump_version()
+            ChangeLogEntry.record(self.profile.parent_id, self.profile_id, "watchlist", "add",
+                                  [{"tmdb_id": tmdb_id} for tmdb_id, in added])
+
+    def contains(self, tmdb_id) -> bool:
+        return tmdb_id in self.legacy_items() or WatchlistItem.select().where(
+            WatchlistItem.profile == self.profile_id,
+            WatchlistItem.tmdb_id == tmdb_id
+        ).exists()
 
     def add(self, tmdb_id):
-        if self.watchlist.get("watchlist"):
-            self.watchlist.get("watchlist").append(tmdb_id)
-        else:
-            self.watchlist = {"watchlist": [tmdb_id]}
-        self.save()
+        self.migrate_legacy()
+        if (WatchlistItem
+                .insert(profile=self.profile_id, tmdb_id=tmdb_id)
+                .on_conflict_ignore()
+                .as_rowcount()
+                .execute()):
+            self.bump_version()
+            ChangeLogEntry.record(self.profile.parent_id, self.profile_id, "watchlist", "add", [{"tmdb_id": tmdb_id}])
 
     def remove(self, tmdb_id):
-        watchlist = self.watchlist.get("watchlist")
-        if watchlist:
-            filtered_watchlist = [id for id in watchlist if id != tmdb_id]
-            self.watchlist = {"watchlist": filtered_watchlist}
-            self.save()
+        self.migrate_legacy()
+        if WatchlistItem.delete().where(
+            WatchlistItem.profile == self.profile_id,
+            WatchlistItem.tmdb_id == tmdb_id
+        ).execute():
+            self.bump_version()
+            ChangeLogEntry.record(self.profile.parent_id, self.profile_id, "watchlist", "remove", [{"tmdb_id": tmdb_id}])
 
     def clear(self):
-        self.watchlist = {"watchlist": []}
-        self.save()
+        reset = self._reset_legacy()
+        if WatchlistItem.delete().where(WatchlistItem.profile == self.profile_id).execute() or reset:
+            self.bump_version()
+            ChangeLogEntry.record(self.profile.parent_id, self.profile_id, "watchlist", "clear")
+
 
+class WatchlistItem(BaseModel):
+    profile = ForeignKeyField(Profile, backref='watchlist_items', on_delete="CASCADE")
+    tmdb_id = IntegerField(null=False)
+    added_at = DateTimeField(default=datetime.datetime.now, null=False)
 
-class Watchhistory(BaseModel):
+    class Meta:
+        indexes = (
+            (('profile', 'tmdb_id'), True),
+        )
+
+    def to_dict(self) -> dict:
+        return {"id": self.tmdb_id, "added_at": self.added_at.isoformat()}
+
+
+def merge_pending(entries: list[tuple[datetime.datetime, dict]], pending: dict[int, dict],
+                  reverse=False) -> list[dict]:
+    # Buffered heartbeats are newer than their rows, overlay them so clients
+    # read their own writes before the next flush
+    merged = {entry["id"]: (updated_at, entry) for updated_at, entry in entries}
+    for tmdb_id, entry in pending.items():
+        duration = entry["duration"]
+        if duration is None and tmdb_id in merged:
+            duration = merged[tmdb_id][1]["duration"]
+        merged[tmdb_id] = (entry["updated_at"], {
+            "id": tmdb_id,
+            "current_time": entry["current_time"],
+            "duration": duration
+        })
+    return [entry for _, entry in sorted(merged.values(), key=lambda e: e[0], reverse=reverse)]
+
+
+class Watchhistory(VersionedModel):
     profile = ForeignKeyField(Profile, backref='watchhistories')
-    watchhistory = JSONField(default={"watchhistory": []}, null=False)
+    # Legacy JSON array, progress now lives in WatchProgress
+    legacy_watchhistory = JSONField(column_name="watchhistory", default={"watchhistory": []}, null=False)
 
-    def add(self, tmdb_id, current_time=0):
-        if self.watchhistory.get("watchhistory"):
-            self.watchhistory.get("watchhistory").append({
-                "id": tmdb_id,
-                "current_time": current_time
-            })
-        else:
-            self.watchhistory = {"watchhistory": [{
+    @property
+    def etag(self) -> str:
+        # Buffered heartbeats change the history before any row does
+        return f'"watchhistory-{self.id}-{self.etag_salt}-{self.version}.{progress_buffer.seq(self.profile_id)}"'
+
+    @property
+    def watchhistory(self) -> dict:
+        pending = progress_buffer.pending(self.profile_id)
+        query = self._progress().order_by(WatchProgress.updated_at, WatchProgress.id)
+        # Legacy entries follow the rows, among them the ones a partial backfill already moved
+        entries = [(LEGACY_TIMESTAMP, entry) for entry in self._unmigrated().values()]
+        return {"watchhistory": merge_pending([(row.updated_at, row.to_dict()) for row in query] + entries, pending)}
+
+    def _progress(self):
+        return WatchProgress.select().where(WatchProgress.profile == self.profile_id)
+
+    def legacy_entries(self) -> dict[int, dict]:
+        # The array appended an entry per call, the last one of a title wins
+        entries = {}
+        for entry in (self.legacy_watchhistory or {}).get("watchhistory") or []:
+            entries[entry["id"]] = {"id": entry["id"], "current_time": entry.get("current_time", 0), "duration": None}
+        return entries
+
+    def _unmigrated(self) -> dict[int, dict]:
+        # Legacy entries of titles without a row, read alongside the rows
+        # until the backfill or a write moves them
+        legacy = self.legacy_entries()
+        for batch in chunked(list(legacy), 500):
+            for tmdb_id in (WatchProgress
+                            .select(WatchProgress.tmdb_id)
+                            .where(WatchProgress.profile == self.profile_id, WatchProgress.tmdb_id.in_(batch))
+                            .scalars()):
+                del legacy[tmdb_id]
+        return legacy
+
+    def migrate_legacy(self, limit: int | None = None) -> int:
+        # Titles that already have a row keep it, it was written after the
+        # array. `limit` moves only the first titles, the rest stay in the array.
+        legacy = self.legacy_entries()
+        if not legacy:
+            return 0
+        rows = [{"profile": self.profile_id, "tmdb_id": tmdb_id, "current_time": entry["current_time"],
+                 "updated_at": LEGACY_TIMESTAMP} for tmdb_id, entry in list(legacy.items())[:limit]]
+        for batch in chunked(rows, 100):
+            WatchProgress.insert_many(batch).on_conflict_ignore().execute()
+        moved = {row["tmdb_id"] for row in rows}
+        self.legacy_watchhistory = {"watchhistory": [
+            entry for entry in self.legacy_watchhistory["watchhistory"] if entry["id"] not in moved
+        ]}
+        Watchhistory.update(legacy_watchhistory=self.legacy_watchhistory).where(Watchhistory.id == self.id).execute()
+        return len(rows)
+
+    def _reset_legacy(self) -> bool:
+        if not self.legacy_entries():
+            return False
+        self.legacy_watchhistory = {"watchhistory": []}
+        Watchhistory.update(legacy_watchhistory=self.legacy_watchhistory).where(Watchhistory.id == self.id).execute()
+        return True
+
+    @classmethod
+    def migrate_row(cls, row_id: int, limit: int) -> tuple[int, bool]:
+        row = cls.get_by_id(row_id)
+        return row.migrate_legacy(limit), not row.legacy_entries()
+
+    def watchhistory_json(self) -> str | None:
+        # Encoded by SQLite like Watchlist.items_json, None while heartbeats
+        # are buffered or legacy entries are left since those are merged in Python
+        if progress_buffer.pending(self.profile_id) or self.legacy_entries():
+            return None
+        progress = (WatchProgress
+                    .select(WatchProgress.tmdb_id, WatchProgress.current_time, WatchProgress.duration)
+                    .where(WatchProgress.profile == self.profile_id)
+                    .order_by(WatchProgress.updated_at, WatchProgress.id))
+        return Select([progress.alias("h")], [fn.json_group_array(fn.json_object(
+            "id", SQL('"h"."tmdb_id"'),
+            "current_time", SQL('"h"."current_time"'),
+            "duration", SQL('"h"."duration"')
+        ))]).scalar(self._meta.database)
+
+    def page(self, limit: int | None = None,
+             after: tuple[datetime.datetime, int] | None = None) -> tuple[list[dict], tuple | None]:
+        entries, next_key = self.keyed_page(limit, after)
+        return [entry for _, entry in entries], next_key
+
+    def keyed_page(self, limit: int | None = None,
+                   after: tuple[datetime.datetime, int] | None = None) -> tuple[list[tuple], tuple | None]:
+        # Keyset on (updated_at, tmdb_id), each entry comes with its key.
+        # Buffered titles have the newest updated_at, so they are left out of
+        # the query and sorted in last.
+        pending = progress_buffer.pending(self.profile_id)
+        query = self._progress().order_by(WatchProgress.updated_at, WatchProgress.tmdb_id)
+        if pending:
+            query = query.where(WatchProgress.tmdb_id.not_in(list(pending)))
+        if after is not None:
+            updated_at, tmdb_id = after
+            query = query.where(
+                (WatchProgress.updated_at > updated_at) |
+                ((WatchProgress.updated_at == updated_at) & (WatchProgress.tmdb_id > tmdb_id))
+            )
+        if limit is not None:
+            query = query.limit(limit + 1)
+        entries = [((row.updated_at, row.tmdb_id), row.to_dict()) for row in query]
+        entries += [((LEGACY_TIMESTAMP, tmdb_id), entry) for tmdb_id, entry in self._unmigrated().items()
+                    if tmdb_id not in pending and (after is None or (LEGACY_TIMESTAMP, tmdb_id) > after)]
+
+        pending = {key: entry for key, entry in pending.items() if after is None or (entry["updated_at"], key) > after}
+        durations = dict(WatchProgress
+                         .select(WatchProgress.tmdb_id, WatchProgress.duration)
+                         .where(WatchProgress.profile == self.profile_id,
+                                WatchProgress.tmdb_id.in_([k for k, e in pending.items() if e["duration"] is None]))
+                         .tuples()) if pending else {}
+        for tmdb_id, entry in pending.items():
+            entries.append(((entry["updated_at"], tmdb_id), {
                 "id": tmdb_id,
-                "current_time": current_time
-            }]}
-        self.save()
+                "current_time": entry["current_time"],
+                "duration": entry["duration"] if entry["duration"] is not None else durations.get(tmdb_id)
+            }))
+        entries.sort(key=lambda e: e[0])
+
+        next_key = entries[limit - 1][0] if limit is not None and len(entries) > limit else None
+        return entries[:limit], next_key
+
+    def resume_position(self, tmdb_id) -> int | None:
+        pending = progress_buffer.get(self.profile_id, tmdb_id)
+        if pending is not None:
+            return pending["current_time"]
+        current_time = (WatchProgress
+                        .select(WatchProgress.current_time)
+                        .where(WatchProgress.profile == self.profile_id, WatchProgress.tmdb_id == tmdb_id)
+                        .scalar())
+        if current_time is None and tmdb_id in (legacy := self.legacy_entries()):
+            return legacy[tmdb_id]["current_time"]
+        return current_time
+
+    def recent(self, limit=20) -> list[dict]:
+        pending = progress_buffer.pending(self.profile_id)
+        query = self._progress().order_by(WatchProgress.updated_at.desc()).limit(limit + len(pending))
+        entries = [(row.updated_at, row.to_dict()) for row in query]
+        if len(entries) < limit + len(pending):
+            # Legacy entries are the oldest, only needed once the rows run out
+            entries += [(LEGACY_TIMESTAMP, entry) for entry in self._unmigrated().values()]
+        return merge_pending(entries, pending, reverse=True)[:limit]
+
+    def buffer(self, tmdb_id, current_time=0, duration=None):
+        progress_buffer.put(self.profile_id, tmdb_id, current_time, duration)
+
+    def add(self, tmdb_id, current_time=0, duration=None):
+        progress_buffer.discard(self.profile_id, tmdb_id)
+        self.migrate_legacy()
+        row = {
+            "profile": self.profile_id,
+            "tmdb_id": tmdb_id,
+            "current_time": current_time,
+            "duration": duration,
+            "updated_at": datetime.datetime.now(),
+        }
+        WatchProgress.upsert_many([row])
+        self.bump_version()
+        ChangeLogEntry.record(self.profile.parent_id, self.profile_id, "watchhistory", "progress",
+                              [ChangeLogEntry.progress(row)])
+
+    def apply(self, operations) -> list[dict]:
+        # Last operation per title wins, progress becomes one batched upsert
+        self.migrate_legacy()
+        final: dict[int, dict | None] = {}
+        results = []
+        for operation in operations:
+            progress_buffer.discard(self.profile_id, operation.tmdb_id)
+            if operation.op == "progress":
+                final[operation.tmdb_id] = {
+                    "profile": self.profile_id,
+                    "tmdb_id": operation.tmdb_id,
+                    "current_time": operation.current_time or 0,
+                    "duration": operation.duration,
+                    "updated_at": datetime.datetime.now(),
+                }
+            else:
+                final[operation.tmdb_id] = None
+            results.append({"op": operation.op, "tmdb_id": operation.tmdb_id, "status": "ok"})
+
+        removed = [tmdb_id for tmdb_id, row in final.items() if row is None]
+        for batch in chunked(removed, 500):
+            WatchProgress.delete().where(
+                WatchProgress.profile == self.profile_id,
+                WatchProgress.tmdb_id.in_(batch)
+            ).execute()
+        rows = [row for row in final.values() if row is not None]
+        if rows:
+            WatchProgress.upsert_many(rows)
+        if final:
+            self.bump_version()
+            ChangeLogEntry.record(self.profile.parent_id, self.profile_id, "watchhistory", "progress",
+                                  [ChangeLogEntry.progress(row) for row in rows])
+            ChangeLogEntry.record(self.profile.parent_id, self.profile_id, "watchhistory", "remove",
+                                  [{"tmdb_id": tmdb_id} for tmdb_id in removed])
+        return results
+
+    def restore(self, entries: list[dict]):
+        # Exported progress keeps its updated_at, a title written here since
+        # keeps the newer row
+        self.migrate_legacy()
+        now = datetime.datetime.now()
+        rows = list({entry["id"]: {
+            "profile": self.profile_id,
+            "tmdb_id": entry["id"],
+            "current_time": entry["current_time"],
+            "duration": entry["duration"],
+            "updated_at": entry["updated_at"] or now,
+        } for entry in entries}.values())
+        if not rows:
+            return
+        WatchProgress.upsert_many(rows)
+        self.bump_version()
+        ChangeLogEntry.record(self.profile.parent_id, self.profile_id, "watchhistory", "progress",
+                              [ChangeLogEntry.progress(row) for row in rows])
 
     def remove(self, tmdb_id):
-        watchhistory = self.watchhistory.get("watchhistory")
-        if watchhistory:
-            filtered_watchhistory = [entry for entry in watchhistory if entry["id"] != tmdb_id]
-            self.watchhistory = {"watchhistory": filtered_watchhistory}
-            self.save()
+        progress_buffer.discard(self.profile_id, tmdb_id)
+        self.migrate_legacy()
+        WatchProgress.delete().where(
+            WatchProgress.profile == self.profile_id,
+            WatchProgress.tmdb_id == tmdb_id
+        ).execute()
+        self.bump_version()
+        ChangeLogEntry.record(self.profile.parent_id, self.profile_id, "watchhistory", "remove", [{"tmdb_id": tmdb_id}])
 
     def clear(self):
-        self.watchhistory = {"watchhistory": []}
-        self.save()
+        progress_buffer.discard(self.profile_id)
+        self._reset_legacy()
+        WatchProgress.delete().where(WatchProgress.profile == self.profile_id).execute()
+        self.bump_version()
+        ChangeLogEntry.record(self.profile.parent_id, self.profile_id, "watchhistory", "clear")
+
+
+class WatchProgress(BaseModel):
+    profile = ForeignKeyField(Profile, backref='watch_progress', on_delete="CASCADE", index=False)
+    tmdb_id = IntegerField(null=False)
+    current_time = IntegerField(default=0, null=False)
+    duration = IntegerField(null=True)
+    updated_at = DateTimeField(default=datetime.datetime.now, null=False)
+
+    class Meta:
+        indexes = (
+            (('profile', 'tmdb_id'), True),
+        )
+
+    def to_dict(self) -> dict:
+        return {"id": self.tmdb_id, "current_time": self.current_time, "duration": self.duration}
+
+    @classmethod
+    def upsert_many(cls, rows: list[dict]) -> dict[int, int]:
+        with cls._meta.database.atomic(lock_type="IMMEDIATE"):
+            # Profiles deleted since the rows were buffered would fail the foreign key
+            profile_ids = list({row["profile"] for row in rows})
+            existing = dict(Profile.select(Profile.id, Profile.parent).where(Profile.id.in_(profile_ids)).tuples())
+            rows = [row for row in rows if row["profile"] in existing]
+            for batch in chunked(rows, 100):
+                (cls
+                 .insert_many(batch)
+                 .on_conflict(
+                     conflict_target=[cls.profile, cls.tmdb_id],
+                     update={
+                         cls.current_time: EXCLUDED.current_time,
+                         cls.duration: fn.COALESCE(EXCLUDED.duration, cls.duration),
+                         cls.updated_at: EXCLUDED.updated_at,
+                     },
+                     # A late flush must not overwrite a newer direct write
+                     where=(EXCLUDED.updated_at >= cls.updated_at))
+                 .execute())
+            return existing
+
+    @classmethod
+    def flush(cls, rows: list[dict]):
+        # The buffered entries become rows, the new version replaces the
+        # buffer sequence in the history ETag
+        owners = cls.upsert_many(rows)
+        for batch in chunked(list(owners), 500):
+            Watchhistory.update(version=Watchhistory.version + 1).where(Watchhistory.profile.in_(batch)).execute()
+        ChangeLogEntry.insert_rows([
+            {"user": owners[row["profile"]], "profile_id": row["profile"], "resource": "watchhistory",
+             "op": "progress", **ChangeLogEntry.progress(row)}
+            for row in rows if row["profile"] in owners
+        ])
+
+
+# "Continue watching" reads the newest rows of a profile first
+WatchProgress.add_index(WatchProgress.profile, WatchProgress.updated_at.desc())
+
+progress_buffer = PartitionedProgressBuffer(
+    lambda shard: ProgressBuffer(
+        WatchProgress.flush,
+        PROGRESS_FLUSH_INTERVAL,
+        PROGRESS_FLUSH_SIZE,
+        transaction=lambda: shard_writing(shard),
+        transient=(OperationalError,)
+    ),
+    current_shard.get
+)
 
 
 class Notification(BaseModel):
     profile = ForeignKeyField(Profile, backref='notifications')
-    notification = JSONField(default={"noticiation": []}, null=False)
+    # Legacy JSON array, notifications now live in NotificationItem
+    legacy_notification = JSONField(column_name="notification", default={"notifications": []}, null=False)
 
-    def add(self, data):
-        if self.notifications.get("notifications"):
-            self.notifications.get("notifications").append(data)
-        else:
-            self.notifications = {"notifications": [data]}
-        self.save()
+    def add(self, data) -> "NotificationItem":
+        return NotificationItem.create(profile=self.profile_id, payload=data)
+
+    def unread(self, after: int | None = None, limit: int | None = None) -> list[dict]:
+        query = (NotificationItem
+                 .select()
+                 .where(NotificationItem.profile == self.profile_id, NotificationItem.read_at.is_null())
+                 .order_by(NotificationItem.id)
+                 .limit(limit))
+        if after is not None:
+            query = query.where(NotificationItem.id > after)
+        return [item.to_dict() for item in query]
+
+    def page(self, limit: int | None = None, after: int | None = None) -> tuple[list[dict], int | None]:
+        # Read and unread, oldest first
+        query = (NotificationItem
+                 .select()
+                 .where(NotificationItem.profile == self.profile_id)
+                 .order_by(NotificationItem.id))
+        if after is not None:
+            query = query.where(NotificationItem.id > after)
+        if limit is not None:
+            query = query.limit(limit + 1)
+        rows = list(query)
+        next_key = rows[limit - 1].id if limit is not None and len(rows) > limit else None
+        return [row.to_dict() for row in rows[:limit]], next_key
+
+    def restore(self, items: list[dict]):
+        # Exported items keep their timestamps and read state
+        now = datetime.datetime.now()
+        for batch in chunked(items, 100):
+            NotificationItem.insert_many([{
+                "profile": self.profile_id,
+                "payload": item["payload"],
+                "created_at": item["created_at"] or now,
+                "read_at": now if item["read"] else None
+            } for item in batch]).execute()
+
+    def mark_read(self, ids: list[int]) -> int:
+        total = 0
+        for batch in chunked(ids, 500):
+            total += (NotificationItem
+                      .update(read_at=datetime.datetime.now())
+                      .where(NotificationItem.profile == self.profile_id,
+                             NotificationItem.id.in_(batch),
+                             NotificationItem.read_at.is_null())
+                      .execute())
+        return total
 
     def clear(self):
-        self.notifications = {"notifications": []}
-        self.save()
+        NotificationItem.delete().where(NotificationItem.profile == self.profile_id).execute()
+
+
+class NotificationItem(BaseModel):
+    profile = ForeignKeyField(Profile, backref='notification_items', on_delete="CASCADE")
+    payload = JSONField(null=False)
+    created_at = DateTimeField(default=datetime.datetime.now, null=False)
+    read_at = DateTimeField(null=True)
+
+    @classmethod
+    def prune(cls, now: datetime.datetime, limit: int) -> int:
+        read_before = now - datetime.timedelta(days=NOTIFICATION_RETENTION)
+        created_before = now - datetime.timedelta(days=NOTIFICATION_UNREAD_RETENTION)
+        return delete_batch(cls, (cls.read_at < read_before) | (cls.created_at < created_before), limit)
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "payload": self.payload,
+            "created_at": self.created_at.isoformat(),
+            "read": self.read_at is not None
+        }
+
+
+def delete_batch(model, condition, limit: int) -> int:
+    # At most `limit` rows per statement so the write lock is held briefly
+    return model.delete().where(model.id.in_(model.select(model.id).where(condition).limit(limit))).execute()
+
+
+# Backfill on connect only ever reads unread rows
+NotificationItem.add_index(
+    NotificationItem
+    .index(NotificationItem.profile, NotificationItem.id, name="notificationitem_unread")
+    .where(NotificationItem.read_at.is_null())
+)
+
+
+class ChangeLogEntry(BaseModel):
+    # Append-only per account feed for delta sync, the id is the sync seq.
+    # Written in the transaction of the mutation it describes. AUTOINCREMENT
+    # so the seq never restarts below a floor once compaction empties the tail.
+    id = AutoIncrementField()
+    user = ForeignKeyField(UserAccount, backref="changes", null=False, on_delete="CASCADE", index=False)
+    profile_id = IntegerField(null=False)
+    resource = CharField(null=False)
+    op = CharField(null=False)
+    tmdb_id = IntegerField(null=True)
+    data = JSONField(null=True)
+    created_at = DateTimeField(default=datetime.datetime.now, null=False)
+
+    class Meta:
+        indexes = (
+            (('user', 'id'), False),
+        )
+
+    @staticmethod
+    def progress(row: dict) -> dict:
+        return {"tmdb_id": row["tmdb_id"], "data": {"current_time": row["current_time"], "duration": row["duration"]}}
+
+    @classmethod
+    def record(cls, user_id: int, profile_id: int, resource: str, op: str, changes: list[dict] | None = None):
+        if changes is None:
+            changes = [{}]
+        cls.insert_rows([
+            {"user": user_id, "profile_id": profile_id, "resource": resource, "op": op, **change}
+            for change in changes
+        ])
+
+    @classmethod
+    def insert_rows(cls, rows: list[dict]):
+        now = datetime.datetime.now()
+        for batch in chunked(rows, 100):
+            cls.insert_many([{"tmdb_id": None, "data": None, "created_at": now, **row} for row in batch]).execute()
+
+    @classmethod
+    def since(cls, user_id: int, seq: int, limit: int) -> tuple[list[dict], bool]:
+        rows = list(cls
+                    .select(cls.id, cls.profile_id, cls.resource, cls.op, cls.tmdb_id, cls.data)
+                    .where(cls.user == user_id, cls.id > seq)
+                    .order_by(cls.id)
+                    .limit(limit + 1))
+        return collapse_changes(rows[:limit]), len(rows) > limit
+
+    @classmethod
+    def compact(cls, before: datetime.datetime, accounts: int | None = None) -> int:
+        # Drops entries older than `before` and raises each account's floor
+        # past them, clients holding an older cursor get a resync signal.
+        # `accounts` bounds how many accounts one call compacts.
+        floors = list(cls
+                      .select(cls.user, fn.MAX(cls.id))
+                      .where(cls.created_at < before)
+                      .group_by(cls.user)
+                      .limit(accounts)
+                      .tuples())
+        deleted = 0
+        for user_id, floor in floors:
+            with cls._meta.database.atomic(lock_type="IMMEDIATE"):
+                UserAccount.update(changelog_floor=fn.MAX(UserAccount.changelog_floor, floor)).where(
+                    UserAccount.id == user_id
+                ).execute()
+                deleted += cls.delete().where(cls.user == user_id, cls.id <= floor).execute()
+        return deleted
+
+
+def collapse_changes(rows: list[ChangeLogEntry]) -> list[dict]:
+    # Later entries supersede earlier ones for the same title, a clear
+    # supersedes its resource and a profile delete the whole profile, so a
+    # page carries each change once no matter how often it was rewritten.
+    # Nothing collapses across a delete, the entries after it describe
+    # another profile even if it got the same id.
+    kept = []
+    seen = set()
+    for row in reversed(rows):
+        keys = ((row.profile_id,), (row.profile_id, row.resource), (row.profile_id, row.resource, row.tmdb_id))
+        if row.resource == "profile" and row.op == "delete":
+            seen = {key for key in seen if key[0] != row.profile_id}
+            seen.add(keys[0])
+        elif any(key in seen for key in keys):
+            continue
+        elif row.op == "clear" or row.tmdb_id is None:
+            seen.add(keys[1])
+        else:
+            seen.add(keys[2])
+        change = {"seq": row.id, "profile_id": row.profile_id, "resource": row.resource, "op": row.op}
+        if row.tmdb_id is not None:
+            change["tmdb_id"] = row.tmdb_id
+        if row.data is not None:
+            change["data"] = row.data
+        kept.append(change)
+    kept.reverse()
+    return kept
+
+
+class TmdbCache(BaseModel):
+    key = CharField(unique=True, null=False)
+    payload = JSONField(null=False)
+    expires_at = DateTimeField(null=False, index=True)
+
+    @classmethod
+    def load(cls, keys: list[str], now: datetime.datetime) -> dict[str, dict]:
+        found = {}
+        for batch in chunked(keys, 500):
+            query = cls.select(cls.key, cls.payload).where(cls.key.in_(batch), cls.expires_at > now)
+            found.update((entry.key, entry.payload) for entry in query)
+        return found
+
+    @classmethod
+    def prune(cls, now: datetime.datetime, limit: int) -> int:
+        return delete_batch(cls, cls.expires_at <= now, limit)
+
+    @classmethod
+    def store(cls, entries: dict[str, dict], ttl: int):
+        expires_at = datetime.datetime.now() + datetime.timedelta(seconds=ttl)
+        rows = [{"key": key, "payload": payload, "expires_at": expires_at} for key, payload in entries.items()]
+        for batch in chunked(rows, 300):
+            cls.insert_many(batch).on_conflict_replace().execute()
+
+
+class MigrationCheckpoint(BaseModel):
+    # Resume point of an online backfill in this file, scheduled by a
+    # migration and advanced one committed batch at a time
+    name = CharField(unique=True, null=False)
+    last_id = IntegerField(default=0, null=False)
+    done = BooleanField(default=False, null=False)
+    updated_at = DateTimeField(default=datetime.datetime.now, null=False)
 
 
 class Token(pydantic.BaseModel):
@@ -194,14 +1222,51 @@ class TokenData(UserAccount):
     username: str | None = None
 
 
+# Account data, split across the shard files when sharding is on
+ACCOUNT_MODELS = [
+    UserAccount,
+    TokenSession,
+    Profile,
+    Preferences,
+    Watchlist,
+    WatchlistItem,
+    Watchhistory,
+    WatchProgress,
+    Notification,
+    NotificationItem,
+    ChangeLogEntry,
+]
+# Shared by every account, always in the main file
+MAIN_MODELS = [
+    AccountRoute,
+    TmdbCache,
+]
+# State of the file itself, kept in every file
+FILE_MODELS = [
+    MigrationCheckpoint,
+]
+MODELS = ACCOUNT_MODELS + MAIN_MODELS + FILE_MODELS
+
+
 def create_tables():
-    db.connect()
-    db.create_tables([
-        UserAccount,
-        Profile,
-        Preferences,
-        Watchlist,
-        Watchhistory,
-        Notification,
-    ])
-    db.close()
+    # Only creates missing tables, changes to existing ones are migrations
+    # in src/migrations
+    database = DatabaseSingleton()
+    # The main file keeps the account tables too, accounts created before
+    # sharding was turned on stay there until a rebalance moves them
+    with database.connection_context():
+        database.create_tables(MODELS)
+    for shard in database.shard_ids():
+        with use_shard(shard), database.writer():
+            database.create_tables(ACCOUNT_MODELS + FILE_MODELS)
+
+
+def compact_changelog() -> int:
+    database = DatabaseSingleton()
+    before = datetime.datetime.now() - datetime.timedelta(days=CHANGELOG_RETENTION)
+    with database.connection_context():
+        deleted = ChangeLogEntry.compact(before)
+    for shard in database.shard_ids():
+        with use_shard(shard), database.writer():
+            deleted += ChangeLogEntry.compact(before)
+    return deleted
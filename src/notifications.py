@@ -0,0 +1,88 @@
+import asyncio
+import threading
+
+NOTIFICATION_QUEUE_SIZE = 100
+
+
+class Subscription:
+    def __init__(self, user_id: int, profile_id: int, shard: int | None = None,
+                 maxsize: int = NOTIFICATION_QUEUE_SIZE):
+        self.key = (shard, user_id, profile_id)
+        self.loop = asyncio.get_running_loop()
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.overflowed = False
+        self.closed = False
+
+    def deliver(self, message: dict):
+        # Runs on the subscriber's loop. A consumer that falls this far behind
+        # is disconnected and catches up from the table when it reconnects.
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+    def close(self):
+        # Runs on the subscriber's loop, wakes a pending get()
+        self.closed = True
+        try:
+            self.queue.put_nowait(None)
+        except asyncio.QueueFull:
+            pass
+
+    async def get(self) -> dict | None:
+        if self.overflowed or self.closed:
+            return None
+        message = await self.queue.get()
+        return None if self.overflowed or self.closed else message
+
+
+class NotificationHub:
+    # In-process pub/sub keyed by shard, account and profile id, profile ids
+    # are only unique within a shard. publish() and close() are called from
+    # the threadpool after the change is committed, delivery hops onto the
+    # event loop of each subscribed connection.
+    def __init__(self):
+        self._subscribers: dict[tuple[int | None, int, int], set[Subscription]] = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, user_id: int, profile_id: int, shard: int | None = None) -> Subscription:
+        subscription = Subscription(user_id, profile_id, shard)
+        with self._lock:
+            self._subscribers.setdefault(subscription.key, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        key = subscription.key
+        with self._lock:
+            subscribers = self._subscribers.get(key)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[key]
+
+    def subscriber_count(self, user_id: int, profile_id: int, shard: int | None = None) -> int:
+        with self._lock:
+            return len(self._subscribers.get((shard, user_id, profile_id), ()))
+
+    def publish(self, user_id: int, profile_id: int, message: dict, shard: int | None = None):
+        with self._lock:
+            subscribers = list(self._subscribers.get((shard, user_id, profile_id), ()))
+        for subscription in subscribers:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.deliver, message)
+            except RuntimeError:
+                # The connection's loop has already closed
+                self.unsubscribe(subscription)
+
+    def close(self, user_id: int, profile_id: int, shard: int | None = None):
+        # The profile is gone, its connections are closed and forgotten
+        with self._lock:
+            subscribers = self._subscribers.pop((shard, user_id, profile_id), set())
+        for subscription in subscribers:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.close)
+            except RuntimeError:
+                pass
+
+
+notification_hub = NotificationHub()
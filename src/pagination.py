@@ -0,0 +1,60 @@
+import base64
+import binascii
+import json
+from typing import Annotated
+
+from fastapi import HTTPException, Query, status
+
+MAX_PAGE_SIZE = 500
+
+
+def encode_cursor(key: dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps(key, separators=(",", ":")).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> dict:
+    padded = cursor + "=" * (-len(cursor) % 4)
+    key = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    if not isinstance(key, dict):
+        raise ValueError("Cursor must decode to an object")
+    return key
+
+
+def project(entry: dict, fields: set[str] | None) -> dict:
+    if not fields:
+        return entry
+    return {field: value for field, value in entry.items() if field in fields}
+
+
+class PageParams:
+    def __init__(self,
+                 limit: Annotated[int | None, Query(ge=1, le=MAX_PAGE_SIZE)] = None,
+                 cursor: str | None = None,
+                 fields: Annotated[str | None, Query(description="Comma separated fields to return")] = None):
+        self.limit = limit
+        self.fields = {field.strip() for field in fields.split(",") if field.strip()} if fields else None
+        try:
+            self.after = decode_cursor(cursor) if cursor else None
+        except (ValueError, binascii.Error):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+    def after_key(self, name: str, kind: type = int):
+        # The cursor comes from the client, a value of the wrong type or out
+        # of SQLite's integer range is a bad request
+        if self.after is None:
+            return None
+        value = self.after.get(name)
+        if type(value) is not kind or kind is int and not -2 ** 63 <= value < 2 ** 63:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+        return value
+
+    @property
+    def paginated(self) -> bool:
+        return self.limit is not None or self.after is not None
+
+    def check_fields(self, allowed: set[str]):
+        if self.fields and not self.fields <= allowed:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Unknown fields: {', '.join(sorted(self.fields - allowed))}"
+            )
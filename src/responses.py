@@ -0,0 +1,113 @@
+from datetime import datetime
+from typing import Any
+
+import orjson
+from fastapi import Response
+from fastapi.encoders import jsonable_encoder
+from pydantic import BaseModel
+
+# Typed shapes of the list endpoints. They document the responses, the
+# handlers encode rows straight to bytes and return a Response, which
+# FastAPI sends as is without validating or walking it again.
+
+
+class ProfileData(BaseModel):
+    # Every field but the id may be projected away with ?fields=
+    id: int
+    parent: int | None = None
+    name: str | None = None
+    avatar_url: str | None = None
+    version: int | None = None
+
+
+class ProfileListResponse(BaseModel):
+    data: list[ProfileData]
+    next_cursor: str | None = None
+
+
+class WatchlistEntry(BaseModel):
+    id: int | None = None
+    added_at: datetime | None = None
+
+
+class WatchlistData(BaseModel):
+    # Plain tmdb ids unless fields were requested
+    watchlist: list[int] | list[WatchlistEntry]
+
+
+class WatchlistResponse(BaseModel):
+    data: WatchlistData
+    next_cursor: str | None = None
+
+
+class HistoryEntry(BaseModel):
+    id: int | None = None
+    current_time: int | None = None
+    duration: int | None = None
+
+
+class WatchhistoryData(BaseModel):
+    watchhistory: list[HistoryEntry]
+
+
+class WatchhistoryResponse(BaseModel):
+    data: WatchhistoryData
+    next_cursor: str | None = None
+
+
+class RecentResponse(BaseModel):
+    data: list[HistoryEntry]
+
+
+class NotificationData(BaseModel):
+    id: int
+    payload: dict[str, Any]
+    created_at: datetime
+    read: bool
+
+
+class NotificationsResponse(BaseModel):
+    data: list[NotificationData]
+
+
+class Change(BaseModel):
+    seq: int
+    profile_id: int
+    resource: str
+    op: str
+    tmdb_id: int | None = None
+    data: Any = None
+
+
+class SyncData(BaseModel):
+    resync: bool
+    seq: int
+    changes: list[Change]
+    has_more: bool
+
+
+class SyncResponse(BaseModel):
+    data: SyncData
+
+
+def dumps(content) -> bytes:
+    # Anything orjson has no native encoding for takes FastAPI's slow path
+    return orjson.dumps(content, default=jsonable_encoder, option=orjson.OPT_NON_STR_KEYS)
+
+
+def nest(raw: bytes | str, *keys: str) -> bytes:
+    # Wraps JSON that is already encoded, e.g. an array built by SQLite,
+    # in objects under `keys` without decoding it
+    body = raw.encode() if isinstance(raw, str) else raw
+    for key in reversed(keys):
+        body = b"{" + orjson.dumps(key) + b":" + body + b"}"
+    return body
+
+
+def json_response(content=None, response: Response | None = None, raw: bytes | None = None) -> Response:
+    # Headers the handler set on the injected response (ETag) are carried over
+    return Response(
+        raw if raw is not None else dumps(content),
+        media_type="application/json",
+        headers=dict(response.headers) if response is not None else None
+    )
@@ -1,10 +1,15 @@
 from datetime import datetime, timedelta, timezone
-from typing import Annotated
+from typing import Annotated, Any, Literal
+import asyncio
+import hmac
+import json
 import os
+import uuid
 
 from dotenv import load_dotenv
 
-from fastapi import Depends, APIRouter, HTTPException, status
+from fastapi import Body, Depends, APIRouter, HTTPException, Query, Request, Response, WebSocket, WebSocketDisconnect, status
+from fastapi.responses import StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.security import OAuth2PasswordBearer
 
@@ -12,13 +17,60 @@ from fastapi.security import OAuth2PasswordBearer
 import jwt
 from jwt.exceptions import InvalidTokenError
 
-from argon2.exceptions import VerifyMismatchError
-
-from peewee import DoesNotExist, IntegrityError
-
-from src.security import verify_password
-from src.models import UserAccount, Profile, Token, TokenData, Watchlist, Watchhistory
-from src.forms import CreateProfileForm, DeleteProfileForm, UpdateProfileForm, UpdateWatchlistForm, UpdateWatchHistoryForm
+from argon2.exceptions import InvalidHashError, VerificationError, VerifyMismatchError
+
+from starlette.concurrency import run_in_threadpool
+
+from peewee import DoesNotExist, IntegrityError, fn
+
+from src.security import verify_password_async, token_digest, HasherSaturatedError
+from src.cache import legacy_miss_cache, token_cache, UserSnapshot
+from src.database import current_shard, read_transaction, write_transaction
+from src.unitofwork import UnitOfWork
+from src.tmdb import TmdbError, tmdb_client
+from src.notifications import notification_hub
+from src.pagination import MAX_PAGE_SIZE, PageParams, encode_cursor, project
+from src.conditional import check_if_match, not_modified
+from src.metrics import metrics
+from src.transfer import ImportFormatError, export_account, import_account
+from src.responses import (
+    NotificationsResponse,
+    ProfileListResponse,
+    RecentResponse,
+    SyncResponse,
+    WatchhistoryResponse,
+    WatchlistResponse,
+    json_response,
+    nest
+)
+from src.models import (
+    AccountRoute,
+    PROFILE_FIELDS,
+    UserAccount,
+    Profile,
+    Token,
+    TokenData,
+    Preferences,
+    PreferencePathError,
+    Watchlist,
+    Watchhistory,
+    Notification,
+    ChangeLogEntry
+)
+from src.forms import (
+    CreateProfileForm,
+    DeleteProfileForm,
+    UpdateProfileForm,
+    UpdateWatchlistForm,
+    UpdateWatchHistoryForm,
+    UpdatePreferencesForm,
+    PreferencePathForm,
+    BulkWatchlistForm,
+    BulkWatchHistoryForm,
+    CreateNotificationForm,
+    ReadNotificationsForm,
+    TmdbId
+)
 
 load_dotenv()
 
@@ -28,6 +80,10 @@ SECRET_KEY = os.getenv("PRIVATE_JWT_SECRET")
 
 TMDB_API_KEY = os.getenv("PRIVATE_TMDB_API_KEY")
 
+SOCKET_AUTH_TIMEOUT = float(os.getenv("SOCKET_AUTH_TIMEOUT", 10))  # seconds to send the token after connecting
+# Scrapers send it as a bearer token, /metrics is not served without one
+METRICS_TOKEN = os.getenv("PRIVATE_METRICS_TOKEN")
+
 
 access_router = APIRouter(tags=["Access"])
 manageprofiles_router = APIRouter(prefix="/manageprofiles", tags=["Manage Profile"])
@@ -35,9 +91,27 @@ watchlist_router = APIRouter(prefix="/watchlist", tags=["Watchlist"])
 watchhistory_router = APIRouter(prefix="/watchhistory", tags=["Watch History"])
 notification_router = APIRouter(prefix="/notification", tags=["Notification"])
 preferences_router = APIRouter(prefix="/preferences", tags=["Preferences"])
+tmdb_router = APIRouter(prefix="/tmdb", tags=["TMDB"])
+sync_router = APIRouter(prefix="/sync", tags=["Sync"])
+metrics_router = APIRouter(tags=["Metrics"])
+account_router = APIRouter(prefix="/account", tags=["Account"])
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+WATCHLIST_FIELDS = {"id", "added_at"}
+WATCHHISTORY_FIELDS = {"id", "current_time", "duration"}
+
+
+def watchlist_response(watchlist: Watchlist, response: Response) -> Response:
+    return json_response(response=response, raw=nest(watchlist.items_json(), "data", "watchlist"))
+
+
+def watchhistory_response(watchhistory: Watchhistory, response: Response) -> Response:
+    raw = watchhistory.watchhistory_json()
+    if raw is None:
+        return json_response({"data": watchhistory.watchhistory}, response)
+    return json_response(response=response, raw=nest(raw, "data", "watchhistory"))
+
 
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
     to_encode = data.copy()
@@ -45,7 +119,8 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
         expire = datetime.now(timezone.utc) + expires_delta
     else:
         expire = datetime.now(timezone.utc) + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
+    # jti keeps tokens issued within the same second distinct
+    to_encode.update({"exp": expire, "jti": uuid.uuid4().hex})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
@@ -56,6 +131,14 @@ async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]) -> Use
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+    digest = token_digest(token)
+    snapshot: UserSnapshot | None = token_cache.get(digest)
+    if snapshot is not None:
+        # Set here, in the request's context, so the handler's threads inherit it
+        current_shard.set(snapshot.shard)
+        # Detached instance, enough for ownership checks without a db round trip
+        return UserAccount(id=snapshot.id, username=snapshot.username, disabled=snapshot.disabled)
+
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username = payload.get("sub")
@@ -65,20 +148,66 @@ async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]) -> Use
     except InvalidTokenError:
         raise credentials_exception
 
-    user: UserAccount = UserAccount.get(UserAccount.username == token_data.username)  # get user
-    # Check if token is stll valid
-    if not user.check_token(token):
+    try:
+        shard = await run_in_threadpool(AccountRoute.shard_of, token_data.username)
+    except DoesNotExist:
         raise credentials_exception
-
+    current_shard.set(shard)
+    generation = token_cache.generation
+    user = await run_in_threadpool(load_token_user, token_data.username, token)
+    if user is None and legacy_miss_cache.get(digest) is None:
+        expires_at = datetime.fromtimestamp(payload["exp"]) if "exp" in payload else None
+        user = await adopt_legacy_token(token_data.username, token, expires_at)
+        if user is None:
+            legacy_miss_cache.set(digest, True)
     if user is None:
         raise credentials_exception
+
+    token_cache.set(
+        digest,
+        UserSnapshot(user.id, user.username, user.disabled, shard),
+        ttl=payload["exp"] - datetime.now(timezone.utc).timestamp() if "exp" in payload else None,
+        generation=generation
+    )
     return user
 
 
-def authenticate_user(username: str, password: str) -> UserAccount | bool:
+@read_transaction
+def load_token_user(username: str, token: str) -> UserAccount | None:
+    return UserAccount.get_by_token(username, token)
+
+
+async def adopt_legacy_token(username: str, token: str, expires_at: datetime | None) -> UserAccount | None:
+    # Sessions issued before TokenSession are only stored as Argon2 hashes in
+    # the account's tokens column. They stay valid: the first request with one
+    # verifies it there and moves it to a TokenSession.
+    hashes = await run_in_threadpool(read_transaction(UserAccount.legacy_token_hashes), username)
+    for hashed in hashes:
+        try:
+            await verify_password_async(hashed, token)
+        except (VerificationError, InvalidHashError):
+            continue
+        except HasherSaturatedError:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many login attempts, try again shortly",
+                headers={"Retry-After": "1"},
+            )
+        return await run_in_threadpool(write_transaction(UserAccount.adopt_legacy_token),
+                                       username, token, hashed, expires_at)
+    return None
+
+
+@read_transaction
+def load_user(username: str) -> UserAccount:
+    return UserAccount.get(UserAccount.username == username)
+
+
+async def authenticate_user(username: str, password: str) -> UserAccount | bool:
     try:
-        user: UserAccount = UserAccount.get(UserAccount.username == username)
-        if user and verify_password(user.hashed_password, password):
+        current_shard.set(await run_in_threadpool(AccountRoute.shard_of, username))
+        user: UserAccount = await run_in_threadpool(load_user, username)
+        if user and await verify_password_async(user.hashed_password, password):
             return user
     except (VerifyMismatchError, DoesNotExist):
         pass
@@ -91,17 +220,21 @@ async def require_token(current_user: Annotated[UserAccount, Depends(get_current
     return current_user
 
 
-def local_get_profile(id, user: UserAccount):
-    try:
-        profile: Profile = Profile.get(Profile.parent == user, Profile.id == id)
-        return profile
-    except DoesNotExist:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not profile found")
+def get_unit_of_work(token: Annotated[str, Depends(oauth2_scheme)],
+                     user: Annotated[UserAccount, Depends(require_token)]) -> UnitOfWork:
+    return UnitOfWork(user, token)
 
 
 @access_router.post("/token")
 async def generate_token(form_data: Annotated[OAuth2PasswordRequestForm, Depends()]) -> Token:
-    user = authenticate_user(form_data.username, form_data.password)
+    try:
+        user = await authenticate_user(form_data.username, form_data.password)
+    except HasherSaturatedError:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many login attempts, try again shortly",
+            headers={"Retry-After": "1"},
+        )
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -113,151 +246,556 @@ async def generate_token(form_data: Annotated[OAuth2PasswordRequestForm, Depends
     access_token = create_access_token(
         data={"sub": user.username}, expires_delta=access_token_expires
     )
-    user.register_token(access_token)
+    await run_in_threadpool(write_transaction(user.register_token), access_token,
+                            expires_at=datetime.now() + access_token_expires)
     return Token(access_token=access_token, token_type="bearer")
 
 
-@access_router.get("/tmdb_apikey")
+@access_router.get("/tmdb_apikey", deprecated=True)
 async def tmdb_apikey(_: Annotated[str, Depends(require_token)]):
     return Token(access_token=TMDB_API_KEY, token_type="bearer")
 
 
 @access_router.get("/logout")
-async def logout(token: Annotated[str, Depends(oauth2_scheme)], user: Annotated[UserAccount, Depends(require_token)]):
-    user.revoke_token(token)
+@write_transaction
+def logout(uow: Annotated[UnitOfWork, Depends(get_unit_of_work)]):
+    uow.user.revoke_token(uow.token)
     return {"message": "Logout Successfull"}
 
 
 @access_router.get("/logoutall")
-async def logoutall(user: Annotated[UserAccount, Depends(require_token)]):
-    user.revoke_all_tokens()
+@write_transaction
+def logoutall(uow: Annotated[UnitOfWork, Depends(get_unit_of_work)]):
+    uow.user.revoke_all_tokens()
     return {"message": "Logouts Successfull"}
 
 
 @manageprofiles_router.get("/{id}")
-async def get_profile(id: int, user: Annotated[UserAccount, Depends(require_token)]):
-    try:
-        profile: Profile = local_get_profile(id, user)
-        return {"data": profile.__data__}
-    except DoesNotExist:
+@read_transaction
+def get_profile(id: int, request: Request, response: Response,
+                uow: Annotated[UnitOfWork, Depends(get_unit_of_work)]):
+    profile: Profile = uow.profile(id)
+    if unchanged := not_modified(request, response, profile.etag):
+        return unchanged
+    return {"data": profile.to_dict()}
+
+
+@manageprofiles_router.get("/{id}/full")
+@read_transaction
+def get_full_profile(id: int, uow: Annotated[UnitOfWork, Depends(get_unit_of_work)]):
+    profile = Profile.hydrate(uow.user, id)
+    if profile is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Id does not match known profiles")
+    return json_response({"data": profile})
 
 
-@manageprofiles_router.get("")
-async def get_all_profiles(user: Annotated[UserAccount, Depends(require_token)]):
-    try:
-        profiles = Profile.select().where(Profile.parent_id == user.id)
-        return {"data": [profile.__data__ for profile in profiles]}
-    except DoesNotExist:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Id does not match known profiles")
+@manageprofiles_router.get("", response_model=ProfileListResponse)
+@read_transaction
+def get_all_profiles(request: Request, response: Response,
+                     uow: Annotated[UnitOfWork, Depends(get_unit_of_work)],
+                     page: Annotated[PageParams, Depends()]):
+    page.check_fields(set(PROFILE_FIELDS))
+    if unchanged := not_modified(request, response, UserAccount.profiles_etag(uow.user.id)):
+        return unchanged
+    profiles, next_key = Profile.page(uow.user, page.limit, page.after_key("id"), page.fields)
+    data = [project(profile, page.fields) for profile in profiles]
+    if not page.paginated:
+        return json_response({"data": data}, response)
+    return json_response({"data": data, "next_cursor": encode_cursor({"id": next_key}) if next_key else None},
+                         response)
 
 
 @manageprofiles_router.post("")
-async def create_profile(token: Annotated[str, Depends(oauth2_scheme)],
-                         user: Annotated[UserAccount, Depends(require_token)],
-                         form_data: Annotated[CreateProfileForm, Depends()]):
+@write_transaction
+def create_profile(uow: Annotated[UnitOfWork, Depends(get_unit_of_work)],
+                   form_data: Annotated[CreateProfileForm, Depends()]):
     try:
-        profile: Profile = Profile.create(parent=user, name=form_data.name, avatar_url=form_data.avatar_url)
-        return {"message": "Profile created successfully", "data": profile.__data__}
+        profile: Profile = Profile.create(parent=uow.user, name=form_data.name, avatar_url=form_data.avatar_url)
+        return {"message": "Profile created successfully", "data": profile.to_dict()}
     except IntegrityError:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Profile with name already exists")
 
 
-@manageprofiles_router.delete("")
-async def delete_profile(token: Annotated[str, Depends(oauth2_scheme)],
-                         user: Annotated[UserAccount, Depends(require_token)],
-                         form_data: Annotated[DeleteProfileForm, Depends()]):
-    profile: Profile = local_get_profile(form_data.id, user)
+@write_transaction
+def remove_profile(request: Request, uow: UnitOfWork, profile_id: int) -> dict:
+    profile: Profile = uow.profile(profile_id)
+    check_if_match(request, profile.etag)
     profile.delete_instance(recursive=True)
-    return {"message": "Profile deleted successfully", "data": profile.__data__}
+    uow.forget(profile.id)
+    return profile.to_dict()
+
+
+@manageprofiles_router.delete("")
+def delete_profile(request: Request,
+                   uow: Annotated[UnitOfWork, Depends(get_unit_of_work)],
+                   form_data: Annotated[DeleteProfileForm, Depends()]):
+    data = remove_profile(request, uow, form_data.id)
+    # Closed only once committed, like a publish
+    notification_hub.close(uow.user.id, form_data.id, current_shard.get())
+    return {"message": "Profile deleted successfully", "data": data}
 
 
 @manageprofiles_router.put("")
-async def update_profile(token: Annotated[str, Depends(oauth2_scheme)],
-                         user: Annotated[UserAccount, Depends(require_token)],
-                         form_data: Annotated[UpdateProfileForm, Depends()]):
-    profile: Profile = local_get_profile(form_data.id, user)
+@write_transaction
+def update_profile(request: Request, response: Response,
+                   uow: Annotated[UnitOfWork, Depends(get_unit_of_work)],
+                   form_data: Annotated[UpdateProfileForm, Depends()]):
+    profile: Profile = uow.profile(form_data.id)
+    check_if_match(request, profile.etag)
     try:
         profile.update_profile(form_data.name, form_data.avatar_url)
-        return {"message": "Profile updated successfully", "data": profile.__data__}
+        response.headers["ETag"] = profile.etag
+        return {"message": "Profile updated successfully", "data": profile.to_dict()}
     except IntegrityError:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Profile with name already exists")
 
 
-@watchlist_router.get("/{profile_id}")
-async def get_watchlist(profile_id: int, user: Annotated[UserAccount, Depends(require_token)]):
-    profile: Profile = local_get_profile(profile_id, user)
-    watchlist: Watchlist = Watchlist.get(Watchlist.profile == profile)
-    return {"data": watchlist.__data__.get("watchlist")}
-
-
-@watchlist_router.put("/add")
-async def add_watchlist(profile_id: int,
-                        user: Annotated[UserAccount, Depends(require_token)],
-                        form_data: Annotated[UpdateWatchlistForm, Depends()]):
-    profile: Profile = local_get_profile(profile_id, user)
-    watchlist: Watchlist = Watchlist.get(Watchlist.profile == profile)
+@watchlist_router.get("/{profile_id}", response_model=WatchlistResponse)
+@read_transaction
+def get_watchlist(profile_id: int,
+                  request: Request,
+                  response: Response,
+                  uow: Annotated[UnitOfWork, Depends(get_unit_of_work)],
+                  page: Annotated[PageParams, Depends()]):
+    page.check_fields(WATCHLIST_FIELDS)
+    watchlist: Watchlist = uow.get(Watchlist, profile_id)
+    if unchanged := not_modified(request, response, watchlist.etag):
+        return unchanged
+    if not page.paginated and not page.fields:
+        return watchlist_response(watchlist, response)
+
+    entries, next_key = watchlist.page(page.limit, page.after_key("id"))
+    # Without a projection entries keep the plain tmdb_id list shape
+    data = [project(entry, page.fields) if page.fields else entry["id"] for entry in entries]
+    if not page.paginated:
+        return json_response({"data": {"watchlist": data}}, response)
+    return json_response({"data": {"watchlist": data},
+                          "next_cursor": encode_cursor({"id": next_key}) if next_key else None}, response)
+
+
+@watchlist_router.get("/{profile_id}/{tmdb_id}")
+@read_transaction
+def contains_watchlist(profile_id: int, tmdb_id: TmdbId, uow: Annotated[UnitOfWork, Depends(get_unit_of_work)]):
+    watchlist: Watchlist = uow.get(Watchlist, profile_id)
+    return {"data": watchlist.contains(tmdb_id)}
+
+
+@watchlist_router.put("/add", response_model=WatchlistResponse)
+@write_transaction
+def add_watchlist(profile_id: int,
+                  request: Request,
+                  response: Response,
+                  uow: Annotated[UnitOfWork, Depends(get_unit_of_work)],
+                  form_data: Annotated[UpdateWatchlistForm, Depends()]):
+    watchlist: Watchlist = uow.get(Watchlist, profile_id)
+    check_if_match(request, watchlist.etag)
     watchlist.add(form_data.tmdb_id)
-    return {"data": watchlist.__data__.get("watchlist")}
-
-
-@watchlist_router.put("/remove")
-async def remove_watchlist(profile_id: int,
-                           user: Annotated[UserAccount, Depends(require_token)],
-                           form_data: Annotated[UpdateWatchlistForm, Depends()]):
-    profile: Profile = local_get_profile(profile_id, user)
-    watchlist: Watchlist = Watchlist.get(Watchlist.profile == profile)
+    response.headers["ETag"] = watchlist.etag
+    return watchlist_response(watchlist, response)
+
+
+@watchlist_router.put("/remove", response_model=WatchlistResponse)
+@write_transaction
+def remove_watchlist(profile_id: int,
+                     request: Request,
+                     response: Response,
+                     uow: Annotated[UnitOfWork, Depends(get_unit_of_work)],
+                     form_data: Annotated[UpdateWatchlistForm, Depends()]):
+    watchlist: Watchlist = uow.get(Watchlist, profile_id)
+    check_if_match(request, watchlist.etag)
     watchlist.remove(form_data.tmdb_id)
-    return {"data": watchlist.__data__.get("watchlist")}
-
-
-@watchlist_router.put("/clear")
-async def clear_watchlist(profile_id: int, user: Annotated[UserAccount, Depends(require_token)]):
-    profile: Profile = local_get_profile(profile_id, user)
-    watchlist: Watchlist = Watchlist.get(Watchlist.profile == profile)
+    response.headers["ETag"] = watchlist.etag
+    return watchlist_response(watchlist, response)
+
+
+@watchlist_router.put("/bulk")
+@write_transaction
+def bulk_watchlist(request: Request, response: Response,
+                   uow: Annotated[UnitOfWork, Depends(get_unit_of_work)], form_data: BulkWatchlistForm):
+    watchlist: Watchlist = uow.get(Watchlist, form_data.profile_id)
+    check_if_match(request, watchlist.etag)
+    results = watchlist.apply(form_data.operations)
+    response.headers["ETag"] = watchlist.etag
+    return {"data": results}
+
+
+@watchlist_router.put("/clear", response_model=WatchlistResponse)
+@write_transaction
+def clear_watchlist(profile_id: int, request: Request, response: Response,
+                    uow: Annotated[UnitOfWork, Depends(get_unit_of_work)]):
+    watchlist: Watchlist = uow.get(Watchlist, profile_id)
+    check_if_match(request, watchlist.etag)
     watchlist.clear()
-    return {"data": watchlist.__data__.get("watchlist")}
-
-
-@watchhistory_router.get("/{profile_id}")
-async def get_watchhistory(profile_id: int,
-                           user: Annotated[UserAccount, Depends(require_token)]):
-    profile: Profile = local_get_profile(profile_id, user)
-    watchhistory: Watchhistory = Watchhistory.get(Watchhistory.profile == profile)
-    return {"data": watchhistory.__data__.get("watchhistory")}
+    response.headers["ETag"] = watchlist.etag
+    return watchlist_response(watchlist, response)
+
+
+@watchhistory_router.get("/{profile_id}", response_model=WatchhistoryResponse)
+@read_transaction
+def get_watchhistory(profile_id: int,
+                     request: Request,
+                     response: Response,
+                     uow: Annotated[UnitOfWork, Depends(get_unit_of_work)],
+                     page: Annotated[PageParams, Depends()]):
+    page.check_fields(WATCHHISTORY_FIELDS)
+    watchhistory: Watchhistory = uow.get(Watchhistory, profile_id)
+    if unchanged := not_modified(request, response, watchhistory.etag):
+        return unchanged
+    if not page.paginated and not page.fields:
+        return watchhistory_response(watchhistory, response)
+
+    after = None
+    if page.after:
+        try:
+            updated_at = datetime.fromisoformat(page.after_key("updated_at", str))
+        except ValueError:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+        after = (updated_at, page.after_key("id"))
+    entries, next_key = watchhistory.page(page.limit, after)
+    data = [project(entry, page.fields) for entry in entries]
+    if not page.paginated:
+        return json_response({"data": {"watchhistory": data}}, response)
+    next_cursor = encode_cursor({"updated_at": next_key[0].isoformat(), "id": next_key[1]}) if next_key else None
+    return json_response({"data": {"watchhistory": data}, "next_cursor": next_cursor}, response)
+
+
+@watchhistory_router.get("/{profile_id}/recent", response_model=RecentResponse)
+@read_transaction
+def recent_watchhistory(profile_id: int,
+                        uow: Annotated[UnitOfWork, Depends(get_unit_of_work)],
+                        limit: Annotated[int, Query(ge=1, le=100)] = 20):
+    watchhistory: Watchhistory = uow.get(Watchhistory, profile_id)
+    return json_response({"data": watchhistory.recent(limit)})
+
+
+@watchhistory_router.get("/{profile_id}/{tmdb_id}")
+@read_transaction
+def resume_watchhistory(profile_id: int, tmdb_id: TmdbId, uow: Annotated[UnitOfWork, Depends(get_unit_of_work)]):
+    watchhistory: Watchhistory = uow.get(Watchhistory, profile_id)
+    current_time = watchhistory.resume_position(tmdb_id)
+    if current_time is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Title not in watch history")
+    return {"data": {"id": tmdb_id, "current_time": current_time}}
+
+
+@watchhistory_router.put("/add", response_model=WatchhistoryResponse)
+@read_transaction
+def add_watchhistory(profile_id: int,
+                     request: Request,
+                     response: Response,
+                     uow: Annotated[UnitOfWork, Depends(get_unit_of_work)],
+                     form_data: Annotated[UpdateWatchHistoryForm, Depends()]):
+    watchhistory: Watchhistory = uow.get(Watchhistory, profile_id)
+    check_if_match(request, watchhistory.etag)
+    watchhistory.buffer(form_data.tmdb_id, form_data.current_time, form_data.duration)
+    response.headers["ETag"] = watchhistory.etag
+    return watchhistory_response(watchhistory, response)
+
+
+@watchhistory_router.put("/remove", response_model=WatchhistoryResponse)
+@write_transaction
+def remove_watchhistory(profile_id: int,
+                        tmdb_id: TmdbId,
+                        request: Request,
+                        response: Response,
+                        uow: Annotated[UnitOfWork, Depends(get_unit_of_work)]):
+    watchhistory: Watchhistory = uow.get(Watchhistory, profile_id)
+    check_if_match(request, watchhistory.etag)
+    watchhistory.remove(tmdb_id)
+    response.headers["ETag"] = watchhistory.etag
+    return watchhistory_response(watchhistory, response)
+
+
+@watchhistory_router.put("/bulk")
+@write_transaction
+def bulk_watchhistory(request: Request, response: Response,
+                      uow: Annotated[UnitOfWork, Depends(get_unit_of_work)], form_data: BulkWatchHistoryForm):
+    watchhistory: Watchhistory = uow.get(Watchhistory, form_data.profile_id)
+    check_if_match(request, watchhistory.etag)
+    results = watchhistory.apply(form_data.operations)
+    response.headers["ETag"] = watchhistory.etag
+    return {"data": results}
+
+
+@watchhistory_router.put("/clear", response_model=WatchhistoryResponse)
+@write_transaction
+def clear_watchhistory(profile_id: int, request: Request, response: Response,
+                       uow: Annotated[UnitOfWork, Depends(get_unit_of_work)]):
+    watchhistory: Watchhistory = uow.get(Watchhistory, profile_id)
+    check_if_match(request, watchhistory.etag)
+    watchhistory.clear()
+    response.headers["ETag"] = watchhistory.etag
+    return watchhistory_response(watchhistory, response)
+
+
+@preferences_router.get("/{profile_id}")
+@read_transaction
+def get_preferences(profile_id: int, request: Request, response: Response,
+                    uow: Annotated[UnitOfWork, Depends(get_unit_of_work)]):
+    preferences: Preferences = uow.get(Preferences, profile_id)
+    if unchanged := not_modified(request, response, preferences.etag):
+        return unchanged
+    return {"data": preferences.preferences}
+
+
+@preferences_router.put("/{profile_id}")
+@write_transaction
+def update_preferences(profile_id: int, request: Request, response: Response,
+                       uow: Annotated[UnitOfWork, Depends(get_unit_of_work)],
+                       form_data: UpdatePreferencesForm):
+    preferences: Preferences = uow.get(Preferences, profile_id)
+    check_if_match(request, preferences.etag)
+    preferences.update_prefs(form_data.preferences)
+    response.headers["ETag"] = preferences.etag
+    return {"data": preferences.preferences}
+
+
+@preferences_router.patch("/{profile_id}")
+@write_transaction
+def patch_preferences(profile_id: int, request: Request, response: Response,
+                      uow: Annotated[UnitOfWork, Depends(get_unit_of_work)],
+                      patch: Annotated[dict[str, Any], Body(media_type="application/merge-patch+json")]):
+    preferences: Preferences = uow.get(Preferences, profile_id)
+    check_if_match(request, preferences.etag)
+    preferences.patch(patch)
+    response.headers["ETag"] = preferences.etag
+    return {"data": preferences.preferences}
+
+
+def preference_path(path: str) -> list[str]:
+    segments = path.strip("/").split("/")
+    if not path.strip("/") or any(not segment or '"' in segment for segment in segments):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid preference path")
+    return segments
+
+
+def resolve_preference_path(preferences: Preferences, segments: list[str]) -> list:
+    try:
+        return preferences.resolve(segments)
+    except PreferencePathError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+
+
+@preferences_router.put("/{profile_id}/{path:path}")
+@write_transaction
+def update_preference_path(profile_id: int, path: str, request: Request, response: Response,
+                           uow: Annotated[UnitOfWork, Depends(get_unit_of_work)],
+                           form_data: PreferencePathForm):
+    segments = preference_path(path)
+    preferences: Preferences = uow.get(Preferences, profile_id)
+    check_if_match(request, preferences.etag)
+    keys = resolve_preference_path(preferences, segments)
+    if form_data.op == "append":
+        if not preferences.append(keys, form_data.value):
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Preference is not a list")
+    elif form_data.op == "remove":
+        if isinstance(form_data.value, (dict, list)):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Only scalar values can be removed")
+        if not preferences.remove_value(keys, form_data.value):
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Preference is not a list")
+    elif not preferences.set_path(keys, form_data.value, overwrite=form_data.op == "set"):
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Preference already exists")
+    response.headers["ETag"] = preferences.etag
+    return {"data": preferences.preferences}
+
+
+@preferences_router.delete("/{profile_id}/{path:path}")
+@write_transaction
+def delete_preference_path(profile_id: int, path: str, request: Request, response: Response,
+                           uow: Annotated[UnitOfWork, Depends(get_unit_of_work)]):
+    segments = preference_path(path)
+    preferences: Preferences = uow.get(Preferences, profile_id)
+    check_if_match(request, preferences.etag)
+    if not preferences.remove_path(resolve_preference_path(preferences, segments)):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Preference not found")
+    response.headers["ETag"] = preferences.etag
+    return {"data": preferences.preferences}
+
+
+@sync_router.get("", response_model=SyncResponse)
+@read_transaction
+def sync(uow: Annotated[UnitOfWork, Depends(get_unit_of_work)],
+         since: Annotated[int | None, Query(ge=0, le=2 ** 63 - 1)] = None,
+         limit: Annotated[int, Query(ge=1, le=MAX_PAGE_SIZE)] = 100):
+    user_id = uow.user.id
+    floor = UserAccount.select(UserAccount.changelog_floor).where(UserAccount.id == user_id).scalar()
+    if since is None or since < floor:
+        # The client reads everything after taking this seq, changes that
+        # land in between are replayed on the next sync and are idempotent
+        seq = ChangeLogEntry.select(fn.MAX(ChangeLogEntry.id)).where(ChangeLogEntry.user == user_id).scalar()
+        return json_response({"data": {"resync": True, "seq": seq or floor, "changes": [], "has_more": False}})
+
+    changes, has_more = ChangeLogEntry.since(user_id, since, limit)
+    seq = changes[-1]["seq"] if changes else since
+    return json_response({"data": {"resync": False, "seq": seq, "changes": changes, "has_more": has_more}})
+
+
+@read_transaction
+def watchlist_ids(uow: UnitOfWork, profile_id: int) -> list[int]:
+    return uow.get(Watchlist, profile_id).items()
+
+
+@tmdb_router.get("/watchlist/{profile_id}")
+async def tmdb_watchlist(profile_id: int,
+                         uow: Annotated[UnitOfWork, Depends(get_unit_of_work)],
+                         kind: Literal["movie", "tv"] = "movie"):
+    tmdb_ids = await run_in_threadpool(watchlist_ids, uow, profile_id)
+    details = await tmdb_client.hydrate(kind, tmdb_ids)
+    return {"data": [{"id": tmdb_id, "details": details[tmdb_id]} for tmdb_id in tmdb_ids]}
+
+
+@tmdb_router.get("/{kind}/{tmdb_id}")
+async def tmdb_details(kind: Literal["movie", "tv"],
+                       tmdb_id: TmdbId,
+                       _: Annotated[UserAccount, Depends(require_token)]):
+    try:
+        return {"data": await tmdb_client.get(f"{kind}/{tmdb_id}")}
+    except TmdbError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+
+
+@notification_router.get("/{profile_id}", response_model=NotificationsResponse)
+@read_transaction
+def get_notifications(profile_id: int,
+                      uow: Annotated[UnitOfWork, Depends(get_unit_of_work)],
+                      after: Annotated[int | None, Query(ge=0, le=2 ** 63 - 1)] = None,
+                      limit: Annotated[int, Query(ge=1, le=500)] = 100):
+    notification: Notification = uow.get(Notification, profile_id)
+    return json_response({"data": notification.unread(after, limit)})
+
+
+@write_transaction
+def add_notification(uow: UnitOfWork, profile_id: int, payload: dict) -> dict:
+    return uow.get(Notification, profile_id).add(payload).to_dict()
+
+
+@notification_router.post("/{profile_id}")
+def create_notification(profile_id: int,
+                        uow: Annotated[UnitOfWork, Depends(get_unit_of_work)],
+                        form_data: CreateNotificationForm):
+    item = add_notification(uow, profile_id, form_data.payload)
+    # Published only once committed so subscribers never see a rolled back row
+    notification_hub.publish(uow.user.id, profile_id, item, current_shard.get())
+    return {"message": "Notification created successfully", "data": item}
+
+
+@notification_router.put("/{profile_id}/read")
+@write_transaction
+def read_notifications(profile_id: int,
+                       uow: Annotated[UnitOfWork, Depends(get_unit_of_work)],
+                       form_data: ReadNotificationsForm):
+    notification: Notification = uow.get(Notification, profile_id)
+    return {"data": notification.mark_read(form_data.ids)}
+
+
+@notification_router.put("/{profile_id}/clear")
+@write_transaction
+def clear_notifications(profile_id: int, uow: Annotated[UnitOfWork, Depends(get_unit_of_work)]):
+    notification: Notification = uow.get(Notification, profile_id)
+    notification.clear()
+    return {"data": []}
+
+
+async def socket_token(websocket: WebSocket) -> str | None:
+    # Browsers cannot set headers on a websocket, they send {"token": ...} as
+    # the first message. Never in the URL, that would land in access logs.
+    authorization = websocket.headers.get("authorization", "")
+    if authorization.lower().startswith("bearer "):
+        return authorization[7:]
+    try:
+        message = json.loads(await asyncio.wait_for(websocket.receive_text(), SOCKET_AUTH_TIMEOUT))
+    except (asyncio.TimeoutError, ValueError, KeyError):
+        return None
+    token = message.get("token") if isinstance(message, dict) else None
+    return token if isinstance(token, str) else None
 
 
-@watchhistory_router.put("/add")
-async def add_watchhistory(profile_id: int,
-                           user: Annotated[UserAccount, Depends(require_token)],
-                           form_data: Annotated[UpdateWatchHistoryForm, Depends()]):
-    profile: Profile = local_get_profile(profile_id, user)
-    watchhistory: Watchhistory = Watchhistory.get(Watchhistory.profile == profile)
-    watchhistory.add(form_data.tmdb_id, form_data.current_time)
-    return {"data": watchhistory.__data__.get("watchhistory")}
+@notification_router.websocket("/{profile_id}/ws")
+async def notification_socket(websocket: WebSocket, profile_id: int):
+    await websocket.accept()
+    try:
+        token = await socket_token(websocket)
+        if not token:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED)
+        uow = UnitOfWork(await require_token(await get_current_user(token)), token)
+        notification: Notification = await run_in_threadpool(read_transaction(uow.get), Notification, profile_id)
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    except WebSocketDisconnect:
+        return
+
+    # Subscribe before the backfill so nothing committed in between is missed
+    subscription = notification_hub.subscribe(uow.user.id, profile_id, current_shard.get())
+    try:
+        last_id = 0
+        for item in await run_in_threadpool(read_transaction(notification.unread)):
+            await websocket.send_json(item)
+            last_id = item["id"]
+
+        async def send():
+            while True:
+                message = await subscription.get()
+                if subscription.closed:
+                    # The profile was deleted
+                    await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+                    return
+                if message is None:
+                    # Fell too far behind, the client reconnects and backfills
+                    await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+                    return
+                if message["id"] > last_id:
+                    await websocket.send_json(message)
+
+        async def receive():
+            # Clients acknowledge with {"read": [ids]}, validated like the
+            # form of the HTTP route, anything else is ignored
+            while True:
+                try:
+                    form_data = ReadNotificationsForm(ids=json.loads(await websocket.receive_text())["read"])
+                except (ValueError, KeyError, TypeError):
+                    continue
+                await run_in_threadpool(write_transaction(notification.mark_read), form_data.ids)
+
+        tasks = [asyncio.create_task(send()), asyncio.create_task(receive())]
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        for task in done:
+            if task.exception() and not isinstance(task.exception(), WebSocketDisconnect):
+                raise task.exception()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        notification_hub.unsubscribe(subscription)
 
 
-@watchhistory_router.put("/remove")
-async def remove_watchhistory(profile_id: int,
-                              tmdb_id: int,
-                              user: Annotated[UserAccount, Depends(require_token)]):
-    profile: Profile = local_get_profile(profile_id, user)
-    watchhistory: Watchhistory = Watchhistory.get(Watchhistory.profile == profile)
-    watchhistory.remove(tmdb_id)
-    return {"data": watchhistory.__data__.get("watchhistory")}
+@metrics_router.get("/metrics", include_in_schema=False)
+async def get_metrics(request: Request):
+    if not METRICS_TOKEN:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+    authorization = request.headers.get("authorization", "").encode()
+    if not hmac.compare_digest(authorization, f"Bearer {METRICS_TOKEN}".encode()):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    # Prometheus text exposition format
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 
-@watchhistory_router.put("/clear")
-async def clear_watchhistory(profile_id: int, user: Annotated[UserAccount, Depends(require_token)]):
-    profile: Profile = local_get_profile(profile_id, user)
-    watchhistory: Watchhistory = Watchhistory.get(Watchhistory.profile == profile)
-    watchhistory.clear()
-    return {"data": watchhistory.__data__.get("watchhistory")}
+@account_router.get("/export")
+async def export_account_data(user: Annotated[UserAccount, Depends(require_token)]):
+    # NDJSON, one record per line, profiles before their entries
+    return StreamingResponse(export_account(user), media_type="application/x-ndjson",
+                             headers={"Content-Disposition": f'attachment; filename="{user.username}.ndjson"'})
 
 
-# @notification_router.get("/{profile_id}")
-# async def get_notification(profile_id: int,
-#                            user: Annotated[UserAccount, Depends(require_token)]):
-#     profile: Profile = local_get_profile(profile_id, user)
-#     watchhistory: Watchhistory = Watchhistory.get(Watchhistory.profile == profile)
-#     return {"data": watchhistory.__data__.get("watchhistory")}
+@account_router.post("/import")
+async def import_account_data(request: Request, user: Annotated[UserAccount, Depends(require_token)]):
+    try:
+        counts = await import_account(user.id, request.stream())
+    except ImportFormatError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"{e}, earlier lines were imported")
+    return {"message": "Account data imported", "data": counts}
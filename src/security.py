@@ -1,7 +1,30 @@
+import asyncio
+import hashlib
+import hmac
+import os
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+from dotenv import load_dotenv
 from argon2 import PasswordHasher
 
+from src.metrics import metrics
+
+load_dotenv()
+
 password_hasher = PasswordHasher()
 
+TOKEN_DIGEST_KEY = (os.getenv("PRIVATE_JWT_SECRET") or "").encode()
+
+ARGON2_EXECUTOR = os.getenv("ARGON2_EXECUTOR", "thread")  # thread | process
+ARGON2_MAX_WORKERS = int(os.getenv("ARGON2_MAX_WORKERS", os.cpu_count() or 1))
+ARGON2_MAX_QUEUE = int(os.getenv("ARGON2_MAX_QUEUE", 32))
+
+
+class HasherSaturatedError(Exception):
+    pass
+
 
 def verify_password(hashed_password: str, plain_password: str) -> bool:
     return password_hasher.verify(hashed_password, plain_password)
@@ -9,3 +32,56 @@ def verify_password(hashed_password: str, plain_password: str) -> bool:
 
 def hash_password(password: str) -> str:
     return password_hasher.hash(password)
+
+
+def token_digest(token: str) -> str:
+    # Bearer tokens are high entropy, a keyed SHA-256 is enough to index them
+    return hmac.new(TOKEN_DIGEST_KEY, token.encode(), hashlib.sha256).hexdigest()
+
+
+class HasherPool:
+    def __init__(self, kind: str = "thread", max_workers: int = 1, max_queue: int = 0):
+        self.kind = kind
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._pending = 0
+        self._executor: Executor | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self) -> Executor:
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="argon2")
+        return self._executor
+
+    async def run(self, fn, *args):
+        with self._lock:
+            if self._pending >= self.max_workers + self.max_queue:
+                raise HasherSaturatedError("Password hashing pool is saturated")
+            self._pending += 1
+        started = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+        finally:
+            metrics.observe_argon2(time.perf_counter() - started)
+            with self._lock:
+                self._pending -= 1
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+hasher_pool = HasherPool(ARGON2_EXECUTOR, ARGON2_MAX_WORKERS, ARGON2_MAX_QUEUE)
+
+
+async def verify_password_async(hashed_password: str, plain_password: str) -> bool:
+    return await hasher_pool.run(verify_password, hashed_password, plain_password)
+
+
+async def hash_password_async(password: str) -> str:
+    return await hasher_pool.run(hash_password, password)
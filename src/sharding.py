@@ -0,0 +1,117 @@
+import sys
+
+from peewee import fn
+
+from src.database import DatabaseSingleton, shard_for, use_shard, writing
+from src.models import (
+    ACCOUNT_MODELS,
+    MODELS,
+    AccountRoute,
+    ChangeLogEntry,
+    Profile,
+    UserAccount,
+    create_tables
+)
+
+# Offline rebalance, run with the app stopped:
+#   python -m src.sharding <shards>
+# Moves every account whose route disagrees with shard_for(id, shards), 0
+# moves everything back into the main file. Update `shards` in config.yml to
+# the same count before starting the app again.
+
+
+def owned_by(model, user_id: int, profile_ids: list[int]):
+    if model is UserAccount:
+        return model.id == user_id
+    if model is Profile:
+        return model.parent == user_id
+    if "user" in model._meta.fields:
+        return model.user == user_id
+    return model.profile.in_(profile_ids)
+
+
+def account_rows(user_id: int) -> dict[type, list[dict]]:
+    profile_ids = list(Profile.select(Profile.id).where(Profile.parent == user_id).scalars())
+    return {model: list(model.select().where(owned_by(model, user_id, profile_ids)).dicts())
+            for model in ACCOUNT_MODELS}
+
+
+def purge_account(user_id: int):
+    profile_ids = list(Profile.select(Profile.id).where(Profile.parent == user_id).scalars())
+    for model in reversed(ACCOUNT_MODELS):
+        model.delete().where(owned_by(model, user_id, profile_ids)).execute()
+
+
+def move_account(route: AccountRoute, target: int | None):
+    # Copies into the target, repoints the route and only then deletes the
+    # source, an interrupted move is redone from the start. Profile ids are
+    # only unique within a file, so profiles get new ids in the target.
+    with use_shard(route.shard), writing():
+        rows = account_rows(route.id)
+    seq = max((row["id"] for row in rows[ChangeLogEntry]), default=0)
+
+    with use_shard(target), writing():
+        purge_account(route.id)
+        # The log cannot be carried over with its seqs, a marker above every
+        # cursor the client may hold becomes the floor and forces a resync
+        seq = max(seq, ChangeLogEntry.select(fn.MAX(ChangeLogEntry.id)).scalar() or 0) + 1
+        profiles = {}
+        for model in ACCOUNT_MODELS:
+            for row in rows[model]:
+                if model is UserAccount:
+                    model.insert({**row, "changelog_floor": seq}).execute()
+                elif model is Profile:
+                    profiles[row.pop("id")] = model.insert(row).execute()
+                elif model is not ChangeLogEntry:
+                    row.pop("id")
+                    if "profile" in row:
+                        row["profile"] = profiles[row["profile"]]
+                    model.insert(row).execute()
+        ChangeLogEntry.insert(id=seq, user=route.id, profile_id=0, resource="account", op="move").execute()
+
+    with use_shard(None), writing():
+        AccountRoute.update(shard=target).where(AccountRoute.id == route.id).execute()
+    with use_shard(route.shard), writing():
+        purge_account(route.id)
+
+
+def route_main_accounts():
+    # Accounts created while sharding was off have no route yet, routes of
+    # accounts in the main file are rebuilt so renames are picked up
+    with use_shard(None), writing():
+        AccountRoute.delete().where(AccountRoute.shard.is_null()).execute()
+        AccountRoute.insert_from(
+            UserAccount.select(UserAccount.id, UserAccount.username, UserAccount.email),
+            fields=[AccountRoute.id, AccountRoute.username, AccountRoute.email]
+        ).execute()
+
+
+def rebalance(shards: int, db_name: str | None = None) -> int:
+    database = DatabaseSingleton.initialize(db_name, 0)
+    database.bind(MODELS, bind_refs=False, bind_backrefs=False)
+    create_tables()
+    with database.connection_context():
+        highest = AccountRoute.select(fn.MAX(AccountRoute.shard)).scalar()
+    # Shards beyond the new count are still opened so their accounts can leave
+    database = DatabaseSingleton.initialize(db_name, max(shards, highest + 1 if highest is not None else 0))
+    database.bind(MODELS, bind_refs=False, bind_backrefs=False)
+    create_tables()
+    route_main_accounts()
+
+    with use_shard(None), database.reader():
+        routes = list(AccountRoute.select().order_by(AccountRoute.id))
+    moved = 0
+    for route in routes:
+        target = shard_for(route.id, shards) if shards else None
+        if route.shard != target:
+            move_account(route, target)
+            moved += 1
+    database.close_pool()
+    return moved
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: python -m src.sharding <shards>")
+        sys.exit(1)
+    print(f"Moved {rebalance(int(sys.argv[1]))} accounts")
@@ -0,0 +1,149 @@
+import json
+import os
+import random
+import statistics
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pytest
+
+from src.cache import route_cache, token_cache
+from src.database import DatabaseSingleton, use_shard, writing
+from src.models import (
+    MODELS,
+    AccountRoute,
+    Profile,
+    TokenSession,
+    UserAccount,
+    WatchlistItem,
+    WatchProgress,
+    create_tables
+)
+from src.security import hash_password, token_digest
+
+# Off by default, the suite takes minutes and needs a quiet machine:
+#   BENCHMARK=1 python -m pytest -q -s src/tests/benchmarks
+BENCHMARK = bool(os.getenv("BENCHMARK"))
+BENCH_USERS = int(os.getenv("BENCH_USERS", 20))
+BENCH_TOKENS = int(os.getenv("BENCH_TOKENS", 10))  # registered tokens per user
+BENCH_ITEMS = int(os.getenv("BENCH_ITEMS", 200))  # watchlist and history entries per profile
+BENCH_SHARDS = int(os.getenv("BENCH_SHARDS", 0))
+BENCH_CONCURRENCY = int(os.getenv("BENCH_CONCURRENCY", 16))
+BENCH_TOLERANCE = float(os.getenv("BENCH_TOLERANCE", 0.5))  # allowed slowdown against the baseline
+BENCH_UPDATE = bool(os.getenv("BENCH_UPDATE"))  # rewrite the baselines from this run
+
+BASELINES = Path(__file__).with_name("baselines.json")
+PASSWORD = "Password@1234"
+
+
+def pytest_collection_modifyitems(config, items):
+    if BENCHMARK:
+        return
+    skip = pytest.mark.skip(reason="benchmarks run with BENCHMARK=1")
+    for item in items:
+        if "benchmarks" in item.nodeid:
+            item.add_marker(skip)
+
+
+def summarize(latencies: list[float], elapsed: float) -> dict:
+    cuts = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {
+        "requests": len(latencies),
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50": round(cuts[49] * 1000, 2),
+        "p95": round(cuts[94] * 1000, 2),
+        "p99": round(cuts[98] * 1000, 2),
+    }
+
+
+class Baselines:
+    # Latencies (ms) may grow and throughput may drop by BENCH_TOLERANCE
+    # before a scenario fails
+    def __init__(self, path: Path):
+        self.path = path
+        self.stored = json.loads(path.read_text()) if path.exists() else {}
+        self.results: dict[str, dict] = {}
+
+    def check(self, name: str, result: dict):
+        self.results[name] = result
+        print(f"\n{name:<24} {result['requests']:>6} req {result['rps']:>9} req/s "
+              f"p50 {result['p50']:>8} ms  p95 {result['p95']:>8} ms  p99 {result['p99']:>8} ms")
+        baseline = self.stored.get(name)
+        if BENCH_UPDATE or baseline is None:
+            return
+        regressions = [
+            f"{metric} {result[metric]} > {baseline[metric]}"
+            for metric in ("p50", "p95", "p99")
+            if result[metric] > baseline[metric] * (1 + BENCH_TOLERANCE)
+        ]
+        if result["rps"] < baseline["rps"] / (1 + BENCH_TOLERANCE):
+            regressions.append(f"rps {result['rps']} < {baseline['rps']}")
+        assert not regressions, f"{name} regressed: {', '.join(regressions)}"
+
+    def save(self):
+        self.path.write_text(json.dumps({**self.stored, **self.results}, indent=2, sort_keys=True) + "\n")
+
+
+@pytest.fixture(scope="session")
+def baselines():
+    stored = Baselines(BASELINES)
+    yield stored
+    if BENCH_UPDATE and stored.results:
+        stored.save()
+
+
+def seed(users: int, tokens: int, items: int) -> dict[str, dict]:
+    # Bulk inserts straight into the tables, one Argon2 hash for everyone
+    from src.routes import create_access_token
+
+    hashed = hash_password(PASSWORD)
+    issued = {}
+    now = datetime.now()
+    for index in range(users):
+        username = f"bench{index}"
+        UserAccount().create_user(username=username, email=f"{username}@bench.test", hashed_password=hashed)
+        with use_shard(AccountRoute.shard_of(username)), writing():
+            user = UserAccount.get(UserAccount.username == username)
+            profile = Profile.create(parent=user, name="Main")
+            issued[username] = {
+                "tokens": [create_access_token({"sub": username}, timedelta(days=1)) for _ in range(tokens)],
+                "profile": profile.id,
+            }
+            TokenSession.insert_many([
+                {"user": user.id, "digest": token_digest(token), "expires_at": now + timedelta(days=1)}
+                for token in issued[username]["tokens"]
+            ]).execute()
+            WatchlistItem.insert_many([
+                {"profile": profile.id, "tmdb_id": tmdb_id} for tmdb_id in range(items)
+            ]).execute()
+            WatchProgress.insert_many([
+                {"profile": profile.id, "tmdb_id": tmdb_id, "current_time": tmdb_id, "duration": 3600,
+                 "updated_at": now - timedelta(seconds=items - tmdb_id)}
+                for tmdb_id in range(items)
+            ]).execute()
+    return issued
+
+
+@pytest.fixture(scope="module")
+def bench_db(tmp_path_factory):
+    _db = DatabaseSingleton.initialize(str(tmp_path_factory.mktemp("bench") / "bench.sqlite3"), shards=BENCH_SHARDS)
+    _db.bind(MODELS, bind_refs=False, bind_backrefs=False)
+    create_tables()
+    route_cache.clear()
+    token_cache.clear()
+    started = time.perf_counter()
+    issued = seed(BENCH_USERS, BENCH_TOKENS, BENCH_ITEMS)
+    print(f"\nSeeded {BENCH_USERS} users x {BENCH_TOKENS} tokens x {BENCH_ITEMS} items "
+          f"in {time.perf_counter() - started:.1f}s")
+    yield issued
+    _db.close_pool()
+
+
+@pytest.fixture
+def accounts(bench_db) -> dict[str, dict]:
+    # Every scenario starts with cold token and route caches
+    token_cache.clear()
+    route_cache.clear()
+    random.seed(0)
+    return bench_db
@@ -0,0 +1,104 @@
+import asyncio
+import itertools
+import random
+import time
+
+import httpx
+
+from src.main import app
+from src.models import progress_buffer
+from src.tests.benchmarks.conftest import BENCH_CONCURRENCY, BENCH_ITEMS, PASSWORD, summarize
+
+
+def bearer(token: str) -> dict:
+    return {"Authorization": f"Bearer {token}"}
+
+
+async def drive(requests: list[tuple], concurrency: int = BENCH_CONCURRENCY) -> dict:
+    # Runs the real app in-process, lifespan included, and times every
+    # request from send to the last byte of the body
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+    transport = httpx.ASGITransport(app=app)
+
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            async def send(method, url, kwargs):
+                async with semaphore:
+                    started = time.perf_counter()
+                    response = await client.request(method, url, **kwargs)
+                    latencies.append(time.perf_counter() - started)
+                assert response.status_code < 400, (method, url, response.status_code, response.text)
+
+            started = time.perf_counter()
+            await asyncio.gather(*(send(*request) for request in requests))
+            elapsed = time.perf_counter() - started
+        progress_buffer.flush()
+    return summarize(latencies, elapsed)
+
+
+def run(requests: list[tuple], concurrency: int = BENCH_CONCURRENCY) -> dict:
+    return asyncio.run(drive(requests, concurrency))
+
+
+def test_token(accounts, baselines):
+    # Argon2 bound, kept short
+    requests = [
+        ("POST", "/token", {"data": {"username": username, "password": PASSWORD}})
+        for username in itertools.islice(itertools.cycle(accounts), 40)
+    ]
+    baselines.check("token", run(requests))
+
+
+def test_authenticated_get(accounts, baselines):
+    # Spread over every registered token, the first use of each misses the cache
+    tokens = [token for account in accounts.values() for token in account["tokens"]]
+    requests = [("GET", "/manageprofiles", {"headers": bearer(random.choice(tokens))}) for _ in range(2000)]
+    baselines.check("authenticated_get", run(requests))
+
+
+def test_library_reads(accounts, baselines):
+    requests = []
+    for _ in range(500):
+        account = random.choice(list(accounts.values()))
+        headers = bearer(account["tokens"][0])
+        requests.append(("GET", f"/watchlist/{account['profile']}", {"headers": headers}))
+        requests.append(("GET", f"/watchhistory/{account['profile']}", {"headers": headers}))
+    baselines.check("library_reads", run(requests))
+
+
+def test_watchlist_burst(accounts, baselines):
+    requests = []
+    for index in range(1000):
+        account = random.choice(list(accounts.values()))
+        params = {"profile_id": account["profile"], "tmdb_id": BENCH_ITEMS + index}
+        requests.append(("PUT", "/watchlist/add", {"params": params, "headers": bearer(account["tokens"][0])}))
+    baselines.check("watchlist_burst", run(requests))
+
+
+def test_watchhistory_burst(accounts, baselines):
+    # Playback heartbeats, mostly absorbed by the write-behind buffer
+    requests = []
+    for second in range(1000):
+        account = random.choice(list(accounts.values()))
+        params = {"profile_id": account["profile"], "tmdb_id": random.randrange(BENCH_ITEMS), "current_time": second}
+        requests.append(("PUT", "/watchhistory/add", {"params": params, "headers": bearer(account["tokens"][0])}))
+    baselines.check("watchhistory_burst", run(requests))
+
+
+def test_mixed_workload(accounts, baselines):
+    requests = []
+    for index in range(2000):
+        account = random.choice(list(accounts.values()))
+        headers = {"headers": bearer(random.choice(account["tokens"]))}
+        profile_id = account["profile"]
+        requests.append(random.choices([
+            ("GET", "/manageprofiles", headers),
+            ("GET", f"/manageprofiles/{profile_id}", headers),
+            ("GET", f"/watchlist/{profile_id}", {**headers, "params": {"limit": 50}}),
+            ("GET", f"/watchhistory/{profile_id}/recent", headers),
+            ("PUT", "/watchlist/add", {**headers, "params": {"profile_id": profile_id, "tmdb_id": index}}),
+            ("PUT", "/watchhistory/add", {**headers, "params": {"profile_id": profile_id, "tmdb_id": index % 50,
+                                                                  "current_time": index}}),
+        ], weights=[2, 2, 3, 3, 1, 4])[0])
+    baselines.check("mixed_workload", run(requests))
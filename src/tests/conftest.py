@@ -1,29 +1,21 @@
+import os
+
+os.environ.setdefault("PRIVATE_JWT_SECRET", "test-secret-key-for-the-pytest-suite")
+
 import pytest
+from fastapi.testclient import TestClient
 from src.security import hash_password
 from src.database import DatabaseSingleton
-from src.models import (
-    UserAccount,
-    Profile,
-    Preferences,
-    Watchlist,
-    Watchhistory,
-    Notification
-)
+from src.models import MODELS, UserAccount
+from src.cache import legacy_miss_cache, token_cache
 
 
 @pytest.fixture
 def db():
     _db = DatabaseSingleton.initialize(":memory:")
-    _db.bind([UserAccount, Profile, Preferences, Watchlist, Watchhistory, Notification], bind_refs=False, bind_backrefs=False)
+    _db.bind(MODELS, bind_refs=False, bind_backrefs=False)
     _db.connect()
-    _db.create_tables([
-        UserAccount,
-        Profile,
-        Preferences,
-        Watchlist,
-        Watchhistory,
-        Notification
-    ])
+    _db.create_tables(MODELS)
     UserAccount().create_user(
         username="Dummy1",
         email="test_dummy@gmooch.com",
@@ -31,12 +23,57 @@ def db():
     )
 
     yield _db
-    _db.drop_tables([
-        UserAccount,
-        Profile,
-        Preferences,
-        Watchlist,
-        Watchhistory,
-        Notification
-    ])
+    _db.drop_tables(MODELS)
     _db.close()
+
+
+@pytest.fixture
+def file_db(tmp_path):
+    # Sync routes run on worker threads, each with its own connection, so an
+    # in-memory database would not be shared with them
+    _db = DatabaseSingleton.initialize(str(tmp_path / "test.sqlite3"))
+    _db.bind(MODELS, bind_refs=False, bind_backrefs=False)
+    _db.create_tables(MODELS)
+    UserAccount().create_user(
+        username="Dummy1",
+        email="test_dummy@gmooch.com",
+        hashed_password=hash_password("Password@1234")
+    )
+    yield _db
+    _db.close()
+
+
+@pytest.fixture
+def client(file_db):
+    from src.main import app
+    token_cache.clear()
+    legacy_miss_cache.clear()
+    with TestClient(app) as client:
+        yield client
+
+
+@pytest.fixture
+def auth_headers(client):
+    result = client.post("/token", data={"username": "Dummy1", "password": "Password@1234"})
+    return {"Authorization": f"Bearer {result.json()['access_token']}"}
+
+
+@pytest.fixture
+def profile_id(client, auth_headers):
+    result = client.post("/manageprofiles", params={"name": "Test1"}, headers=auth_headers)
+    return result.json()["data"]["id"]
+
+
+@pytest.fixture
+def query_counter(file_db, monkeypatch):
+    # Counts statements issued by the routes, transaction control excluded
+    queries = []
+    execute_sql = file_db.execute_sql
+
+    def counting_execute_sql(sql, params=None, *args, **kwargs):
+        if not sql.startswith(("BEGIN", "SAVEPOINT", "RELEASE", "ROLLBACK")):
+            queries.append(sql)
+        return execute_sql(sql, params, *args, **kwargs)
+
+    monkeypatch.setattr(file_db, "execute_sql", counting_execute_sql)
+    return queries
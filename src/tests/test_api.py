@@ -0,0 +1,386 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import pytest
+from starlette.websockets import WebSocketDisconnect
+
+from src.database import writing
+from src.models import UserAccount, Watchhistory, Watchlist, progress_buffer
+from src.notifications import notification_hub
+from src.pagination import encode_cursor
+from src import routes
+from src.routes import create_access_token
+from src.security import hash_password, verify_password_async
+
+
+def test_token(client, auth_headers):
+    assert client.get("/manageprofiles", headers=auth_headers).status_code == 200
+    assert client.get("/logout", headers=auth_headers).status_code == 200
+    assert client.get("/manageprofiles", headers=auth_headers).status_code == 401
+
+
+def test_legacy_token_is_adopted(client):
+    # Issued before TokenSession, only its Argon2 hash is stored
+    token = create_access_token({"sub": "Dummy1"}, timedelta(days=1))
+    with writing():
+        UserAccount.update(tokens={"tokens": [[hash_password(token), "2024-01-01T00:00:00"]]}).execute()
+    headers = {"Authorization": f"Bearer {token}"}
+
+    assert client.get("/manageprofiles", headers=headers).status_code == 200
+    user = UserAccount.get()
+    assert user.tokens == {"tokens": []} and user.check_token(token)
+    assert client.get("/logout", headers=headers).status_code == 200
+    assert client.get("/manageprofiles", headers=headers).status_code == 401
+
+
+def test_unknown_token_checks_legacy_hashes_once(client, monkeypatch):
+    with writing():
+        UserAccount.update(tokens={"tokens": [[hash_password("other"), "2024-01-01T00:00:00"]]}).execute()
+    checks = []
+
+    async def verify(hashed, token):
+        checks.append(token)
+        return await verify_password_async(hashed, token)
+
+    monkeypatch.setattr(routes, "verify_password_async", verify)
+    headers = {"Authorization": f"Bearer {create_access_token({'sub': 'Dummy1'}, timedelta(days=1))}"}
+    assert client.get("/manageprofiles", headers=headers).status_code == 401
+    assert client.get("/manageprofiles", headers=headers).status_code == 401
+    assert len(checks) == 1
+
+
+def test_concurrent_watchlist_writes(client, auth_headers, profile_id):
+    def add(tmdb_id):
+        return client.put("/watchlist/add", params={"profile_id": profile_id, "tmdb_id": tmdb_id},
+                          headers=auth_headers).status_code
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        assert set(pool.map(add, range(40))) == {200}
+
+    result = client.get(f"/watchlist/{profile_id}", headers=auth_headers)
+    assert sorted(result.json()["data"]["watchlist"]) == list(range(40))
+
+
+def test_watchlist_contains(client, auth_headers, profile_id):
+    client.put("/watchlist/add", params={"profile_id": profile_id, "tmdb_id": 42}, headers=auth_headers)
+    assert client.get(f"/watchlist/{profile_id}/42", headers=auth_headers).json() == {"data": True}
+    assert client.get(f"/watchlist/{profile_id}/7", headers=auth_headers).json() == {"data": False}
+
+
+def test_watchhistory_resume(client, auth_headers, profile_id):
+    for current_time in (30, 60, 90):
+        client.put("/watchhistory/add", params={"profile_id": profile_id, "tmdb_id": 42, "current_time": current_time},
+                   headers=auth_headers)
+    client.put("/watchhistory/add", params={"profile_id": profile_id, "tmdb_id": 7, "current_time": 10},
+               headers=auth_headers)
+
+    result = client.get(f"/watchhistory/{profile_id}/42", headers=auth_headers)
+    assert result.json() == {"data": {"id": 42, "current_time": 90}}
+    result = client.get(f"/watchhistory/{profile_id}/recent", params={"limit": 1}, headers=auth_headers)
+    assert [entry["id"] for entry in result.json()["data"]] == [7]
+    assert client.get(f"/watchhistory/{profile_id}/1", headers=auth_headers).status_code == 404
+
+
+def test_paginated_watchlist(client, auth_headers, profile_id):
+    for tmdb_id in range(5):
+        client.put("/watchlist/add", params={"profile_id": profile_id, "tmdb_id": tmdb_id}, headers=auth_headers)
+
+    pages, cursor = [], None
+    while True:
+        params = {"limit": 2, **({"cursor": cursor} if cursor else {})}
+        result = client.get(f"/watchlist/{profile_id}", params=params, headers=auth_headers).json()
+        pages.append(result["data"]["watchlist"])
+        cursor = result["next_cursor"]
+        if not cursor:
+            break
+    assert pages == [[0, 1], [2, 3], [4]]
+
+    result = client.get(f"/watchlist/{profile_id}", params={"fields": "added_at", "limit": 1}, headers=auth_headers)
+    assert list(result.json()["data"]["watchlist"][0]) == ["added_at"]
+    assert client.get(f"/watchlist/{profile_id}", params={"cursor": "???"}, headers=auth_headers).status_code == 400
+
+
+@pytest.mark.parametrize("path", ["/watchlist/{}", "/watchhistory/{}", "/manageprofiles"])
+@pytest.mark.parametrize("key", [{"id": "x"}, {"id": 2 ** 63}, {"id": True}])
+def test_cursor_value_types(client, auth_headers, profile_id, path, key):
+    key = {"updated_at": "2024-01-01T00:00:00", **key} if path.startswith("/watchhistory") else key
+    result = client.get(path.format(profile_id), params={"cursor": encode_cursor(key)}, headers=auth_headers)
+    assert result.status_code == 400
+    cursor = encode_cursor({"updated_at": 5, "id": 1})
+    assert client.get(f"/watchhistory/{profile_id}", params={"cursor": cursor}, headers=auth_headers).status_code == 400
+
+
+@pytest.mark.parametrize("current_time", [-1, 2 ** 63, 10 ** 30])
+def test_watchhistory_position_bounds(client, auth_headers, profile_id, current_time):
+    params = {"profile_id": profile_id, "tmdb_id": 5, "current_time": current_time}
+    assert client.put("/watchhistory/add", params=params, headers=auth_headers).status_code == 422
+    assert not progress_buffer.pending(profile_id)
+
+
+@pytest.mark.parametrize("tmdb_id", [-1, 2 ** 63])
+def test_tmdb_id_bounds(client, auth_headers, profile_id, tmdb_id):
+    params = {"profile_id": profile_id, "tmdb_id": tmdb_id}
+    assert client.put("/watchlist/add", params=params, headers=auth_headers).status_code == 422
+    assert client.put("/watchlist/remove", params=params, headers=auth_headers).status_code == 422
+    assert client.get(f"/watchlist/{profile_id}/{tmdb_id}", headers=auth_headers).status_code == 422
+    assert client.get(f"/watchhistory/{profile_id}/{tmdb_id}", headers=auth_headers).status_code == 422
+    assert client.put("/watchhistory/remove", params=params, headers=auth_headers).status_code == 422
+
+
+def test_paginated_watchhistory(client, auth_headers, profile_id):
+    for tmdb_id in range(3):
+        client.put("/watchhistory/add", params={"profile_id": profile_id, "tmdb_id": tmdb_id, "current_time": 1},
+                   headers=auth_headers)
+    progress_buffer.flush()
+    client.put("/watchhistory/add", params={"profile_id": profile_id, "tmdb_id": 0, "current_time": 50},
+               headers=auth_headers)
+
+    first = client.get(f"/watchhistory/{profile_id}", params={"limit": 2, "fields": "id"}, headers=auth_headers).json()
+    assert first["data"]["watchhistory"] == [{"id": 1}, {"id": 2}]
+    second = client.get(f"/watchhistory/{profile_id}", params={"limit": 2, "cursor": first["next_cursor"]},
+                        headers=auth_headers).json()
+    assert second["data"]["watchhistory"] == [{"id": 0, "current_time": 50, "duration": None}]
+    assert second["next_cursor"] is None
+
+
+def test_paginated_profiles(client, auth_headers, profile_id):
+    client.post("/manageprofiles", params={"name": "Test2"}, headers=auth_headers)
+    result = client.get("/manageprofiles", params={"limit": 1, "fields": "name"}, headers=auth_headers).json()
+    assert result["data"] == [{"name": "Test1"}]
+    result = client.get("/manageprofiles", params={"cursor": result["next_cursor"]}, headers=auth_headers).json()
+    assert [profile["name"] for profile in result["data"]] == ["Test2"]
+    assert client.get("/manageprofiles", params={"fields": "secret"}, headers=auth_headers).status_code == 400
+    assert client.get("/manageprofiles", params={"fields": "etag_salt"}, headers=auth_headers).status_code == 400
+    # Only the public columns are serialised
+    fields = {"id", "parent", "name", "avatar_url"}
+    assert all(set(profile) == fields for profile in client.get("/manageprofiles", headers=auth_headers).json()["data"])
+    assert set(client.get(f"/manageprofiles/{profile_id}", headers=auth_headers).json()["data"]) == fields
+
+
+def test_bulk_mutations(client, auth_headers, profile_id):
+    operations = [{"op": "add", "tmdb_id": tmdb_id} for tmdb_id in range(500)]
+    operations += [{"op": "remove", "tmdb_id": 0}, {"op": "add", "tmdb_id": 1}]
+    result = client.put("/watchlist/bulk", json={"profile_id": profile_id, "operations": operations},
+                        headers=auth_headers)
+    assert [item["status"] for item in result.json()["data"][-2:]] == ["removed", "unchanged"]
+    watchlist = client.get(f"/watchlist/{profile_id}", headers=auth_headers).json()["data"]["watchlist"]
+    assert watchlist == list(range(1, 500))
+
+    operations = [{"op": "progress", "tmdb_id": 7, "current_time": t} for t in (10, 20)]
+    operations += [{"op": "progress", "tmdb_id": 8}, {"op": "remove", "tmdb_id": 8}]
+    client.put("/watchhistory/bulk", json={"profile_id": profile_id, "operations": operations}, headers=auth_headers)
+    history = client.get(f"/watchhistory/{profile_id}", headers=auth_headers).json()["data"]["watchhistory"]
+    assert history == [{"id": 7, "current_time": 20, "duration": None}]
+
+    operations = [{"op": "add", "tmdb_id": 9}, {"op": "add", "tmdb_id": 2 ** 63}]
+    result = client.put("/watchlist/bulk", json={"profile_id": profile_id, "operations": operations},
+                        headers=auth_headers)
+    assert result.status_code == 422
+    operations = [{"op": "remove", "tmdb_id": 2 ** 63}]
+    result = client.put("/watchhistory/bulk", json={"profile_id": profile_id, "operations": operations},
+                        headers=auth_headers)
+    assert result.status_code == 422
+
+
+def test_encoded_list_responses(client, auth_headers, profile_id):
+    operations = [{"op": "add", "tmdb_id": tmdb_id} for tmdb_id in range(400)]
+    client.put("/watchlist/bulk", json={"profile_id": profile_id, "operations": operations}, headers=auth_headers)
+    result = client.get(f"/watchlist/{profile_id}", headers={**auth_headers, "Accept-Encoding": "gzip"})
+    assert result.headers["content-type"] == "application/json"
+    assert result.headers["content-encoding"] == "gzip" and "etag" in result.headers
+    assert result.json() == {"data": {"watchlist": list(range(400))}}
+    compressed = result.headers["ETag"]
+    result = client.get(f"/watchlist/{profile_id}", headers={**auth_headers, "Accept-Encoding": "identity"})
+    assert "content-encoding" not in result.headers
+    # Same resource state, the compressed representation only gets the weak tag
+    assert compressed == f"W/{result.headers['ETag']}"
+    assert result.headers["Vary"] == "Accept-Encoding"
+
+    # Encoded by SQLite once flushed, merged in Python while buffered, same shape either way
+    for tmdb_id in (3, 1, 2):
+        client.put("/watchhistory/add", params={"profile_id": profile_id, "tmdb_id": tmdb_id, "current_time": tmdb_id},
+                   headers=auth_headers)
+    buffered = client.get(f"/watchhistory/{profile_id}", headers=auth_headers).json()
+    progress_buffer.flush()
+    assert client.get(f"/watchhistory/{profile_id}", headers=auth_headers).json() == buffered
+    assert [entry["id"] for entry in buffered["data"]["watchhistory"]] == [3, 1, 2]
+
+
+def test_full_profile_reads_legacy_entries(client, auth_headers, profile_id):
+    with writing():
+        Watchlist.update(legacy_watchlist={"watchlist": [5, 6]}).execute()
+        Watchhistory.update(legacy_watchhistory={"watchhistory": [{"id": 7, "current_time": 30}]}).execute()
+    client.put("/watchhistory/add", params={"profile_id": profile_id, "tmdb_id": 8, "current_time": 10},
+               headers=auth_headers)
+
+    full = client.get(f"/manageprofiles/{profile_id}/full", headers=auth_headers).json()["data"]
+    watchlist = client.get(f"/watchlist/{profile_id}", headers=auth_headers).json()["data"]["watchlist"]
+    history = client.get(f"/watchhistory/{profile_id}", headers=auth_headers).json()["data"]["watchhistory"]
+    assert full["watchlist"] == watchlist == [5, 6]
+    assert full["watchhistory"] == history
+    assert [entry["id"] for entry in history] == [7, 8]
+
+
+@pytest.mark.parametrize("method, path, params, budget", [
+    ("get", "/manageprofiles/{profile_id}/full", {}, 1),
+    ("get", "/manageprofiles", {}, 2),
+    ("get", "/manageprofiles/{profile_id}", {}, 1),
+    ("get", "/watchlist/{profile_id}", {}, 2),
+    ("put", "/watchlist/add", {"tmdb_id": 5}, 5),
+    ("put", "/watchlist/remove", {"tmdb_id": 5}, 4),
+    ("get", "/watchhistory/{profile_id}", {}, 2),
+    ("put", "/watchhistory/add", {"tmdb_id": 5, "current_time": 10}, 2),
+])
+def test_query_budget(client, auth_headers, profile_id, query_counter, method, path, params, budget):
+    client.get("/manageprofiles", headers=auth_headers)  # warms the token cache
+    query_counter.clear()
+    params = {"profile_id": profile_id, **params}
+    result = getattr(client, method)(path.format(profile_id=profile_id), params=params, headers=auth_headers)
+    assert result.status_code == 200
+    assert len(query_counter) <= budget, query_counter
+
+
+def test_conditional_get(client, auth_headers, profile_id, query_counter):
+    first = client.get(f"/watchlist/{profile_id}", headers=auth_headers)
+    etag = first.headers["ETag"]
+
+    query_counter.clear()
+    cached = client.get(f"/watchlist/{profile_id}", headers={**auth_headers, "If-None-Match": etag})
+    assert cached.status_code == 304
+    assert cached.headers["ETag"] == etag
+    assert len(query_counter) == 1
+
+    client.put("/watchlist/add", params={"profile_id": profile_id, "tmdb_id": 5}, headers=auth_headers)
+    changed = client.get(f"/watchlist/{profile_id}", headers={**auth_headers, "If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != etag
+    assert changed.json()["data"] == {"watchlist": [5]}
+
+
+def test_watchhistory_etag_follows_buffer(client, auth_headers, profile_id):
+    etag = client.get(f"/watchhistory/{profile_id}", headers=auth_headers).headers["ETag"]
+    client.put("/watchhistory/add", params={"profile_id": profile_id, "tmdb_id": 5, "current_time": 10},
+               headers=auth_headers)
+    buffered = client.get(f"/watchhistory/{profile_id}", headers={**auth_headers, "If-None-Match": etag})
+    assert buffered.status_code == 200
+
+    progress_buffer.flush()
+    flushed = client.get(f"/watchhistory/{profile_id}", headers={**auth_headers, "If-None-Match": etag})
+    assert flushed.status_code == 200
+    assert flushed.headers["ETag"] not in (etag, buffered.headers["ETag"])
+
+
+def test_deleted_profile_leaves_nothing_behind(client, auth_headers, profile_id):
+    client.put("/watchhistory/add", params={"profile_id": profile_id, "tmdb_id": 5, "current_time": 10},
+               headers=auth_headers)
+    client.request("DELETE", "/manageprofiles", params={"id": profile_id}, headers=auth_headers)
+    assert not progress_buffer.pending(profile_id)
+
+    created = client.post("/manageprofiles", params={"name": "Test2"}, headers=auth_headers).json()["data"]
+    assert created["id"] > profile_id
+    progress_buffer.flush()
+    assert client.get(f"/watchhistory/{created['id']}", headers=auth_headers).json()["data"]["watchhistory"] == []
+
+
+def test_if_match(client, auth_headers, profile_id):
+    etag = client.get(f"/preferences/{profile_id}", headers=auth_headers).headers["ETag"]
+    updated = client.put(f"/preferences/{profile_id}", json={"preferences": {"theme": "dark"}},
+                         headers={**auth_headers, "If-Match": etag})
+    assert updated.status_code == 200
+
+    stale = client.put(f"/preferences/{profile_id}", json={"preferences": {"theme": "light"}},
+                       headers={**auth_headers, "If-Match": etag})
+    assert stale.status_code == 412
+    assert stale.headers["ETag"] == updated.headers["ETag"]
+    assert client.get(f"/preferences/{profile_id}", headers=auth_headers).json()["data"] == {"theme": "dark"}
+
+
+def test_preference_paths(client, auth_headers, profile_id):
+    url = f"/preferences/{profile_id}"
+    client.put(url, json={"preferences": {"years": {}, "genres": [12, 35]}}, headers=auth_headers)
+
+    def put(path, op, value=None):
+        return client.put(f"{url}/{path}", json={"op": op, "value": value}, headers=auth_headers)
+
+    # Digits name keys of objects and index arrays
+    assert put("years/2024", "set", 3).json()["data"]["years"] == {"2024": 3}
+    assert put("genres/1", "set", 18).json()["data"]["genres"] == [12, 18]
+    assert put("genres/2", "set", 99).json()["data"]["genres"] == [12, 18, 99]
+
+    etag = client.get(url, headers=auth_headers).headers["ETag"]
+    assert put("missing", "append", 1).status_code == 409
+    assert put("genres/name", "set", 1).status_code == 409
+    assert put("genres/9", "set", 1).status_code == 409
+    assert put("years/2024/x", "set", 1).status_code == 409
+    assert put("years/2024", "insert", 4).status_code == 409
+    assert client.delete(f"{url}/missing", headers=auth_headers).status_code == 404
+    # Refused operations leave the version, and the changelog, alone
+    assert client.get(url, headers={**auth_headers, "If-None-Match": etag}).status_code == 304
+
+
+def test_sync(client, auth_headers, profile_id):
+    initial = client.get("/sync", headers=auth_headers).json()["data"]
+    assert initial["resync"]
+
+    for tmdb_id in (1, 2, 3):
+        client.put("/watchlist/add", params={"profile_id": profile_id, "tmdb_id": tmdb_id}, headers=auth_headers)
+    client.put("/watchlist/remove", params={"profile_id": profile_id, "tmdb_id": 2}, headers=auth_headers)
+
+    page = client.get("/sync", params={"since": initial["seq"], "limit": 3}, headers=auth_headers).json()["data"]
+    assert not page["resync"] and page["has_more"]
+    assert [change["tmdb_id"] for change in page["changes"]] == [1, 2, 3]
+    rest = client.get("/sync", params={"since": page["seq"]}, headers=auth_headers).json()["data"]
+    assert [(change["op"], change["tmdb_id"]) for change in rest["changes"]] == [("remove", 2)]
+    assert not rest["has_more"]
+    assert client.get("/sync", params={"since": 2 ** 63}, headers=auth_headers).status_code == 422
+
+
+def test_notification_socket(client, auth_headers, profile_id):
+    token = auth_headers["Authorization"].split()[1]
+    client.post(f"/notification/{profile_id}", json={"payload": {"message": "backlog"}}, headers=auth_headers)
+
+    with client.websocket_connect(f"/notification/{profile_id}/ws") as socket:
+        socket.send_json({"token": token})
+        backlog = socket.receive_json()
+        assert backlog["payload"] == {"message": "backlog"}
+        client.post(f"/notification/{profile_id}", json={"payload": {"message": "live"}}, headers=auth_headers)
+        assert socket.receive_json()["payload"] == {"message": "live"}
+        # Malformed acknowledgements are ignored, the socket stays open
+        socket.send_json({"read": {"id": "x"}})
+        socket.send_text("not json")
+        socket.send_json({"read": [backlog["id"]]})
+
+    unread = client.get(f"/notification/{profile_id}", headers=auth_headers).json()["data"]
+    assert [item["payload"]["message"] for item in unread] == ["live"]
+    assert client.get(f"/notification/{profile_id}", params={"after": 2 ** 63},
+                      headers=auth_headers).status_code == 422
+    with pytest.raises(WebSocketDisconnect):
+        with client.websocket_connect(f"/notification/{profile_id}/ws") as socket:
+            socket.send_json({"token": "bad"})
+            socket.receive_json()
+    with client.websocket_connect(f"/notification/{profile_id}/ws", headers=auth_headers) as socket:
+        assert socket.receive_json()["payload"] == {"message": "live"}
+
+
+def test_notification_socket_closed_with_its_profile(client, auth_headers, profile_id):
+    token = auth_headers["Authorization"].split()[1]
+    with client.websocket_connect(f"/notification/{profile_id}/ws") as socket:
+        socket.send_json({"token": token})
+        client.request("DELETE", "/manageprofiles", params={"id": profile_id}, headers=auth_headers)
+        with pytest.raises(WebSocketDisconnect) as closed:
+            socket.receive_json()
+        assert closed.value.code == 1008
+
+
+def test_notification_hub_keys_by_account():
+    async def deliveries():
+        own = notification_hub.subscribe(1, 5)
+        other = notification_hub.subscribe(2, 5)
+        notification_hub.publish(1, 5, {"id": 1})
+        notification_hub.close(2, 5)
+        await asyncio.sleep(0)
+        notification_hub.unsubscribe(own)
+        return await own.get(), await other.get(), notification_hub.subscriber_count(2, 5)
+
+    assert asyncio.run(deliveries()) == ({"id": 1}, None, 0)
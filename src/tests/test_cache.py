@@ -0,0 +1,62 @@
+import time
+
+import pytest
+
+from src.cache import TTLCache, UserSnapshot, token_cache
+from src.security import token_digest
+from src.models import UserAccount
+
+
+def test_ttl_cache_expiry_and_lru():
+    cache = TTLCache(maxsize=2, ttl=0.05)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)  # evicts "b", the least recently used
+    assert cache.get("b") is None
+    assert cache.stats() == {"size": 2, "hits": 1, "misses": 1}
+
+    time.sleep(0.06)
+    assert cache.get("a") is None and len(cache) == 1
+
+
+def test_token_cache_invalidation(db):
+    user: UserAccount = UserAccount.get(UserAccount.username == "Dummy1")
+    user.register_token("token_a")
+    user.register_token("token_b")
+    for token in ("token_a", "token_b"):
+        token_cache.set(token_digest(token), UserSnapshot(user.id, user.username, user.disabled))
+
+    user.revoke_token("token_a")
+    assert token_cache.get(token_digest("token_a")) is None
+    assert token_cache.get(token_digest("token_b"))
+
+    user.update_user(user.username, user.email, user.hashed_password, True)
+    assert token_cache.get(token_digest("token_b")) is None
+
+
+def test_token_revoked_after_commit(db):
+    user: UserAccount = UserAccount.get(UserAccount.username == "Dummy1")
+    user.register_token("token_a")
+    digest = token_digest("token_a")
+    token_cache.set(digest, UserSnapshot(user.id, user.username, user.disabled))
+
+    with db.atomic():
+        generation = token_cache.generation
+        user.revoke_token("token_a")
+        # Still cached until the delete commits
+        assert token_cache.get(digest)
+    assert token_cache.get(digest) is None
+
+    # A lookup that started before the revocation does not cache its result
+    token_cache.set(digest, UserSnapshot(user.id, user.username, user.disabled), generation=generation)
+    assert token_cache.get(digest) is None
+
+    # Nothing is invalidated by a revocation that rolls back
+    user.register_token("token_b")
+    token_cache.set(token_digest("token_b"), UserSnapshot(user.id, user.username, user.disabled))
+    with pytest.raises(ValueError):
+        with db.atomic():
+            user.revoke_all_tokens()
+            raise ValueError
+    assert user.check_token("token_b") and token_cache.get(token_digest("token_b"))
@@ -0,0 +1,103 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from peewee import OperationalError
+
+from src.database import DatabaseSingleton, read_settings, read_transaction, serving, write_transaction, writing
+from src.models import MODELS, UserAccount, Profile
+from src.writequeue import WriteQueue, WriterSaturatedError
+
+
+def test_read_settings(tmp_path):
+    config = tmp_path / "config.yml"
+    config.write_text('database_name: "app.sqlite3"\nsqlite:\n  read_pool_size: 2\n  synchronous: "full"\n')
+    settings = read_settings(str(config))
+    assert settings["database_name"] == "app.sqlite3"
+    assert settings["read_pool_size"] == 2 and settings["synchronous"] == "full"
+    assert settings["busy_timeout"] == 5000
+    assert read_settings(str(tmp_path / "missing.yml"))["database_name"] == "database.db"
+
+
+def test_read_write_split(file_db):
+    @read_transaction
+    def rename_in_read():
+        UserAccount.update(username="Renamed").execute()
+
+    @write_transaction
+    def rename():
+        UserAccount.update(username="Renamed").execute()
+
+    @read_transaction
+    def username():
+        return UserAccount.select(UserAccount.username).scalar()
+
+    with pytest.raises(OperationalError, match="readonly"):
+        rename_in_read()
+    rename()
+    assert username() == "Renamed"
+    assert DatabaseSingleton()._reader_count == 1
+
+
+def test_reader_path_is_escaped(tmp_path):
+    path = tmp_path / "odd?name#1%20" / "test.sqlite3"
+    path.parent.mkdir()
+    database = DatabaseSingleton.initialize(str(path))
+    database.bind(MODELS, bind_refs=False, bind_backrefs=False)
+    database.create_tables(MODELS)
+    try:
+        with database.reader():
+            assert UserAccount.select().count() == 0
+        assert database._reader_count == 1
+    finally:
+        database.close_pool()
+
+
+def test_write_queue_group_commit(file_db):
+    user = UserAccount.get(UserAccount.username == "Dummy1")
+    started, release = threading.Event(), threading.Event()
+    writes = WriteQueue(writing, lambda: DatabaseSingleton().atomic(), max_pending=100)
+    writes.start()
+    try:
+        # Holds the writer so the following submissions queue up into one batch
+        blocker = threading.Thread(target=writes.submit, args=(lambda: started.set() or release.wait(),))
+        blocker.start()
+        assert started.wait(5)
+
+        def create(name):
+            if name == "Bad":
+                Profile.create(parent=user, name=name)
+                raise ValueError(name)
+            return Profile.create(parent=user, name=name).id
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            futures = [pool.submit(writes.submit, lambda name=name: create(name))
+                       for name in ("A", "B", "Bad", "C")]
+            while writes._queue.qsize() < 4:
+                time.sleep(0.001)
+            release.set()
+            blocker.join()
+            results = [future.exception() or future.result() for future in futures]
+    finally:
+        writes.stop()
+
+    assert isinstance(results[2], ValueError)
+    assert sorted(Profile.select(Profile.name).scalars()) == ["A", "B", "C"]
+    assert writes.batches == 2 and writes.committed == 5
+
+
+def test_write_queue_backpressure():
+    writes = WriteQueue(lambda: threading.Lock(), lambda: threading.Lock(), max_pending=1, timeout=0.01)
+    writes._queue.put(None)
+    with pytest.raises(WriterSaturatedError):
+        writes.submit(lambda: None)
+
+
+def test_single_serving_process(file_db):
+    with serving():
+        with pytest.raises(RuntimeError):
+            with serving():
+                pass
+    with serving():
+        pass
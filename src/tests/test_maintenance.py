@@ -0,0 +1,80 @@
+import datetime
+import time
+
+from src import maintenance
+from src.database import DatabaseSingleton, writing
+from src.maintenance import MaintenanceScheduler, MaintenanceTask
+from src.metrics import metrics
+from src.models import NotificationItem, Profile, TmdbCache, TokenSession, UserAccount
+
+
+def seed(now):
+    long_ago = now - datetime.timedelta(days=365)
+    with writing():
+        user = UserAccount.get(UserAccount.username == "Dummy1")
+        profile = Profile.create(parent=user, name="Test1")
+        for index in range(5):
+            TokenSession.create(user=user, digest=f"expired{index}", expires_at=now - datetime.timedelta(hours=1))
+        TokenSession.create(user=user, digest="live", expires_at=now + datetime.timedelta(hours=1))
+        NotificationItem.create(profile=profile, payload={}, created_at=long_ago, read_at=long_ago)
+        NotificationItem.create(profile=profile, payload={}, created_at=long_ago)
+        NotificationItem.create(profile=profile, payload={}, created_at=now, read_at=now)
+        TmdbCache.create(key="old", payload={}, expires_at=now - datetime.timedelta(seconds=1))
+        TmdbCache.create(key="new", payload={}, expires_at=now + datetime.timedelta(days=1))
+
+
+def test_prune_in_batches(file_db, monkeypatch):
+    seed(datetime.datetime.now())
+    monkeypatch.setattr(maintenance, "MAINTENANCE_BATCH", 2)
+    scheduler = MaintenanceScheduler([], pause=0)
+    task = MaintenanceTask("prune_sessions", maintenance.prune(TokenSession), interval=600)
+    before = metrics.maintenance.count("prune_sessions")
+
+    assert scheduler.run_task(task) == 5
+    assert list(TokenSession.select(TokenSession.digest).scalars()) == ["live"]
+    assert metrics.maintenance.count("prune_sessions") == before + 1
+
+    assert scheduler.run_task(MaintenanceTask("notifications", maintenance.prune(NotificationItem), 600)) == 2
+    assert NotificationItem.select().count() == 1
+    assert scheduler.run_task(MaintenanceTask("tmdb", maintenance.prune(TmdbCache, main_only=True), 600)) == 1
+    assert list(TmdbCache.select(TmdbCache.key).scalars()) == ["new"]
+
+
+def test_budget_backoff(file_db, monkeypatch):
+    seed(datetime.datetime.now())
+    monkeypatch.setattr(maintenance, "MAINTENANCE_BATCH", 2)
+    scheduler = MaintenanceScheduler([], pause=0, backoff=1)
+    task = MaintenanceTask("prune_sessions", maintenance.prune(TokenSession), interval=600, budget=0)
+
+    # One batch per run once the budget is spent, the rest follows after the backoff
+    assert scheduler.run_task(task) == 2
+    assert task.next_run <= time.monotonic() + 1
+    assert TokenSession.select().count() == 4
+    task.budget = 10
+    assert scheduler.run_task(task) == 3
+    assert task.next_run > time.monotonic() + 1
+
+
+def test_failing_task_is_rescheduled(file_db):
+    def fail():
+        raise RuntimeError("boom")
+
+    task = MaintenanceTask("fail", fail, interval=600)
+    task.next_run = 0
+    MaintenanceScheduler([task]).run_pending()
+    assert task.next_run > time.monotonic() + 1
+
+
+def test_checkpoint_and_optimize(file_db, monkeypatch):
+    seed(datetime.datetime.now())
+    database = DatabaseSingleton()
+    assert database.wal_size() > 0
+
+    monkeypatch.setattr(maintenance, "WAL_CHECKPOINT_SIZE", 0)
+    maintenance.checkpoint()
+    assert database.wal_size() == 0
+
+    # Whether ANALYZE runs is SQLite's call, it has to go through the writer either way
+    maintenance.optimize()
+    with database.reader():
+        assert database.execute_sql("PRAGMA analysis_limit").fetchone()[0] == 0
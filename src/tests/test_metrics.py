@@ -0,0 +1,46 @@
+import logging
+
+from src import routes
+from src.metrics import Histogram, metrics
+
+
+def test_histogram_render():
+    histogram = Histogram("latency_seconds", "Latency", ("route",), buckets=(0.1, 1))
+    for value in (0.05, 0.5, 0.5, 5):
+        histogram.observe(value, '/a"b')
+    assert histogram.count('/a"b') == 4
+    assert histogram.render() == [
+        "# HELP latency_seconds Latency",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{route="/a\\"b",le="0.1"} 1',
+        'latency_seconds_bucket{route="/a\\"b",le="1"} 3',
+        'latency_seconds_bucket{route="/a\\"b",le="+Inf"} 4',
+        'latency_seconds_sum{route="/a\\"b"} 6.05',
+        'latency_seconds_count{route="/a\\"b"} 4',
+    ]
+
+
+def test_metrics_endpoint(client, auth_headers, profile_id, monkeypatch):
+    before = metrics.request_queries.count("/watchlist/{profile_id}")
+    client.get(f"/watchlist/{profile_id}", headers=auth_headers)
+    assert metrics.request_queries.count("/watchlist/{profile_id}") == before + 1
+
+    assert client.get("/metrics").status_code == 404
+    monkeypatch.setattr(routes, "METRICS_TOKEN", "scrape")
+    assert client.get("/metrics").status_code == 401
+    assert client.get("/metrics", headers=auth_headers).status_code == 401
+    body = client.get("/metrics", headers={"Authorization": "Bearer scrape"}).text
+    assert 'http_request_duration_seconds_count{method="GET",route="/watchlist/{profile_id}",status="200"}' in body
+    assert 'http_request_queries_bucket{route="/token",le="+Inf"}' in body
+    # Logging in hashed once, creating the profile waited for the write lock
+    assert "argon2_duration_seconds_count" in body
+    assert 'db_lock_wait_seconds_count{lock="writer"}' in body
+    assert "token_cache_misses_total" in body
+
+
+def test_slow_request_log(client, auth_headers, profile_id, monkeypatch, caplog):
+    monkeypatch.setattr(metrics, "slow_request_ms", 0.001)
+    with caplog.at_level(logging.WARNING, logger="src.metrics"):
+        client.get(f"/watchlist/{profile_id}", headers=auth_headers)
+    record = next(record for record in caplog.records if "/watchlist/{profile_id}" in record.getMessage())
+    assert 'FROM "watchlistitem"' in record.getMessage()
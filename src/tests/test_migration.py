@@ -0,0 +1,127 @@
+import datetime
+
+import pytest
+from peewee import IntegrityError
+
+from src import migration
+from src.database import writing
+from src.migration import BACKFILLS, apply_migrations, backfill
+from src.models import (
+    ChangeLogEntry,
+    MigrationCheckpoint,
+    Profile,
+    UserAccount,
+    Watchhistory,
+    Watchlist,
+    WatchlistItem,
+    WatchProgress
+)
+
+
+def seed_legacy(profile_id):
+    issued = datetime.datetime.now().isoformat()
+    with writing():
+        UserAccount.update(tokens={"tokens": [["$argon2id$expired", "2024-01-01T00:00:00"],
+                                              ["$argon2id$live", issued]]}).execute()
+        Watchlist.update(legacy_watchlist={"watchlist": [3, 1, 3, 2]}).where(Watchlist.profile == profile_id).execute()
+        Watchhistory.update(legacy_watchhistory={"watchhistory": [
+            {"id": 5, "current_time": 10},
+            {"id": 6, "current_time": 30},
+            {"id": 5, "current_time": 20},
+        ]}).where(Watchhistory.profile == profile_id).execute()
+
+
+def read_library(client, auth_headers, profile_id) -> dict:
+    pages, cursor = [], None
+    while True:
+        params = {"limit": 2, **({"cursor": cursor} if cursor else {})}
+        result = client.get(f"/watchlist/{profile_id}", params=params, headers=auth_headers).json()
+        pages.append(result["data"]["watchlist"])
+        if not (cursor := result["next_cursor"]):
+            break
+    return {
+        "watchlist": client.get(f"/watchlist/{profile_id}", headers=auth_headers).json()["data"]["watchlist"],
+        "pages": pages,
+        "contains": client.get(f"/watchlist/{profile_id}/2", headers=auth_headers).json()["data"],
+        "watchhistory": client.get(f"/watchhistory/{profile_id}", headers=auth_headers).json()["data"]["watchhistory"],
+        "resume": client.get(f"/watchhistory/{profile_id}/5", headers=auth_headers).json()["data"],
+        "recent": client.get(f"/watchhistory/{profile_id}/recent", headers=auth_headers).json()["data"],
+    }
+
+
+def test_backfill_is_resumable_and_reads_match(client, auth_headers, profile_id, monkeypatch):
+    client.put("/watchlist/add", params={"profile_id": profile_id, "tmdb_id": 1}, headers=auth_headers)
+    client.post("/manageprofiles", params={"name": "Test2"}, headers=auth_headers)
+    seed_legacy(profile_id)
+
+    # Dual read, the legacy entries follow the rows
+    before = read_library(client, auth_headers, profile_id)
+    assert before["watchlist"] == [1, 3, 2]
+    assert before["pages"] == [[1, 3], [2]]
+    assert before["contains"] is True
+    assert before["watchhistory"] == [{"id": 5, "current_time": 20, "duration": None},
+                                      {"id": 6, "current_time": 30, "duration": None}]
+    assert before["resume"]["current_time"] == 20
+    assert [entry["id"] for entry in before["recent"]] == [5, 6]
+
+    # Scheduled once per file on startup, applying again is a no-op
+    assert apply_migrations() == []
+    monkeypatch.setattr(migration, "MIGRATION_BATCH", 1)
+    # One entry per transaction, the rows are split across batches
+    assert backfill() == (2 + 1 + 1, True)
+    checkpoints = {checkpoint.name: checkpoint for checkpoint in MigrationCheckpoint.select()}
+    assert set(checkpoints) == {backfill.name for backfill in BACKFILLS}
+    assert checkpoints["watchlist"].last_id == 0 and not checkpoints["watchlist"].done
+    assert Watchlist.get(Watchlist.profile == profile_id).legacy_watchlist == {"watchlist": [1, 2]}
+    assert read_library(client, auth_headers, profile_id) == before
+
+    while backfill()[1]:
+        pass
+    assert all(MigrationCheckpoint.select(MigrationCheckpoint.done).scalars())
+    # Live legacy tokens stay for adoption on their next use
+    assert [entry[0] for entry in UserAccount.get().tokens["tokens"]] == ["$argon2id$live"]
+    assert Watchlist.get(Watchlist.profile == profile_id).legacy_watchlist == {"watchlist": []}
+    assert Watchhistory.get(Watchhistory.profile == profile_id).legacy_watchhistory == {"watchhistory": []}
+    assert WatchlistItem.select().where(WatchlistItem.profile == profile_id).count() == 3
+    assert WatchProgress.select().where(WatchProgress.profile == profile_id).count() == 2
+
+    after = read_library(client, auth_headers, profile_id)
+    assert after == before
+
+
+def test_write_migrates_the_row(client, auth_headers, profile_id):
+    seed_legacy(profile_id)
+    result = client.put("/watchlist/remove", params={"profile_id": profile_id, "tmdb_id": 3}, headers=auth_headers)
+    assert result.json()["data"]["watchlist"] == [1, 2]
+    assert Watchlist.get(Watchlist.profile == profile_id).legacy_watchlist == {"watchlist": []}
+
+    client.put("/watchhistory/clear", params={"profile_id": profile_id}, headers=auth_headers)
+    assert client.get(f"/watchhistory/{profile_id}", headers=auth_headers).json()["data"]["watchhistory"] == []
+
+
+def test_legacy_profile_table_is_upgraded(file_db):
+    # The schema before profiles were versioned and their ids AUTOINCREMENT
+    file_db.execute_sql('DROP TABLE "profile"')
+    file_db.execute_sql('CREATE TABLE "profile" ("id" INTEGER NOT NULL PRIMARY KEY, "parent_id" INTEGER NOT NULL, '
+                        '"name" VARCHAR(255) NOT NULL, "avatar_url" VARCHAR(255), '
+                        'FOREIGN KEY ("parent_id") REFERENCES "useraccount" ("id"))')
+    file_db.execute_sql('CREATE UNIQUE INDEX "profile_parent_id_name" ON "profile" ("parent_id", "name")')
+    user: UserAccount = UserAccount.get(UserAccount.username == "Dummy1")
+    file_db.execute_sql('INSERT INTO "profile" ("id", "parent_id", "name") VALUES (1, ?, \'Test1\'), (2, ?, \'Test2\')',
+                        (user.id, user.id))
+    Watchlist.insert(profile=1).execute()
+    WatchlistItem.insert(profile=1, tmdb_id=1).execute()
+    # A deleted profile, its id is still in the changelog
+    ChangeLogEntry.record(user.id, 3, "profile", "delete")
+
+    assert apply_migrations() == ["001_schedule_legacy_backfills", "002_add_version_columns", "003_autoincrement_ids"]
+    sql = file_db.execute_sql("SELECT sql FROM sqlite_master WHERE name = 'profile'").fetchone()[0]
+    assert "AUTOINCREMENT" in sql
+    profiles = list(Profile.select().order_by(Profile.id))
+    assert [profile.version for profile in profiles] == [0, 0]
+    assert profiles[0].etag_salt and profiles[0].etag_salt != profiles[1].etag_salt
+    assert Watchlist.get(Watchlist.profile == 1).items() == [1]
+    assert Profile.create(parent=user, name="Test3").id == 4
+    with pytest.raises(IntegrityError):
+        Profile.create(parent=user, name="Test1")
+    assert apply_migrations() == []
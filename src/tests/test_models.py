@@ -1,3 +1,5 @@
+import datetime
+
 import pytest
 from peewee import DoesNotExist
 from src.security import hash_password
@@ -6,8 +8,13 @@ from src.models import (
     Profile,
     Preferences,
     Watchlist,
+    WatchlistItem,
     Watchhistory,
-    Notification
+    WatchProgress,
+    Notification,
+    TokenSession,
+    ChangeLogEntry,
+    progress_buffer
 )
 
 
@@ -71,6 +78,13 @@ def test_watchlist(db):
     watchlist.remove(2134)
     assert len(watchlist.watchlist.get("watchlist")) == 2
 
+    watchlist.add(9999)
+    assert WatchlistItem.select().where(WatchlistItem.profile == profile).count() == 2
+    assert watchlist.contains(9999) and not watchlist.contains(2134)
+
+    watchlist.clear()
+    assert watchlist.items() == []
+
 
 def test_watchhistory(db):
     user: UserAccount = UserAccount.get(UserAccount.username == "Dummy1")
@@ -88,6 +102,11 @@ def test_watchhistory(db):
     watchhistory.remove(2134)
     assert len(watchhistory.watchhistory.get("watchhistory")) == 2
 
+    watchhistory.add(9999, 120, 5400)  # heartbeat for a title already in history
+    assert WatchProgress.select().where(WatchProgress.profile == profile).count() == 2
+    assert watchhistory.resume_position(9999) == 120
+    assert watchhistory.recent(1) == [{"id": 9999, "current_time": 120, "duration": 5400}]
+
 
 def test_preferences(db):
     user: UserAccount = UserAccount.get(UserAccount.username == "Dummy1")
@@ -104,13 +123,158 @@ def test_preferences(db):
     assert not preferences.preferences.get("color")
 
 
+def test_preferences_partial_updates(db):
+    user: UserAccount = UserAccount.get(UserAccount.username == "Dummy1")
+    profile = Profile.create(parent=user, name="Test1")
+    preferences: Preferences = Preferences.get(Preferences.profile == profile)
+    preferences.update_prefs({"player": {"volume": 5, "subtitles": True}, "genres": [12, "drama", 35]})
+
+    preferences.patch({"player": {"volume": 8, "subtitles": None}, "language": "en"})
+    preferences.append(["genres"], {"id": 99})
+    preferences.set_path(["player", "speed"], 1.5)
+    assert not preferences.set_path(["language"], "fr", overwrite=False)
+    assert preferences.remove_value(["genres"], "drama")
+    assert not preferences.remove_value(["language"], "en")
+    preferences.remove_path(["genres", 0])
+
+    expected = {"player": {"volume": 8, "speed": 1.5}, "genres": [35, {"id": 99}], "language": "en"}
+    assert preferences.preferences == expected
+    assert Preferences.get_by_id(preferences.id).preferences == expected
+    # The refused insert and removal changed nothing
+    assert preferences.version == Preferences.get_by_id(preferences.id).version == 6
+
+
 def test_notification(db):
     user: UserAccount = UserAccount.get(UserAccount.username == "Dummy1")
     Profile.create(parent=user, name="Test1")
     assert Profile.get(Profile.name == "Test1")
 
     profile: Profile = Profile.get(Profile.parent == user, Profile.name == "Test1")
-    notification: Notification = Notification.create(profile=profile)
+    notification: Notification = Notification.get(Notification.profile == profile)
+
+    first = notification.add({"message": "New episode"})
+    notification.add({"message": "Back in stock"})
+    assert [item["payload"]["message"] for item in notification.unread()] == ["New episode", "Back in stock"]
+
+    assert notification.mark_read([first.id]) == 1
+    assert [item["id"] for item in notification.unread()] == [first.id + 1]
+    assert notification.unread(after=first.id + 1) == []
+
+
+def test_token_sessions(db):
+    user: UserAccount = UserAccount.get(UserAccount.username == "Dummy1")
+    user.register_token("token_a")
+    user.register_token("token_b")
+    assert TokenSession.select().where(TokenSession.user == user).count() == 2
+    assert user.check_token("token_a") and user.check_token("token_b")
+
+    user.register_token("expired", expires_at=datetime.datetime.now() - datetime.timedelta(minutes=1))
+    assert not user.check_token("expired")
+
+    user.revoke_all_tokens()
+    assert not user.check_token("token_a") and not user.check_token("token_b")
+
+
+def test_watchhistory_write_behind(db):
+    user: UserAccount = UserAccount.get(UserAccount.username == "Dummy1")
+    profile = Profile.create(parent=user, name="Test1")
+    watchhistory: Watchhistory = Watchhistory.get(Watchhistory.profile == profile)
+    watchhistory.add(2134, 10, 5400)
 
-    # notification.add
-    ...
+    for current_time in range(30, 300, 30):
+        watchhistory.buffer(2134, current_time)
+    watchhistory.buffer(9999, 5)
+    assert len(progress_buffer) == 2
+    assert watchhistory.resume_position(2134) == 270
+    assert watchhistory.recent(1) == [{"id": 9999, "current_time": 5, "duration": None}]
+    assert WatchProgress.get(WatchProgress.tmdb_id == 2134).current_time == 10
+
+    assert progress_buffer.flush() == 2
+    assert WatchProgress.get(WatchProgress.tmdb_id == 2134).current_time == 270
+    assert WatchProgress.get(WatchProgress.tmdb_id == 2134).duration == 5400
+    assert watchhistory.watchhistory.get("watchhistory")[1]["id"] == 9999
+
+
+def test_write_behind_drops_rejected_rows(db):
+    user: UserAccount = UserAccount.get(UserAccount.username == "Dummy1")
+    watchhistory: Watchhistory = Watchhistory.get(Watchhistory.profile == Profile.create(parent=user, name="Test1"))
+    watchhistory.buffer(1, 2 ** 63)
+    watchhistory.buffer(2, 10)
+
+    assert progress_buffer.flush() == 1
+    assert len(progress_buffer) == 0
+    assert [row.tmdb_id for row in WatchProgress.select()] == [2]
+
+
+def test_profile_hydrate(db):
+    user: UserAccount = UserAccount.get(UserAccount.username == "Dummy1")
+    profile = Profile.create(parent=user, name="Test1")
+    assert Preferences.get(Preferences.profile == profile) and Notification.get(Notification.profile == profile)
+    Watchlist.get(Watchlist.profile == profile).add(2134)
+    watchhistory: Watchhistory = Watchhistory.get(Watchhistory.profile == profile)
+    watchhistory.add(2134, 30)
+    watchhistory.buffer(9999, 5)
+
+    state = Profile.hydrate(user, profile.id)
+    progress_buffer.discard(profile.id)
+    assert state["profile"]["name"] == "Test1"
+    assert state["watchlist"] == [2134]
+    assert [entry["id"] for entry in state["watchhistory"]] == [2134, 9999]
+    assert Profile.hydrate(user, profile.id + 1) is None
+
+
+def test_changelog(db):
+    user: UserAccount = UserAccount.get(UserAccount.username == "Dummy1")
+    profile = Profile.create(parent=user, name="Test1")
+    watchlist: Watchlist = Watchlist.get(Watchlist.profile == profile)
+    watchlist.add(1)
+    watchlist.add(2)
+    watchlist.remove(1)
+    watchhistory: Watchhistory = Watchhistory.get(Watchhistory.profile == profile)
+    watchhistory.buffer(2, 10)
+    watchhistory.buffer(2, 20)
+    progress_buffer.flush()
+
+    changes, has_more = ChangeLogEntry.since(user.id, 0, 100)
+    assert not has_more
+    assert [(change["resource"], change["op"], change.get("tmdb_id")) for change in changes] == [
+        ("profile", "create", None),
+        ("watchlist", "add", 2),
+        ("watchlist", "remove", 1),
+        ("watchhistory", "progress", 2),
+    ]
+    assert changes[-1]["data"] == {"current_time": 20, "duration": None}
+
+    seq = changes[-1]["seq"]
+    watchlist.clear()
+    assert [change["op"] for change in ChangeLogEntry.since(user.id, seq, 100)[0]] == ["clear"]
+
+    assert ChangeLogEntry.compact(datetime.datetime.now() + datetime.timedelta(seconds=1)) == 6
+    assert UserAccount.get_by_id(user.id).changelog_floor == seq + 1
+    # The emptied feed continues above the floor
+    watchlist.add(3)
+    assert ChangeLogEntry.since(user.id, seq + 1, 100)[0][0]["seq"] == seq + 2
+
+
+def test_changelog_never_collapses_across_a_delete(db):
+    user: UserAccount = UserAccount.get(UserAccount.username == "Dummy1")
+    ChangeLogEntry.record(user.id, 7, "profile", "create")
+    ChangeLogEntry.record(user.id, 7, "watchlist", "add", [{"tmdb_id": 1}])
+    ChangeLogEntry.record(user.id, 7, "profile", "delete")
+    ChangeLogEntry.record(user.id, 7, "profile", "create")
+    ChangeLogEntry.record(user.id, 7, "watchlist", "add", [{"tmdb_id": 2}])
+
+    changes, _ = ChangeLogEntry.since(user.id, 0, 100)
+    assert [(change["resource"], change["op"], change.get("tmdb_id")) for change in changes] == [
+        ("profile", "delete", None),
+        ("profile", "create", None),
+        ("watchlist", "add", 2),
+    ]
+
+
+def test_etag_differs_for_a_row_with_the_same_id(db):
+    user: UserAccount = UserAccount.get(UserAccount.username == "Dummy1")
+    profile = Profile.create(parent=user, name="Test1")
+    profile.delete_instance(recursive=True)
+    Profile.insert(id=profile.id, parent=user, name="Test2").execute()
+    assert Profile.get_by_id(profile.id).etag != profile.etag
@@ -1,6 +1,32 @@
-from src.security import hash_password, verify_password
+import asyncio
+import time
+
+from src.security import (
+    hash_password,
+    verify_password,
+    hash_password_async,
+    verify_password_async,
+    HasherPool,
+    HasherSaturatedError
+)
 
 
 def test_password_hash():
     password = hash_password("Password1234")
     assert verify_password(password, "Password1234")
+
+
+def test_password_hash_async():
+    password = asyncio.run(hash_password_async("Password1234"))
+    assert asyncio.run(verify_password_async(password, "Password1234"))
+
+
+def test_hasher_pool_saturation():
+    pool = HasherPool(max_workers=1, max_queue=0)
+
+    async def burst():
+        return await asyncio.gather(pool.run(time.sleep, 0.05), pool.run(time.sleep, 0.05), return_exceptions=True)
+
+    results = asyncio.run(burst())
+    pool.shutdown()
+    assert results[0] is None and isinstance(results[1], HasherSaturatedError)
@@ -0,0 +1,117 @@
+import pytest
+from fastapi.testclient import TestClient
+
+from src.cache import route_cache, token_cache
+from src.database import DatabaseSingleton, shard_for, use_shard
+from src.models import MODELS, AccountRoute, Profile, UserAccount, WatchlistItem, create_tables, progress_buffer
+from src.security import hash_password
+from src.sharding import rebalance
+
+USERS = ["Dummy1", "Dummy2", "Dummy3", "Dummy4"]
+
+
+def create_users(names):
+    for name in names:
+        UserAccount().create_user(username=name, email=f"{name}@gmooch.com", hashed_password=hash_password(name))
+
+
+def accounts(shard) -> list[str]:
+    with use_shard(shard), DatabaseSingleton().reader():
+        return sorted(UserAccount.select(UserAccount.username).scalars())
+
+
+@pytest.fixture
+def sharded_db(tmp_path):
+    _db = DatabaseSingleton.initialize(str(tmp_path / "test.sqlite3"), shards=2)
+    _db.bind(MODELS, bind_refs=False, bind_backrefs=False)
+    create_tables()
+    route_cache.clear()
+    create_users(USERS)
+    yield _db
+    _db.close_pool()
+
+
+@pytest.fixture
+def sharded_client(sharded_db):
+    from src.main import app
+    token_cache.clear()
+    with TestClient(app) as client:
+        yield client
+
+
+def login(client, name) -> dict:
+    result = client.post("/token", data={"username": name, "password": name})
+    return {"Authorization": f"Bearer {result.json()['access_token']}"}
+
+
+def test_accounts_are_routed(sharded_db):
+    with use_shard(None), sharded_db.reader():
+        routes = {route.username: route for route in AccountRoute.select()}
+    assert sorted(routes) == USERS
+    for route in routes.values():
+        assert route.shard == shard_for(route.id, 2)
+        assert AccountRoute.shard_of(route.username) == route.shard
+    assert accounts(None) == []
+    assert sorted(accounts(0) + accounts(1)) == USERS
+
+    # The route claims the username before any shard is touched
+    with pytest.raises(Exception):
+        create_users(["Dummy1"])
+    with use_shard(None), sharded_db.reader():
+        assert AccountRoute.select().count() == len(USERS)
+
+
+def test_sharded_requests(sharded_client):
+    shards = {name: AccountRoute.shard_of(name) for name in USERS}
+    assert set(shards.values()) == {0, 1}
+    first = next(name for name in USERS if shards[name] == 0)
+    second = next(name for name in USERS if shards[name] == 1)
+
+    profiles = {}
+    for name, tmdb_id in ((first, 1), (second, 2)):
+        headers = login(sharded_client, name)
+        profile_id = sharded_client.post("/manageprofiles", params={"name": name}, headers=headers).json()["data"]["id"]
+        sharded_client.put("/watchlist/add", params={"profile_id": profile_id, "tmdb_id": tmdb_id}, headers=headers)
+        sharded_client.put("/watchhistory/add", params={"profile_id": profile_id, "tmdb_id": tmdb_id,
+                                                        "current_time": 10}, headers=headers)
+        profiles[name] = (profile_id, headers)
+
+    # Profile ids are per file, the same id exists in both shards
+    assert profiles[first][0] == profiles[second][0]
+    assert progress_buffer.flush() == 2
+    for name, tmdb_id in ((first, 1), (second, 2)):
+        profile_id, headers = profiles[name]
+        assert sharded_client.get(f"/watchlist/{profile_id}", headers=headers).json()["data"]["watchlist"] == [tmdb_id]
+        result = sharded_client.get(f"/watchhistory/{profile_id}/{tmdb_id}", headers=headers)
+        assert result.json() == {"data": {"id": tmdb_id, "current_time": 10}}
+        with use_shard(shards[name]), DatabaseSingleton().reader():
+            assert list(WatchlistItem.select(WatchlistItem.tmdb_id).scalars()) == [tmdb_id]
+
+
+def test_rebalance(sharded_db):
+    from src.main import app
+    token_cache.clear()
+    with TestClient(app) as client:
+        headers = login(client, "Dummy1")
+        profile_id = client.post("/manageprofiles", params={"name": "Kid"}, headers=headers).json()["data"]["id"]
+        client.put("/watchlist/add", params={"profile_id": profile_id, "tmdb_id": 7}, headers=headers)
+        seq = client.get("/sync", headers=headers).json()["data"]["seq"]
+
+    # Everything back into the main file, then across three shards
+    assert rebalance(0, sharded_db.database) == len(USERS)
+    assert accounts(None) == USERS
+    assert rebalance(3, sharded_db.database) == len(USERS)
+    assert accounts(None) == []
+    assert sorted(accounts(0) + accounts(1) + accounts(2)) == USERS
+
+    DatabaseSingleton.initialize(sharded_db.database, shards=3).bind(MODELS, bind_refs=False, bind_backrefs=False)
+    route_cache.clear()
+    token_cache.clear()
+    with TestClient(app) as client:
+        # Sessions move with the account, the move marker forces a resync
+        assert client.get("/sync", params={"since": seq}, headers=headers).json()["data"]["resync"] is True
+        with use_shard(AccountRoute.shard_of("Dummy1")), DatabaseSingleton().reader():
+            moved = Profile.get(Profile.name == "Kid")
+        result = client.get(f"/watchlist/{moved.id}", headers=headers)
+        assert result.json()["data"]["watchlist"] == [7]
+    DatabaseSingleton().close_pool()
@@ -0,0 +1,60 @@
+import asyncio
+
+import httpx
+import pytest
+
+from src.tmdb import TmdbClient, TmdbError, tmdb_client
+
+
+def stub_tmdb():
+    # Local stand-in for api.themoviedb.org, records every path it serves
+    calls = []
+
+    async def handler(request: httpx.Request):
+        calls.append(request.url.path)
+        await asyncio.sleep(0.01)
+        tmdb_id = int(request.url.path.rsplit("/", 1)[1])
+        if tmdb_id == 404:
+            return httpx.Response(404, json={"status_message": "Not found"})
+        if tmdb_id == 502:
+            return httpx.Response(200, text="<html>Bad gateway</html>")
+        return httpx.Response(200, json={"id": tmdb_id, "title": f"Title {tmdb_id}"})
+
+    return httpx.MockTransport(handler), calls
+
+
+def test_single_flight_and_tiers(file_db):
+    transport, calls = stub_tmdb()
+
+    async def run():
+        client = TmdbClient("key", base_url="http://tmdb.test/3", transport=transport)
+        results = await asyncio.gather(*(client.get("movie/550") for _ in range(10)))
+        with pytest.raises(TmdbError):
+            await client.get("movie/404")
+        with pytest.raises(TmdbError) as invalid:
+            await client.get("movie/502")
+        assert invalid.value.status_code == 502
+        await client.aclose()
+
+        # A fresh process only has the sqlite tier
+        restarted = TmdbClient("key", base_url="http://tmdb.test/3", transport=transport)
+        assert await restarted.get("movie/550") == results[0]
+        await restarted.aclose()
+        return results
+
+    results = asyncio.run(run())
+    assert all(result == {"id": 550, "title": "Title 550"} for result in results)
+    assert calls == ["/3/movie/550", "/3/movie/404", "/3/movie/502"]
+
+
+def test_watchlist_hydration(client, auth_headers, profile_id, monkeypatch):
+    transport, calls = stub_tmdb()
+    monkeypatch.setattr(tmdb_client, "transport", transport)
+    operations = [{"op": "add", "tmdb_id": tmdb_id} for tmdb_id in (1, 2, 404)]
+    client.put("/watchlist/bulk", json={"profile_id": profile_id, "operations": operations}, headers=auth_headers)
+
+    for _ in range(2):
+        result = client.get(f"/tmdb/watchlist/{profile_id}", headers=auth_headers).json()
+        assert [entry["details"] and entry["details"]["id"] for entry in result["data"]] == [1, 2, None]
+    assert calls.count("/3/movie/1") == 1 and calls.count("/3/movie/2") == 1
+    assert client.get("/tmdb/movie/404", headers=auth_headers).status_code == 404
@@ -0,0 +1,76 @@
+import json
+
+from src import transfer
+from src.models import UserAccount
+from src.security import hash_password
+
+
+def library(client, headers, profile_id) -> dict:
+    return {
+        "watchlist": client.get(f"/watchlist/{profile_id}", headers=headers).json()["data"]["watchlist"],
+        "watchhistory": client.get(f"/watchhistory/{profile_id}", headers=headers).json()["data"]["watchhistory"],
+        "preferences": client.get(f"/preferences/{profile_id}", headers=headers).json()["data"],
+    }
+
+
+def entries(records: list[dict]) -> list[dict]:
+    return [{key: value for key, value in record.items() if key != "profile"}
+            for record in records if record["type"] in ("watchlist", "watchhistory")]
+
+
+def test_export_and_import(client, auth_headers, profile_id, monkeypatch):
+    monkeypatch.setattr(transfer, "EXPORT_CHUNK", 10)
+    monkeypatch.setattr(transfer, "IMPORT_CHUNK", 7)
+    operations = [{"op": "add", "tmdb_id": tmdb_id} for tmdb_id in range(25)]
+    client.put("/watchlist/bulk", json={"profile_id": profile_id, "operations": operations}, headers=auth_headers)
+    operations = [{"op": "progress", "tmdb_id": tmdb_id, "current_time": tmdb_id * 10} for tmdb_id in range(12)]
+    client.put("/watchhistory/bulk", json={"profile_id": profile_id, "operations": operations}, headers=auth_headers)
+    client.put(f"/preferences/{profile_id}", json={"preferences": {"language": "en"}}, headers=auth_headers)
+    client.post(f"/notification/{profile_id}", json={"payload": {"text": "hi"}}, headers=auth_headers)
+
+    export = client.get("/account/export", headers=auth_headers)
+    assert export.headers["content-type"] == "application/x-ndjson"
+    records = [json.loads(line) for line in export.text.splitlines()]
+    assert records[0]["type"] == "account"
+    kinds = [record["type"] for record in records[1:]]
+    assert kinds == ["profile", "preferences"] + ["watchlist"] * 25 + ["watchhistory"] * 12 + ["notification"]
+
+    UserAccount().create_user(username="Dummy2", email="dummy2@gmooch.com", hashed_password=hash_password("Password@1234"))
+    token = client.post("/token", data={"username": "Dummy2", "password": "Password@1234"}).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    for _ in range(2):
+        # Merged by profile name, importing twice changes nothing in the lists
+        result = client.post("/account/import", content=export.content, headers=headers)
+        assert result.status_code == 200
+        assert result.json()["data"] == {"profiles": 1, "preferences": 1, "watchlist": 25,
+                                         "watchhistory": 12, "notifications": 1}
+    profiles = client.get("/manageprofiles", headers=headers).json()["data"]
+    assert [profile["name"] for profile in profiles] == ["Test1"]
+    assert library(client, headers, profiles[0]["id"]) == library(client, auth_headers, profile_id)
+    # Entries keep when they were added and last watched
+    imported = [json.loads(line) for line in client.get("/account/export", headers=headers).text.splitlines()]
+    assert entries(imported) == entries(records)
+    notifications = client.get(f"/notification/{profiles[0]['id']}", headers=headers).json()["data"]
+    assert [item["payload"] for item in notifications] == [{"text": "hi"}] * 2
+
+
+def test_import_rejects_bad_lines(client, auth_headers):
+    body = b'{"type": "watchlist", "profile": 1, "id": 5}\n'
+    result = client.post("/account/import", content=body, headers=auth_headers)
+    assert result.status_code == 400
+    assert result.json()["detail"].startswith("Line 1: Profile 1 is not defined")
+
+    body = b'{"type": "profile", "id": 1, "name": "Imported"}\n{"type": "watchlist", "profile": 1}\n'
+    result = client.post("/account/import", content=body, headers=auth_headers)
+    assert result.status_code == 400
+    assert result.json()["detail"].startswith("Line 2: ")
+
+
+def test_import_bounds_line_length(client, auth_headers, monkeypatch):
+    monkeypatch.setattr(transfer, "IMPORT_MAX_LINE", 64)
+    profile = b'{"type": "profile", "id": 1, "name": "Imported"}'
+    result = client.post("/account/import", content=profile + b"\n" + b" " * 65 + b"\n", headers=auth_headers)
+    assert result.status_code == 400
+    assert result.json()["detail"].startswith("Line 2: Line longer than 64 bytes")
+    # A line of exactly the limit, its newline aside, is read
+    assert client.post("/account/import", content=profile.ljust(64) + b"\n", headers=auth_headers).status_code == 200
@@ -0,0 +1,142 @@
+import asyncio
+import datetime
+import os
+from urllib.parse import urlencode
+
+import httpx
+from starlette.concurrency import run_in_threadpool
+
+from src.cache import TTLCache
+from src.database import main_shard, read_transaction, write_transaction
+from src.models import TmdbCache
+
+TMDB_API_KEY = os.getenv("PRIVATE_TMDB_API_KEY")
+TMDB_BASE_URL = os.getenv("TMDB_BASE_URL", "https://api.themoviedb.org/3")
+TMDB_MEMORY_SIZE = int(os.getenv("TMDB_MEMORY_SIZE", 10000))
+TMDB_MEMORY_TTL = int(os.getenv("TMDB_MEMORY_TTL", 300))  # seconds
+TMDB_PERSISTENT_TTL = int(os.getenv("TMDB_PERSISTENT_TTL", 86400))  # seconds
+TMDB_CONCURRENCY = int(os.getenv("TMDB_CONCURRENCY", 8))  # upstream requests in flight
+
+
+class TmdbError(Exception):
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+class TmdbClient:
+    # Lookups go memory -> sqlite -> upstream. Concurrent misses for the same
+    # key share one in-flight future so a cold title is fetched once.
+    def __init__(self, api_key: str | None, base_url: str = TMDB_BASE_URL,
+                 transport: httpx.AsyncBaseTransport | None = None):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.transport = transport
+        self.memory = TTLCache(maxsize=TMDB_MEMORY_SIZE, ttl=TMDB_MEMORY_TTL)
+        self.upstream_calls = 0
+        self._client: httpx.AsyncClient | None = None
+        self._inflight: dict[str, asyncio.Future] = {}
+        self._semaphore = asyncio.Semaphore(TMDB_CONCURRENCY)
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(base_url=self.base_url, transport=self.transport, timeout=10)
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        # Both are tied to the event loop that is shutting down
+        self._inflight.clear()
+        self._semaphore = asyncio.Semaphore(TMDB_CONCURRENCY)
+
+    @staticmethod
+    def cache_key(path: str, params: dict | None = None) -> str:
+        path = path.strip("/")
+        return f"{path}?{urlencode(sorted(params.items()))}" if params else path
+
+    async def get(self, path: str, params: dict | None = None) -> dict:
+        key = self.cache_key(path, params)
+        data = self.memory.get(key)
+        if data is not None:
+            return data
+
+        future = self._inflight.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            data = await run_in_threadpool(load_persistent, [key])
+            data = data.get(key)
+            if data is None:
+                data = await self._fetch(path, params)
+                await run_in_threadpool(store_persistent, {key: data})
+            self.memory.set(key, data)
+            future.set_result(data)
+            return data
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # waiters re-raise it, do not warn when there are none
+            raise
+        finally:
+            del self._inflight[key]
+
+    async def hydrate(self, kind: str, tmdb_ids: list[int]) -> dict[int, dict | None]:
+        keys = {tmdb_id: self.cache_key(f"{kind}/{tmdb_id}") for tmdb_id in dict.fromkeys(tmdb_ids)}
+        results = {tmdb_id: self.memory.get(key) for tmdb_id, key in keys.items()}
+
+        # One query for every title the memory tier missed
+        missing = [keys[tmdb_id] for tmdb_id, data in results.items() if data is None]
+        stored = await run_in_threadpool(load_persistent, missing) if missing else {}
+        for tmdb_id, key in keys.items():
+            if results[tmdb_id] is None and key in stored:
+                results[tmdb_id] = stored[key]
+                self.memory.set(key, stored[key])
+
+        async def fetch(tmdb_id):
+            try:
+                results[tmdb_id] = await self.get(f"{kind}/{tmdb_id}")
+            except TmdbError:
+                results[tmdb_id] = None
+
+        await asyncio.gather(*(fetch(tmdb_id) for tmdb_id, data in results.items() if data is None))
+        return results
+
+    async def _fetch(self, path: str, params: dict | None) -> dict:
+        async with self._semaphore:
+            self.upstream_calls += 1
+            try:
+                response = await self.client.get(f"/{path.strip('/')}", params={**(params or {}), "api_key": self.api_key})
+            except httpx.HTTPError as e:
+                raise TmdbError(502, f"TMDB request failed: {e}")
+        if response.status_code != 200:
+            raise TmdbError(response.status_code if response.status_code == 404 else 502,
+                            f"TMDB responded with {response.status_code}")
+        try:
+            data = response.json()
+        except ValueError:
+            raise TmdbError(502, "TMDB responded with invalid JSON")
+        if not isinstance(data, dict):
+            raise TmdbError(502, "TMDB responded with an unexpected body")
+        return data
+
+
+# The cache is shared by every account and lives in the main file
+@main_shard
+@read_transaction
+def load_persistent(keys: list[str]) -> dict[str, dict]:
+    return TmdbCache.load(keys, datetime.datetime.now())
+
+
+@main_shard
+@write_transaction
+def store_persistent(entries: dict[str, dict]):
+    TmdbCache.store(entries, TMDB_PERSISTENT_TTL)
+
+
+tmdb_client = TmdbClient(TMDB_API_KEY)
@@ -0,0 +1,211 @@
+import datetime
+import os
+from typing import AsyncIterator, Callable
+
+from pydantic import TypeAdapter, ValidationError
+from starlette.concurrency import run_in_threadpool
+
+from src.database import read_transaction, write_transaction
+from src.forms import (
+    AccountRecord,
+    ImportRecord,
+    NotificationRecord,
+    PreferencesRecord,
+    ProfileRecord,
+    WatchhistoryRecord,
+    WatchlistRecord
+)
+from src.models import Notification, Preferences, Profile, UserAccount, Watchhistory, Watchlist
+from src.responses import dumps
+
+EXPORT_VERSION = 1
+EXPORT_CHUNK = int(os.getenv("EXPORT_CHUNK", 1000))  # entries per read transaction
+IMPORT_CHUNK = int(os.getenv("IMPORT_CHUNK", 1000))  # records per write transaction
+IMPORT_MAX_LINE = 1024 * 1024  # bytes, a longer line is rejected before it is buffered
+
+record_adapter = TypeAdapter(ImportRecord)
+
+
+class ImportFormatError(ValueError):
+    def __init__(self, line: int, reason: str):
+        super().__init__(f"Line {line}: {reason}")
+        self.line = line
+
+
+def line(record: dict) -> bytes:
+    return dumps(record) + b"\n"
+
+
+@read_transaction
+def export_profiles(user_id: int) -> list[dict]:
+    profiles = list(Profile.select().where(Profile.parent == user_id).order_by(Profile.id))
+    preferences = dict(Preferences
+                       .select(Preferences.profile, Preferences.preferences)
+                       .where(Preferences.profile.in_([profile.id for profile in profiles]))
+                       .tuples())
+    records = []
+    for profile in profiles:
+        records.append({"type": "profile", "id": profile.id, "name": profile.name, "avatar_url": profile.avatar_url})
+        records.append({"type": "preferences", "profile": profile.id, "data": preferences.get(profile.id, {})})
+    return records
+
+
+def keyed_history_page(profile_id: int, after) -> tuple[list[dict], object]:
+    # The history endpoints leave updated_at out, the export keeps it from the key
+    entries, next_key = Watchhistory.get(Watchhistory.profile == profile_id).keyed_page(EXPORT_CHUNK, after)
+    return [{**entry, "updated_at": updated_at} for (updated_at, _), entry in entries], next_key
+
+
+# Keyset pages of the per-profile lists, the same ones the list endpoints serve
+EXPORT_PAGES: dict[str, Callable] = {
+    "watchlist": lambda profile_id, after: (
+        Watchlist.get(Watchlist.profile == profile_id).page(EXPORT_CHUNK, after)),
+    "watchhistory": keyed_history_page,
+    "notification": lambda profile_id, after: (
+        Notification.get(Notification.profile == profile_id).page(EXPORT_CHUNK, after)),
+}
+
+
+@read_transaction
+def export_page(kind: str, profile_id: int, after) -> tuple[list[dict], object]:
+    entries, next_key = EXPORT_PAGES[kind](profile_id, after)
+    return [{"type": kind, "profile": profile_id, **entry} for entry in entries], next_key
+
+
+async def export_account(user: UserAccount) -> AsyncIterator[bytes]:
+    # One read transaction per chunk, a long download never pins a snapshot
+    # and holds at most EXPORT_CHUNK entries. Entries that change while it
+    # runs show up in either state.
+    yield line({"type": "account", "version": EXPORT_VERSION, "username": user.username,
+                "exported_at": datetime.datetime.now()})
+    records = await run_in_threadpool(export_profiles, user.id)
+    yield b"".join(map(line, records))
+    for profile_id in [record["id"] for record in records if record["type"] == "profile"]:
+        for kind in EXPORT_PAGES:
+            after = None
+            while True:
+                entries, after = await run_in_threadpool(export_page, kind, profile_id, after)
+                if entries:
+                    yield b"".join(map(line, entries))
+                if after is None:
+                    break
+
+
+class BodyReader:
+    # readline() over the chunks of a streamed body, holds one chunk of it
+    def __init__(self, stream: AsyncIterator[bytes]):
+        self._chunks = aiter(stream)
+        self._chunk = b""
+        self._pos = 0
+
+    async def readline(self, limit: int) -> bytes:
+        # Up to and including the next newline, at most `limit` bytes, b"" once
+        # the body is read
+        parts, size = [], 0
+        while size < limit:
+            if self._pos == len(self._chunk):
+                try:
+                    self._chunk, self._pos = await anext(self._chunks), 0
+                except StopAsyncIteration:
+                    break
+                continue
+            stop = min(len(self._chunk), self._pos + limit - size)
+            end = self._chunk.find(b"\n", self._pos, stop)
+            if end != -1:
+                stop = end + 1
+            parts.append(self._chunk[self._pos:stop])
+            size += stop - self._pos
+            self._pos = stop
+            if end != -1:
+                break
+        return b"".join(parts)
+
+
+async def read_records(stream: AsyncIterator[bytes], chunk: int = IMPORT_CHUNK) -> AsyncIterator[list]:
+    # Reads the body a line at a time and yields validated records `chunk` at
+    # a time, nothing beyond one chunk, one line and one body chunk is buffered
+    reader, number, records = BodyReader(stream), 0, []
+    profiles: set[int] = set()
+
+    def parse(raw: bytes):
+        nonlocal number
+        number += 1
+        if not raw.strip():
+            return
+        try:
+            record = record_adapter.validate_json(raw)
+        except ValidationError as e:
+            raise ImportFormatError(number, e.errors(include_url=False)[0]["msg"])
+        if isinstance(record, AccountRecord):
+            if record.version > EXPORT_VERSION:
+                raise ImportFormatError(number, f"Unsupported export version {record.version}")
+            return
+        if isinstance(record, ProfileRecord):
+            profiles.add(record.id)
+        elif record.profile not in profiles:
+            raise ImportFormatError(number, f"Profile {record.profile} is not defined before its entries")
+        records.append(record)
+
+    while raw := await reader.readline(IMPORT_MAX_LINE + 1):
+        if len(raw) > IMPORT_MAX_LINE and not raw.endswith(b"\n"):
+            raise ImportFormatError(number + 1, f"Line longer than {IMPORT_MAX_LINE} bytes")
+        parse(raw)
+        if len(records) >= chunk:
+            yield records
+            records = []
+    if records:
+        yield records
+
+
+class AccountImport:
+    # Merges an export into the account, profiles are matched by name. Each
+    # chunk commits on its own, a failed import keeps the chunks before it and
+    # can be run again: list entries are idempotent, notifications are not.
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.profiles: dict[int, int] = {}
+        self.counts = {"profiles": 0, "preferences": 0, "watchlist": 0, "watchhistory": 0, "notifications": 0}
+
+    def _profile(self, record: ProfileRecord) -> int:
+        profile = Profile.get_or_none(Profile.parent == self.user_id, Profile.name == record.name)
+        if profile is None:
+            profile = Profile.create(parent=self.user_id, name=record.name, avatar_url=record.avatar_url)
+        return profile.id
+
+    def apply(self, records: list):
+        watchlist: dict[int, list] = {}
+        watchhistory: dict[int, list] = {}
+        notifications: dict[int, list] = {}
+        for record in records:
+            if isinstance(record, ProfileRecord):
+                self.profiles[record.id] = self._profile(record)
+                self.counts["profiles"] += 1
+                continue
+            profile_id = self.profiles[record.profile]
+            if isinstance(record, PreferencesRecord):
+                Preferences.get(Preferences.profile == profile_id).update_prefs(record.data)
+                self.counts["preferences"] += 1
+            elif isinstance(record, WatchlistRecord):
+                watchlist.setdefault(profile_id, []).append(record.model_dump())
+            elif isinstance(record, WatchhistoryRecord):
+                watchhistory.setdefault(profile_id, []).append(record.model_dump())
+            elif isinstance(record, NotificationRecord):
+                notifications.setdefault(profile_id, []).append(record.model_dump())
+
+        # One batched restore per profile and list, entries keep their timestamps
+        for profile_id, items in watchlist.items():
+            Watchlist.get(Watchlist.profile == profile_id).restore(items)
+            self.counts["watchlist"] += len(items)
+        for profile_id, items in watchhistory.items():
+            Watchhistory.get(Watchhistory.profile == profile_id).restore(items)
+            self.counts["watchhistory"] += len(items)
+        for profile_id, items in notifications.items():
+            Notification.get(Notification.profile == profile_id).restore(items)
+            self.counts["notifications"] += len(items)
+
+
+async def import_account(user_id: int, stream: AsyncIterator[bytes]) -> dict:
+    importer = AccountImport(user_id)
+    async for records in read_records(stream, IMPORT_CHUNK):
+        await run_in_threadpool(write_transaction(importer.apply), records)
+    return importer.counts
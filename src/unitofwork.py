@@ -0,0 +1,50 @@
+from fastapi import HTTPException, status
+from peewee import DoesNotExist
+
+from src.models import BaseModel, Profile, UserAccount
+
+
+class UnitOfWork:
+    # Request scoped identity map. Profiles are keyed by id and the one-per-
+    # profile child models (Watchlist, Watchhistory, ...) by their profile id,
+    # so each is loaded at most once per request.
+    def __init__(self, user: UserAccount, token: str):
+        self.user = user
+        self.token = token
+        self._identity_map: dict[tuple[type, int], BaseModel] = {}
+
+    def profile(self, profile_id: int) -> Profile:
+        key = (Profile, profile_id)
+        if key not in self._identity_map:
+            try:
+                self._identity_map[key] = Profile.get(Profile.parent == self.user, Profile.id == profile_id)
+            except DoesNotExist:
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not profile found")
+        return self._identity_map[key]
+
+    def get(self, model: type[BaseModel], profile_id: int) -> BaseModel:
+        key = (model, profile_id)
+        if key in self._identity_map:
+            return self._identity_map[key]
+
+        profile = self._identity_map.get((Profile, profile_id))
+        try:
+            if profile is not None:
+                instance = model.get(model.profile == profile)
+                instance.profile = profile
+            else:
+                # Ownership check and child lookup in one joined query
+                instance = (model
+                            .select(model, Profile)
+                            .join(Profile)
+                            .where(Profile.id == profile_id, Profile.parent == self.user)
+                            .get())
+                self._identity_map[(Profile, profile_id)] = instance.profile
+        except DoesNotExist:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not profile found")
+        self._identity_map[key] = instance
+        return instance
+
+    def forget(self, profile_id: int):
+        for key in [key for key in self._identity_map if key[1] == profile_id]:
+            del self._identity_map[key]
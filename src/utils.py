@@ -1,12 +1,11 @@
 import sys
 import yaml
 
-from peewee_migrate import Router
 from peewee import SqliteDatabase
 
+from src.migration import run
 from src.models import create_tables, UserAccount
 from src.security import hash_password
-from src.database import DatabaseSingleton
 
 
 def read_config() -> dict | None:
@@ -33,16 +32,8 @@ def create_user():
 
 
 def migrate():
-    router = Router(DatabaseSingleton())
-
-    # Create migration
-    router.create('_')
-
-    # Run migration/migrations
-    router.run('_')
-
-    # Run all unapplied migrations
-    router.run()
+    # Applies src/migrations and drains the backfills they schedule
+    return run()
 
 
 # if __name__ == "__main__":
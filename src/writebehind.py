@@ -0,0 +1,235 @@
+import contextlib
+import datetime
+import logging
+import os
+import threading
+from typing import Callable, ContextManager
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_FLUSH_INTERVAL = float(os.getenv("PROGRESS_FLUSH_INTERVAL", 5))  # seconds
+PROGRESS_FLUSH_SIZE = int(os.getenv("PROGRESS_FLUSH_SIZE", 500))  # pending titles
+
+
+class ProgressBuffer:
+    # Keeps only the latest position per (profile, title) and hands them to
+    # `flush` as rows in one batch, heartbeats between flushes never hit the db.
+    # A batch failing with a `transient` error is requeued, any other failure
+    # is retried row by row and the rows that still fail are dropped.
+    def __init__(self, flush: Callable[[list[dict]], None], interval: float = 5, max_pending: int = 500,
+                 transaction: Callable[[], ContextManager] = contextlib.nullcontext,
+                 transient: tuple[type[Exception], ...] = ()):
+        self._flush = flush
+        self._transaction = transaction
+        self.transient = transient
+        self._flushing: dict[int, dict[int, dict]] = {}
+        self.interval = interval
+        self.max_pending = max_pending
+        self._pending: dict[int, dict[int, dict]] = {}
+        self._size = 0
+        self._seq = 0
+        self._last_seq: dict[int, int] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def __len__(self):
+        return self._size
+
+    def put(self, profile_id: int, tmdb_id: int, current_time: int, duration: int | None = None):
+        with self._lock:
+            entries = self._pending.setdefault(profile_id, {})
+            previous = entries.get(tmdb_id)
+            if previous is None:
+                self._size += 1
+            elif duration is None:
+                duration = previous["duration"]
+            entries[tmdb_id] = {
+                "current_time": current_time,
+                "duration": duration,
+                "updated_at": datetime.datetime.now(),
+            }
+            self._seq += 1
+            self._last_seq[profile_id] = self._seq
+            full = self._size >= self.max_pending
+        if full:
+            if self._thread is not None:
+                self._wake.set()
+            else:
+                self.flush()
+
+    def get(self, profile_id: int, tmdb_id: int) -> dict | None:
+        with self._lock:
+            entry = self._pending.get(profile_id, {}).get(tmdb_id)
+            return entry if entry is not None else self._flushing.get(profile_id, {}).get(tmdb_id)
+
+    def pending(self, profile_id: int) -> dict[int, dict]:
+        # The batch being flushed stays visible until its transaction commits
+        with self._lock:
+            return {**self._flushing.get(profile_id, {}), **self._pending.get(profile_id, {})}
+
+    def seq(self, profile_id: int) -> int:
+        # Changes with every buffered write of the profile, the flush that
+        # persists them bumps the history version and resets it to 0
+        with self._lock:
+            return self._last_seq.get(profile_id, 0)
+
+    def discard(self, profile_id: int, tmdb_id: int | None = None):
+        with self._lock:
+            entries = self._pending.get(profile_id)
+            if not entries:
+                return
+            if tmdb_id is None:
+                self._size -= len(entries)
+                del self._pending[profile_id]
+            elif entries.pop(tmdb_id, None) is not None:
+                self._size -= 1
+            if not entries or tmdb_id is None:
+                self._pending.pop(profile_id, None)
+                self._last_seq.pop(profile_id, None)
+
+    def flush(self) -> int:
+        with self._flush_lock:
+            if not self._size:
+                return 0
+            # The batch is taken inside the write transaction, a remove or
+            # clear serialised before it has already discarded its entries
+            # and one serialised after it deletes the flushed row
+            rows = []
+            try:
+                with self._transaction():
+                    with self._lock:
+                        self._flushing, self._pending, self._size = self._pending, {}, 0
+                    rows = [
+                        {"profile": profile_id, "tmdb_id": tmdb_id, **entry}
+                        for profile_id, entries in self._flushing.items()
+                        for tmdb_id, entry in entries.items()
+                    ]
+                    if rows:
+                        self._flush(rows)
+            except self.transient:
+                self._requeue(self._flushing)
+                raise
+            except Exception:
+                logger.exception("Failed to flush %d watch progress rows, retrying them one by one", len(rows))
+                rows = self._flush_each(rows)
+            finally:
+                with self._lock:
+                    for profile_id in self._flushing:
+                        if profile_id not in self._pending:
+                            self._last_seq.pop(profile_id, None)
+                    self._flushing = {}
+            return len(rows)
+
+    def _flush_each(self, rows: list[dict]) -> list[dict]:
+        flushed = []
+        for index, row in enumerate(rows):
+            try:
+                with self._transaction():
+                    self._flush([row])
+                flushed.append(row)
+            except self.transient:
+                batch: dict[int, dict[int, dict]] = {}
+                for rest in rows[index:]:
+                    rest = dict(rest)
+                    batch.setdefault(rest.pop("profile"), {})[rest.pop("tmdb_id")] = rest
+                self._requeue(batch)
+                raise
+            except Exception:
+                logger.exception("Dropping watch progress of profile %s for %s", row["profile"], row["tmdb_id"])
+        return flushed
+
+    def _requeue(self, batch: dict[int, dict[int, dict]]):
+        # Entries written while the flush was running are newer, keep those
+        with self._lock:
+            for profile_id, entries in batch.items():
+                current = self._pending.setdefault(profile_id, {})
+                for tmdb_id, entry in entries.items():
+                    if tmdb_id not in current:
+                        current[tmdb_id] = entry
+                        self._size += 1
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Failed to flush watch progress, retrying next interval")
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="progress-flush", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._wake.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+
+class PartitionedProgressBuffer:
+    # One ProgressBuffer per shard, profile ids are only unique within a
+    # shard and a flush commits on a single file. `partition` picks the
+    # buffer of the current caller, `factory` builds one for a partition.
+    def __init__(self, factory: Callable[[object], ProgressBuffer], partition: Callable[[], object]):
+        self._factory = factory
+        self._partition = partition
+        self._buffers: dict[object, ProgressBuffer] = {}
+        self._lock = threading.Lock()
+        self.running = False
+
+    def __len__(self):
+        return sum(len(buffer) for buffer in self.buffers())
+
+    def buffers(self) -> list[ProgressBuffer]:
+        with self._lock:
+            return list(self._buffers.values())
+
+    def buffer(self) -> ProgressBuffer:
+        key = self._partition()
+        with self._lock:
+            if key not in self._buffers:
+                self._buffers[key] = self._factory(key)
+                if self.running:
+                    self._buffers[key].start()
+            return self._buffers[key]
+
+    def put(self, profile_id: int, tmdb_id: int, current_time: int, duration: int | None = None):
+        self.buffer().put(profile_id, tmdb_id, current_time, duration)
+
+    def get(self, profile_id: int, tmdb_id: int) -> dict | None:
+        return self.buffer().get(profile_id, tmdb_id)
+
+    def pending(self, profile_id: int) -> dict[int, dict]:
+        return self.buffer().pending(profile_id)
+
+    def seq(self, profile_id: int) -> int:
+        return self.buffer().seq(profile_id)
+
+    def discard(self, profile_id: int, tmdb_id: int | None = None):
+        self.buffer().discard(profile_id, tmdb_id)
+
+    def flush(self) -> int:
+        return sum(buffer.flush() for buffer in self.buffers())
+
+    def start(self):
+        with self._lock:
+            self.running = True
+            buffers = list(self._buffers.values())
+        for buffer in buffers:
+            buffer.start()
+
+    def stop(self):
+        with self._lock:
+            self.running = False
+            buffers = list(self._buffers.values())
+        for buffer in buffers:
+            buffer.stop()
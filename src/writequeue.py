@@ -0,0 +1,100 @@
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, ContextManager
+
+logger = logging.getLogger(__name__)
+
+
+class WriterSaturatedError(Exception):
+    pass
+
+
+class WriteQueue:
+    # Request threads hand their mutations to one writer thread, which runs
+    # whatever has queued up in a single transaction with a savepoint per
+    # mutation. One lock acquisition and one commit (one fsync) per batch
+    # instead of per request, and a failing mutation only rolls back itself.
+    def __init__(self, transaction: Callable[[], ContextManager], savepoint: Callable[[], ContextManager],
+                 max_pending: int = 1000, max_batch: int = 64, timeout: float = 1):
+        self._transaction = transaction
+        self._savepoint = savepoint
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self._queue: queue.Queue = queue.Queue(maxsize=max_pending)
+        self._thread: threading.Thread | None = None
+        self.batches = 0
+        self.committed = 0
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def on_writer_thread(self) -> bool:
+        return threading.current_thread() is self._thread
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def submit(self, fn: Callable[[], Any]) -> Any:
+        future = Future()
+        try:
+            self._queue.put((fn, future), timeout=self.timeout)
+        except queue.Full:
+            raise WriterSaturatedError("Write queue is full")
+        return future.result()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            job = self._queue.get()
+            if job is None:
+                break
+            batch = [job]
+            while len(batch) < self.max_batch:
+                try:
+                    job = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    stopping = True
+                    break
+                batch.append(job)
+            self._commit(batch)
+
+    def _commit(self, batch: list[tuple[Callable, Future]]):
+        outcomes = []
+        try:
+            with self._transaction():
+                for fn, future in batch:
+                    try:
+                        with self._savepoint():
+                            outcomes.append((future, fn(), None))
+                    except Exception as e:
+                        outcomes.append((future, None, e))
+        except Exception as e:
+            # BEGIN or COMMIT failed, nothing in the batch was written
+            logger.exception("Write batch of %d failed", len(batch))
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        self.batches += 1
+        self.committed += len(batch)
+        # Callers resume only once their write is durable
+        for future, result, error in outcomes:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None